@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+from rec.models.als import ALS
+from rec.models.mc import MC, METHODS
+from rec.models.hseq import HSEQ
+from rec.evaluator.evaluator import Evaluation
+from rec.utils.popularity import PopularityScore
+from rec.utils.vocabulary import Vocabulary
+from rec.utils.synthetic import generate
+
+# Dataset sizes the benchmark runs at, see rec.utils.synthetic.generate
+SCALES = {
+    'small': dict(users=2000, items=500, viewing_rows=100000, session_rows=20000, test_rows=10000),
+    'medium': dict(users=20000, items=3000, viewing_rows=1000000, session_rows=200000, test_rows=100000),
+    'large': dict(users=200000, items=20000, viewing_rows=10000000, session_rows=2000000, test_rows=1000000),
+}
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "baseline.json")
+
+
+class PeakRSS:
+    """Samples the resident memory of the process in a thread and keeps the peak of the enclosed block."""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    @staticmethod
+    def current():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            # No procfs (macOS), fall back to the peak of the whole process (bytes on macOS)
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def measure(results, scale, stage, rows, function):
+    # Runs one stage, records its time, throughput and peak memory and returns what the stage returned
+    with PeakRSS() as memory:
+        start = time.perf_counter()
+        value = function()
+        seconds = time.perf_counter() - start
+    results.append(dict(scale=scale, stage=stage, rows=rows, seconds=seconds, rows_per_second=rows / seconds,
+                        peak_rss_mb=memory.peak / 1024 ** 2))
+    logging.getLogger("benchmark").warning(f"{scale:>6} {stage:<20} {rows:>10} rows {seconds:8.2f}s "
+                                           f"{rows / seconds:12.0f} rows/s {memory.peak / 1024 ** 2:8.0f} MB")
+    return value
+
+
+def run_scale(scale, path, workers=1):
+    """Generates the dataset of a scale into path and benchmarks fitting and evaluating on it."""
+    logger = logging.getLogger("benchmark")
+    sizes = SCALES[scale]
+    paths = generate(path, **sizes)
+    results = []
+
+    def popularity():
+        P = PopularityScore(logger=logger)
+        P.load_data(paths['viewing'], nested=True, type='viewing')
+        P.calculate_popularity_scores(1000)
+        PS = PopularityScore(logger=logger)
+        PS.load_data(paths['sessions'], nested=True, type='sessions')
+        PS.calculate_popularity_scores_sessions()
+        return P, PS
+
+    def als():
+        model = ALS(factors=32, iterations=10, logger=logger, vocabulary=vocabulary)
+        model.load_data(paths['viewing'], nested=True)
+        model.preprocess()
+        model.fit()
+        return model
+
+    def mc():
+        model = MC(method='frequencyScoreNormalizedLog2', logger=logger, vocabulary=vocabulary)
+        model.fit(path=paths['sessions'], nested=True)
+        return model
+
+    def change_method():
+        for method in METHODS:
+            B.change_method(method)
+
+    def evaluate():
+        E.evaluate_reranker(f"benchmark_{scale}", workers=workers)
+
+    P, PS = measure(results, scale, "popularity", sizes['viewing_rows'] + sizes['session_rows'], popularity)
+    vocabulary = Vocabulary()
+    CFR = measure(results, scale, "als.fit", sizes['viewing_rows'], als)
+    B = measure(results, scale, "mc.fit", sizes['session_rows'], mc)
+    measure(results, scale, "mc.change_method", len(METHODS), change_method)
+
+    # The full test set is read, so streaming gives the same rows as the pandas loader
+    E = Evaluation(out_path=os.path.join(path, "evaluations", ""), logger=logger, popularity_scores=P.popularity_scores,
+                   session_popularity_scores=PS.popularity_scores, resume=False, streaming=True)
+    E.setup(CFR, B, HSEQ(B, CFR, logger=logger), path=paths['test'])
+    E.prepare_reranker_evaluations(["hseq", "mc", "als"], ['frequencyScore', 'frequencyScoreNormalizedLog2'],
+                                   [0.5], [20], [1, 5, 10, 20])
+    # Throughput of the evaluation in test rows per case
+    measure(results, scale, "evaluate_reranker", sizes['test_rows'] * len(E.evaluation_cases), evaluate)
+    return results
+
+
+def compare(results, baseline, tolerance, min_seconds=0.1):
+    """
+    Prints every stage next to its baseline, returns the stages that got more than tolerance slower.
+    Stages that took less than min_seconds in the baseline are shown but too noisy to count.
+    """
+    logger = logging.getLogger("benchmark")
+    reference = {(result['scale'], result['stage']): result for result in baseline}
+    regressions = []
+    for result in results:
+        base = reference.get((result['scale'], result['stage']))
+        if base is None:
+            continue
+        speed = result['rows_per_second'] / base['rows_per_second']
+        memory = result['peak_rss_mb'] / base['peak_rss_mb']
+        logger.warning(f"{result['scale']:>6} {result['stage']:<20} {speed:6.2f}x throughput {memory:6.2f}x peak memory")
+        if speed < 1 - tolerance and base['seconds'] >= min_seconds:
+            regressions.append(result)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks fitting and evaluation on synthetic data.")
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=list(SCALES))
+    parser.add_argument('--data', help="Directory for the generated data, a temporary one by default")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help="Overwrite the baseline with this run")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed throughput loss against the baseline")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+
+    results = []
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory(prefix=f"rec-benchmark-{scale}-") as tmp:
+            results += run_scale(scale, os.path.join(args.data, scale) if args.data else tmp, args.workers)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            logging.getLogger("benchmark").error(f"{len(regressions)} stages are slower than the baseline")
+            sys.exit(1)
@@ -0,0 +1,110 @@
+import numpy as np
+from rec.utils.timing import timings
+from rec.types.types import Recommendation
+
+
+class RecommendationCache:
+    """
+    LRU cache of ALS top lists shared by all evaluation cases.
+
+    Lists are computed once at the largest cutoff in the grid (als_n) and smaller cutoffs are served as
+    prefixes. They live in the rows of (slots, als_n) arrays that grow up to as many rows as fit in
+    max_bytes, and a profile code maps to its slot through one array, so a batch splits into hits and
+    misses with array lookups and evicts the least recently used slots at once.
+
+    MC lists are not cached: they are slices of the MC index, which a lookup reads as fast as a cache would.
+    mc_batch and mc keep the interface of the evaluator and HSEQ and always answer for the current method.
+    """
+    def __init__(self, ALS, MC, als_n, max_bytes=1024 ** 3, logger=None):
+        self.ALS = ALS
+        self.MC = MC
+        self.als_n = als_n
+        self.max_bytes = max_bytes
+        self.logger = logger
+        # Item codes and scores of a list plus the slot bookkeeping, the arrays grow up to max_slots rows
+        self.max_slots = int(max_bytes // (als_n * (4 + 4) + 3 * 8)) if als_n > 0 else 0
+        self.items = np.full((0, als_n), -1, dtype=np.int32)
+        self.scores = np.full((0, als_n), -np.inf, dtype=np.float32)
+        self.owner = np.full(0, -1, dtype=np.int64)
+        # Batch number of the last use of every slot, 0 for free ones
+        self.used = np.zeros(0, dtype=np.int64)
+        self.slot = np.full(0, -1, dtype=np.int64)
+        self.batches = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _slots(self, user_ids):
+        # Slot of every profile code, -1 when it is not cached
+        if len(user_ids) and user_ids.max() >= len(self.slot):
+            self.slot = np.concatenate([self.slot, np.full(max(int(user_ids.max()) + 1, 2 * len(self.slot)) - len(self.slot), -1, dtype=np.int64)])
+        return np.where(user_ids >= 0, self.slot[np.maximum(user_ids, 0)], -1)
+
+    def _grow(self, slots):
+        # Doubles the capacity (at least to slots rows), up to max_slots
+        size = min(max(slots, 2 * len(self.owner)), self.max_slots)
+        extra = size - len(self.owner)
+        self.items = np.concatenate([self.items, np.full((extra, self.als_n), -1, dtype=np.int32)])
+        self.scores = np.concatenate([self.scores, np.full((extra, self.als_n), -np.inf, dtype=np.float32)])
+        self.owner = np.concatenate([self.owner, np.full(extra, -1, dtype=np.int64)])
+        self.used = np.concatenate([self.used, np.zeros(extra, dtype=np.int64)])
+
+    def _put(self, user_ids, items, scores):
+        # Stores the lists of distinct uncached profile codes in free or least recently used slots,
+        # slots used by the current batch are kept; what does not fit is not cached
+        free = np.count_nonzero(self.owner < 0)
+        if free < len(user_ids) and len(self.owner) < self.max_slots:
+            self._grow(len(self.owner) + len(user_ids) - free)
+        candidates = np.flatnonzero(self.used < self.batches)
+        user_ids, items, scores = user_ids[:len(candidates)], items[:len(candidates)], scores[:len(candidates)]
+        if len(user_ids) == 0:
+            return
+        if len(user_ids) < len(candidates):
+            candidates = candidates[np.argpartition(self.used[candidates], len(user_ids) - 1)[:len(user_ids)]]
+        evicted = self.owner[candidates]
+        self.evictions += int(np.count_nonzero(evicted >= 0))
+        self.slot[evicted[evicted >= 0]] = -1
+        self.owner[candidates] = user_ids
+        self.slot[user_ids] = candidates
+        self.used[candidates] = self.batches
+        self.items[candidates], self.scores[candidates] = items, scores
+
+    @timings.timed("cache.als", batch=True)
+    def als(self, user_ids, N=5):
+        """Same contract as ALS.recommend_batch on profile codes, served from cache where possible."""
+        # Row reads of a materialized candidate table are cheaper than the cache itself
+        if N > self.als_n or self.ALS.has_candidates(N) or self.max_slots == 0:
+            return self.ALS.recommend_batch(user_ids, N=N, encoded=True)
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.batches += 1
+        slots = self._slots(user_ids)
+        hit = slots >= 0
+        self.used[slots[hit]] = self.batches
+        items = np.full((len(user_ids), N), -1, dtype=np.int32)
+        scores = np.full((len(user_ids), N), -np.inf, dtype=np.float32)
+        items[hit], scores[hit] = self.items[slots[hit], :N], self.scores[slots[hit], :N]
+        self.hits += int(np.count_nonzero(hit))
+        self.misses += len(user_ids) - int(np.count_nonzero(hit))
+        if not hit.all():
+            missing, rows = np.unique(user_ids[~hit], return_inverse=True)
+            new_items, new_scores = self.ALS.recommend_batch(missing, N=self.als_n, encoded=True)
+            items[~hit], scores[~hit] = new_items[rows, :N], new_scores[rows, :N]
+            known = missing >= 0
+            self._put(missing[known], new_items[known], new_scores[known])
+        return items, scores
+
+    @timings.timed("cache.mc_batch", batch=True)
+    def mc_batch(self, item_ids, N=5):
+        """Same contract as MC.recommend_batch on item codes (or contexts) for the current MC method."""
+        return self.MC.recommend_batch(item_ids, N=N, encoded=True)
+
+    def mc(self, item_id, N=-1) -> Recommendation:
+        """Same contract as MC.recommend_standard for the current MC method."""
+        return self.MC.recommend_standard(item_id, N=N)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        entries = int(np.count_nonzero(self.owner >= 0))
+        return {"entries": entries, "slots": len(self.owner), "bytes": self.items.nbytes + self.scores.nbytes + 3 * self.owner.nbytes,
+                "evictions": self.evictions, "als_hits": self.hits, "als_misses": self.misses,
+                "als_hit_rate": self.hits / lookups if lookups else 0}
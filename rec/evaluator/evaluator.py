@@ -5,52 +5,145 @@ import pandas as pd
 import numpy as np
 import logging
 import os
+import time
+import json
+import hashlib
 from tqdm import tqdm
 from typing import List
-from collections import Counter
 from rec.models.hseq import HSEQ
+from rec.evaluator.cache import RecommendationCache
+from rec.evaluator.parallel import evaluate_parallel
+from rec.evaluator.loader import read_columns
+from rec.evaluator.metrics import compute_metrics, gini
+from rec.evaluator.store import ResultStore
+from rec.utils.timing import timings, profiled
+from rec.utils.vocabulary import canonical_ids
 from rec.types.types import EvaluationCase, RecommendedItem, Recommendation
 
 class Evaluation:
-    def __init__(self, sample=False, sample_size=10000, out_path='./data/evaluations', logger=None, popularity_scores=None, session_popularity_scores=None, slack=None):
+    def __init__(self, sample=False, sample_size=10000, out_path='./data/evaluations', logger=None, popularity_scores=None, session_popularity_scores=None, slack=None, cache_bytes=1024 ** 3, streaming=False, single_pass=True, dedup=True, results_path=None, resume=True, timings=False, profile=False):
         self.sample = sample
         self.slack = slack
         self.sample_size = sample_size
         self.logger = logger
         self.logger.name = "evaluator"
         self.out_path = out_path
+        # Stream and reservoir-sample the test set. Off by default: the reservoir draws a different sample
+        # than the pandas one the published results used, so only the full test set is the same either way
+        self.streaming = streaming
+        # Cases that only differ in N share one pass at the largest N, smaller N are prefixes of its lists
+        self.single_pass = single_pass
+        # Recommend once per distinct query (profile for ALS, item for MC, both for HSEQ) instead of per row
+        self.dedup = dedup
+        # SQLite store every finished case is committed to, with resume cases it already holds are skipped
+        self.results_path = results_path if results_path is not None else f"{out_path}results.sqlite"
+        self.resume = resume
+        self.store = None
+        self.seed = 42123
+        # Per-stage timings of every case go to {out_path}{experiment_id}.timings.jsonl, profile runs
+        # the evaluation under cProfile and writes {out_path}{experiment_id}.prof
+        self.timings = timings
+        self.profile = profile
         self.profile_id_key = 'profile_id'
         self.item_id_key = 'item_id'
         self.next_item_id_key = 'next_item_id'
         self.measure_date_key = 'measure_date'
+        # Columns holding the vocabulary codes of the IDs above
+        self.profile_code_key = 'profile_code'
+        self.item_code_key = 'item_code'
+        self.next_item_code_key = 'next_item_code'
         self.data = {}
+        # Dicts of PopularityScore, or the array form indexed by item code: (duration, count) from
+        # DailyPopularity.scores and an array from session_popularity
         self.popularity_scores = popularity_scores
         self.session_popularity_scores = session_popularity_scores
         self.ALS = None
         self.MC = None
         self.HSEQ = None
+        self.vocabulary = None
+        self.popularity = None
+        # Memory cap of the recommendation cache shared across evaluation cases
+        self.cache_bytes = cache_bytes
+        self.cache = None
+        self._fingerprint = None
 
         self.missing_recommendations = 0
+        # Number of test rows that are scored together in one batch
+        self.batch_size = 10000
 
     def load_data(self, path):
-        df = pd.read_csv(path)
-        df.dropna(inplace=True)
-        # We have to do some major changes to ensure that there is no floatingpoint .0s
-        df['item_id'] = df[self.item_id_key].astype(int)
-        df['next_item_id'] = df[self.next_item_id_key].astype(int)
-        df['next_item_id'] = df['next_item_id'].astype(str)
-        if self.sample:
-            df = df.sample(n=self.sample_size, random_state=42123)
-        # Convert the sampled DataFrame to a list of dictionaries
-        self.data = df.to_dict(orient='records')
+        # The test set is kept as columns of vocabulary codes
+        converters = {
+            self.profile_id_key: self._profile_codes,
+            self.item_id_key: self.vocabulary.items.encode,
+            self.next_item_id_key: self.vocabulary.items.encode,
+        }
+        if self.streaming:
+            columns = read_columns(path, list(converters), self.sample_size if self.sample else None,
+                                   seed=self.seed, converters=converters)
+        else:
+            df = pd.read_csv(path)
+            df.dropna(inplace=True)
+            # We have to do some major changes to ensure that there is no floatingpoint .0s
+            df['item_id'] = df[self.item_id_key].astype(int)
+            df['next_item_id'] = df[self.next_item_id_key].astype(int)
+            df['next_item_id'] = df['next_item_id'].astype(str)
+            if self.sample:
+                df = df.sample(n=self.sample_size, random_state=self.seed)
+            columns = {key: encode(df[key]) for key, encode in converters.items()}
+        self._fingerprint = None
+        self.data = {
+            self.profile_code_key: columns[self.profile_id_key],
+            self.item_code_key: columns[self.item_id_key],
+            self.next_item_code_key: columns[self.next_item_id_key],
+        }
+
+    def _profile_codes(self, ids):
+        # Profiles the models don't know still get their own code, MAP is averaged per profile. Their codes
+        # follow the vocabulary instead of being added to it, the models treat them as unknown either way
+        codes = self.vocabulary.profiles.encode(ids)
+        unknown = codes < 0
+        if unknown.any():
+            local, _ = pd.factorize(canonical_ids(np.asarray(ids)[unknown]), sort=True)
+            codes[unknown] = len(self.vocabulary.profiles) + local
+        return codes
 
     def setup(self, ALS, MC, HSEQ, path):
-        # We always load the data first
-        self.load_data(path)
         # We dont evaluate the ALS model here, only bridges, so we dont need to fit the model
         self.ALS = ALS
         self.MC = MC
         self.HSEQ = HSEQ
+        self.vocabulary = ALS.vocabulary
+        self.load_data(path)
+
+    def _popularity_arrays(self):
+        # Duration, count and session popularity as dense arrays indexed by item code, NaN where an item has no score
+        if self.popularity is not None and len(self.popularity[0]) == len(self.vocabulary.items):
+            return self.popularity
+        duration, count, session = (np.full(len(self.vocabulary.items), np.nan) for _ in range(3))
+        if isinstance(self.popularity_scores, dict):
+            codes = self.vocabulary.items.encode(list(self.popularity_scores))
+            scores = list(self.popularity_scores.values())
+            known = np.flatnonzero(codes >= 0)
+            duration[codes[known]] = [scores[i]['duration_score'] for i in known]
+            count[codes[known]] = [scores[i]['count_score'] for i in known]
+        else:
+            for target, scores in zip((duration, count), self.popularity_scores):
+                target[:len(scores)] = scores[:len(target)]
+        if isinstance(self.session_popularity_scores, dict):
+            codes = self.vocabulary.items.encode(list(self.session_popularity_scores))
+            scores = np.array(list(self.session_popularity_scores.values()), dtype=np.float64)
+            session[codes[codes >= 0]] = scores[codes >= 0]
+        else:
+            session[:len(self.session_popularity_scores)] = self.session_popularity_scores[:len(session)]
+        self.popularity = (duration, count, session)
+        return self.popularity
+
+    def _popular_items(self):
+        # Coverage is relative to the number of items with a viewing popularity score
+        if isinstance(self.popularity_scores, dict):
+            return len(self.popularity_scores)
+        return int(np.count_nonzero(~np.isnan(self.popularity_scores[1])))
 
     def prepare_reranker_evaluations(self,models:List[str], methods: List[str], w1s: List[float], Ks: List[int], Ns: List[int]):
         # We take the cartesian product of the methods, w1s, Ks and Ns to get all possible combinations
@@ -64,8 +157,15 @@ class Evaluation:
                             self.evaluation_cases.append(EvaluationCase(model, method, w1, 1-w1, K, N))
 
         self._check_cases()
+        self._setup_cache()
         self.logger.debug(f"Number of evaluation cases: {len(self.evaluation_cases)}")
 
+    def _setup_cache(self):
+        # Lists are computed once at the largest cutoff any case asks for, smaller cutoffs are prefixes
+        als_n = max([case.N for case in self.evaluation_cases if case.model == "als"] +
+                    [case.K for case in self.evaluation_cases if case.model == "hseq"], default=0)
+        self.cache = RecommendationCache(self.ALS, self.MC, als_n, max_bytes=self.cache_bytes, logger=self.logger)
+
     def _check_cases(self):
         # We pruen the cases that are not needed
         for case in self.evaluation_cases:
@@ -84,6 +184,7 @@ class Evaluation:
         for method in methods:
             for N in Ns:
                 self.evaluation_cases.append(EvaluationCase("mc", method, 0, 0, 0, N))
+        self._setup_cache()
 
     def _store_recs(self, model, method, w1, w2, K, N, map, accuracy, avgctr, \
                     missing_bridge_count, missing_cf_count, not_enough_bridge_count,\
@@ -100,179 +201,222 @@ class Evaluation:
     def click_through_rate(self, actual_clicks, recommendations: List[RecommendedItem]):
         return len(set(actual_clicks) & set(recommendations) / len(set(actual_clicks)))
 
-    def evaluate_reranker(self, experiment_id):
+    def fingerprint(self):
+        """Hash of the evaluated test rows, results are only reused for the same data."""
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            for key in sorted(self.data):
+                digest.update(key.encode())
+                digest.update(np.ascontiguousarray(self.data[key]).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def metadata(self):
+        # Settings of a run, recorded next to its results
+        metadata = dict(sample=self.sample, sample_size=self.sample_size, seed=self.seed, streaming=self.streaming,
+                        single_pass=self.single_pass, dedup=self.dedup, rows=len(self.data[self.next_item_code_key]))
+        if self.ALS is not None:
+            metadata['als'] = dict(factors=self.ALS.model.factors, iterations=self.ALS.model.iterations,
+                                   regularization=self.ALS.model.regularization)
+        if self.MC is not None:
+            # MC or VariableOrderMC, each with its own parameters
+            metadata['mc'] = {name: getattr(self.MC, name) for name in ('minScore', 'maxScore', 'bridgeThresholds', 'max_order',
+                                                                       'min_count', 'min_support', 'max_next', 'alpha')
+                              if hasattr(self.MC, name)}
+        return metadata
+
+    def evaluate_reranker(self, experiment_id, workers=1):
         self.logger.debug("Starting evaluation...")
+        self.store = ResultStore(self.results_path)
+        try:
+            done = self.store.done(experiment_id, self.fingerprint()) if self.resume else set()
+            cases = [case for case in self.evaluation_cases if ResultStore.case_key(case) not in done]
+            if len(cases) < len(self.evaluation_cases):
+                self.logger.info(f"Skipping {len(self.evaluation_cases) - len(cases)} cases with results in {self.results_path}")
+            run_id = self.store.start_run(experiment_id, self.fingerprint(), self.metadata(), len(self.evaluation_cases),
+                                          len(self.evaluation_cases) - len(cases))
+            if self.profile:
+                # py-spy can attach to this pid (and to the worker processes) instead, e.g. py-spy record --pid
+                self.logger.info(f"Profiling evaluation process {os.getpid()}")
+            timings.enabled = self.timings
+            with profiled(f"{self.out_path}{experiment_id}.prof" if self.profile else None):
+                self._evaluate_groups(self.case_groups(cases), experiment_id, workers)
+            self.store.finish_run(run_id)
+        finally:
+            timings.enabled = False
+            self.store.close()
+            self.store = None
+
+    def _evaluate_groups(self, groups, experiment_id, workers):
+        if workers > 1:
+            # Cases are farmed out to worker processes that attach to memory-mapped copies of the models
+            evaluate_parallel(self, experiment_id, workers, groups=groups)
+            return
+        self.HSEQ.cache = self.cache
         # MC can be different based on the method, so we need to fit the model for each method
-        for case in self.evaluation_cases:
-            if case.model != "als" and case.method != self.MC.method:
+        for model, method, w1, w2, K, Ns in groups:
+            if model != "als" and method != self.MC.method:
                 self.logger.debug("Changing method...")
-                self.MC.change_method(case.method)
+                self.MC.change_method(method)
                 # Refit reranker with new method.
-                self.HSEQ = HSEQ(self.MC, self.ALS, logger=self.logger)
-            self.logger.debug(f"Model: {case.model}, Method: {case.method}, w1: {case.w1}, w2: {case.w2}, K: {case.K}, N: {case.N}")
-            self._evaluate_reranker(case.method, case.w1, case.w2, case.K, case.N, experiment_id, case.model)
+                self.HSEQ = HSEQ(self.MC, self.ALS, logger=self.logger, cache=self.cache)
+            self.logger.debug(f"Model: {model}, Method: {method}, w1: {w1}, w2: {w2}, K: {K}, N: {Ns}")
+            for result in self._evaluate_cutoffs(method, w1, w2, K, Ns, experiment_id, model):
+                self._report(result, experiment_id)
+            self.logger.debug(f"Cache: {self.cache.stats()}")
+        self.logger.info(f"Cache: {self.cache.stats()}")
+
+    def case_groups(self, cases=None):
+        """
+        The evaluation cases (all of them unless cases is given) as (model, method, w1, w2, K, Ns) groups
+        that are evaluated in one pass, Ns holding the N of every case in the group. Without single_pass
+        every case is its own group.
+        """
+        groups = {}
+        for case in self.evaluation_cases if cases is None else cases:
+            key = (case.model, case.method, case.w1, case.w2, case.K)
+            if not self.single_pass:
+                key += (case.N,)
+            groups.setdefault(key, []).append(case.N)
+        return [key[:5] + (sorted(Ns),) for key, Ns in groups.items()]
 
     def gini(self, array, min_lenght=None):
         """Calculate the Gini coefficient of a numpy array."""
-        # All values are treated equally, arrays must be 1d:
-        if min_lenght:
-            pad_size = max(min_lenght - len(array), 0)
-            array = np.pad(array, (0, pad_size), 'constant', constant_values=(0))
-
-        array = array.flatten()
-        if np.amin(array) < 0:
-            # Values cannot be negative:
-            array -= np.amin(array)
-        # Values cannot be 0:
-        # np.add(array, 0.0000001, out=array, casting="unsafe")
-        # Values must be sorted:
-        array = np.sort(array)
-        # Index per array element:
-        index = np.arange(1, array.shape[0] + 1)
-        # Number of array elements:
-        n = array.shape[0]
-        # Gini coefficient:
-        return ((np.sum((2 * index - n - 1) * array)) / (n * np.sum(array)))
-
+        return gini(array, min_lenght)
+
+    def _recommend_batch(self, chunk, model, w1, w2, K, Ns, weights=None):
+        # Scores a chunk of test rows at once, returns the (rows, N) recommended item codes padded with -1 per N
+        if model == "hseq":
+            return self.HSEQ.recommend_prefixes(chunk[self.profile_code_key], chunk[self.item_code_key],
+                                                Ns, w1=w1, w2=w2, K=K, encoded=True, weights=weights)
+        elif model == "als":
+            codes, _ = self.cache.als(chunk[self.profile_code_key], N=max(Ns))
+        elif model == "mc":
+            codes, _ = self.cache.mc_batch(chunk[self.item_code_key], N=max(Ns))
+        else:
+            self.logger.error("Model not found.")
+            return None
+        # ALS and MC lists are sorted by score, so shorter lists are prefixes
+        return {N: codes[:, :N] for N in Ns}
 
     def _evaluate_reranker(self, method, w1, w2, K, N, experiment_id, model):
-        ctrs = []
-        mrrs = []
-        itemIds = []
+        return self._evaluate_cutoffs(method, w1, w2, K, [N], experiment_id, model)[0]
+
+    def _group_rows(self, columns):
+        # Group number of every row by the values of the given columns (in order of first appearance),
+        # the first row of every group and the number of rows in it
+        groups = pd.DataFrame(columns).groupby(list(columns), sort=False).ngroup().to_numpy()
+        first = np.zeros(groups.max(initial=-1) + 1, dtype=np.int64)
+        first[groups[::-1]] = np.arange(len(groups) - 1, -1, -1)
+        return groups, first, np.bincount(groups, minlength=len(first))
+
+    def _queries(self, model):
+        """
+        The distinct test rows and the distinct queries among them.
+
+        Returns:
+        - rows (Dict[str, np.ndarray]): The code columns of the distinct (profile, item, next item) rows.
+        - row_weights (np.ndarray): How often every distinct row occurs in the test set.
+        - queries (Dict[str, np.ndarray]): The code columns of the distinct queries of the model.
+        - query_weights (np.ndarray): The number of test rows of every query.
+        - inverse (np.ndarray): The query of every distinct row.
+        """
+        _, first, row_weights = self._group_rows(self.data)
+        rows = {key: column[first] for key, column in self.data.items()}
+        keys = {"als": [self.profile_code_key], "mc": [self.item_code_key]}.get(model, [self.profile_code_key, self.item_code_key])
+        inverse, first, _ = self._group_rows({key: rows[key] for key in keys})
+        queries = {key: column[first] for key, column in rows.items()}
+        return rows, row_weights, queries, np.bincount(inverse, weights=row_weights, minlength=len(first)).astype(np.int64), inverse
+
+    def _evaluate_cutoffs(self, method, w1, w2, K, Ns, experiment_id, model):
+        # Evaluates the cases of one group in a single pass over the test set, returns a result per N
+        started = time.perf_counter()
+        timings.reset()
         # Reset metrics:
-        self.missing_recommendations = 0
         self.HSEQ.missing_bridge_count = 0
         self.HSEQ.missing_cf_count = 0
         self.HSEQ.not_enough_bridge_count = 0
         self.HSEQ.not_enough_cf_count = 0
-        # Train a new instance of our model
-        i = 0
-        recommendations = {}
-        with tqdm(total=len(self.data), desc='Processing recommendations') as pbar:
-            for i, case in enumerate(self.data):
-                # get recs from the reranker
-                if model == "hseq":
-                    recs = self.HSEQ.recommend(case[self.profile_id_key], str(case[self.item_id_key]), N=N, w1=w1, w2=w2, K=K)
-                elif model == "als":
-                    recs = self.ALS.recommend_standard(case[self.profile_id_key], N=N)
-                elif model == "mc":
-                    recs = self.MC.recommend_standard(case[self.item_id_key], N=N)
-                else:
-                    self.logger.error("Model not found.")
-                    continue
-                if recs is None:
-                    self.missing_recommendations += 1
-                    continue
-
-                # transform recommended items to string
-                try:
-                    recommended_items = [str(rec.item_id) for rec in recs.items]
-                except Exception as e:
-                    self.logger.error(e)
-                    continue
-
-                ctr_score = 1 if str(int(case[self.next_item_id_key])) in recommended_items else 0
-                ctrs.append(ctr_score)
-
-                # Calculate MRR score
-                try:
-                    rank = recommended_items.index(str(int(case[self.next_item_id_key]))) + 1
-                    mrr_score = 1 / rank
-                except ValueError:
-                    mrr_score = 0
-                mrrs.append(mrr_score)
-
-                # Add the actual and recommended items to the recommendations dictionary
-                p = recommendations.get(case[self.profile_id_key], None)
-                if not p:
-                    recommendations[case[self.profile_id_key]] = {'actual': [], 'recommended': []}
-                recommendations[case[self.profile_id_key]]['actual'].append(case[self.next_item_id_key])
-                recommendations[case[self.profile_id_key]]['recommended'].extend(recommended_items)
-
-                # Add items to the user agnostic pool of recommended items for Gini index
-                itemIds.extend(recommended_items)
-
-                # Update the progress bar every 10,000 iterations
-                if (i + 1) % 10000 == 0:
-                    pbar.update(10000)
-
-        # Calculate precision for each user
-        recommended_for_popularity = []
-        precision_scores = {}
-        for user_id, user_data in recommendations.items():
-            actual_next_items = set(user_data['actual'])
-            recommended_items = set(user_data['recommended'])
-
-            # Calculate the number of correct recommendations
-            correct_recommendations = len(actual_next_items.intersection(recommended_items))
-            recommended_for_popularity.extend(recommended_items)
-            # Calculate precision for this user
-            precision = correct_recommendations / len(recommended_items) if recommended_items else 0
-
-            precision_scores[user_id] = precision
-
-        # Calculate Mean Average Precision (MAP)
-        mean_avg_precision = sum(precision_scores.values()) / len(precision_scores) if precision_scores else 0
-
-        # Calculate average popularity score, general average popularity score and general duration popularity score
-        avg_popularity_score = None
-        avg_count_popularity_score = None
-        avg_session_popularity_score = None
+        if self.dedup:
+            with timings.stage("evaluator.dedup"):
+                rows, row_weights, queries, query_weights, inverse = self._queries(model)
+        else:
+            rows, row_weights, queries, query_weights, inverse = self.data, None, self.data, None, None
+        recs = {N: [] for N in Ns}
+        total = len(queries[self.next_item_code_key])
+        with tqdm(total=total, desc='Processing recommendations') as pbar:
+            for start in range(0, total, self.batch_size):
+                chunk = {key: column[start:start + self.batch_size] for key, column in queries.items()}
+                weights = query_weights[start:start + self.batch_size] if query_weights is not None else None
+                with timings.stage("evaluator.recommend", len(chunk[self.next_item_code_key])):
+                    batch = self._recommend_batch(chunk, model, w1, w2, K, Ns, weights)
+                pbar.update(len(chunk[self.next_item_code_key]))
+                if batch is None:
+                    # Unknown model, nothing is evaluated
+                    rows = {key: column[:0] for key, column in rows.items()}
+                    row_weights = row_weights[:0] if row_weights is not None else None
+                    break
+                for N in Ns:
+                    recs[N].append(batch[N])
+
+        targets, profiles = rows[self.next_item_code_key], rows[self.profile_code_key]
+        popularity = None
         if self.popularity_scores is not None and self.session_popularity_scores is not None:
-            # get all popularity scores for the recommended items
-            duration_popularity = []
-            count_popularity = []
-            session_count_popularity = []
-
-            for item in recommended_for_popularity:
-                session_popularity_score = self.session_popularity_scores.get(item, None)
-                viewing_popularity_scores = self.popularity_scores.get(item, None)
-                # For GAPS and GDPS
-                if viewing_popularity_scores:
-                    duration_popularity.append(viewing_popularity_scores['duration_score'])
-                    count_popularity.append(viewing_popularity_scores['count_score'])
-                # For APS
-                if session_popularity_score:
-                    session_count_popularity.append(session_popularity_score)
-            # calculate the average popularity score
-            avg_popularity_score = sum(duration_popularity) / len(duration_popularity) if duration_popularity else 0
-            avg_count_popularity_score = sum(count_popularity) / len(count_popularity) if count_popularity else 0
-            avg_session_popularity_score = sum(session_count_popularity) / len(session_count_popularity) if session_count_popularity else 0
-
-        avg_ctr = sum(ctrs) / len(ctrs) if ctrs else 0
-        average_mrr = sum(mrrs) / len(mrrs) if mrrs else 0
-
-
-        # Calculate Gini Index
-        popularity_counter = Counter(itemIds)
-        popularity_scores = np.array(list(popularity_counter.values()))
-        # the minimum length of the array is set to 1040, which is the number of items recommended by the ALS in a preivous experiment
-        gini_index = self.gini(popularity_scores, 1040)
-
-        # Coverage:
-        # Calculate the number of unique items recommended
-        unique_items = len(set(recommended_for_popularity))
-        items_count = len(self.popularity_scores)
-        coverage = unique_items / items_count if unique_items else 0
-
-        self._store_recs(model, method, w1, w2, K, N, mean_avg_precision, average_mrr, avg_ctr, self.HSEQ.missing_bridge_count, self.HSEQ.missing_cf_count, self.HSEQ.not_enough_bridge_count, \
-                         self.HSEQ.not_enough_cf_count, experiment_id, avg_popularity_score, avg_count_popularity_score, avg_session_popularity_score, coverage, gini_index)
-        self.logger.info(f"Missing recommendations: {self.missing_recommendations}")
-        self.logger.info(f"Average CTR: {avg_ctr}")
-        self.logger.info(f"Average MRR: {average_mrr}")
-        self.logger.info(f"Mean Average Precision: {mean_avg_precision}")
-        self.logger.info(f"Average Duration Popularity Score: {avg_popularity_score}")
-        self.logger.info(f"Average Count Popularity Score: {avg_count_popularity_score}")
-        self.logger.info(f"Coverage: {coverage}")
-        self.logger.info(f"Gini Index: {gini_index}")
-        self.logger.info(f"Rerank info: missing_bridges:{self.HSEQ.missing_bridge_count}, missing_cf:{self.HSEQ.missing_cf_count}, missing_enough_bridges:{self.HSEQ.not_enough_bridge_count}, missing_enough_cf:{self.HSEQ.not_enough_cf_count}")
+            popularity = self._popularity_arrays()
+        # Stages of the shared pass, every case adds the timings of its own metrics
+        stages = timings.summary()
+        results = []
+        for N in Ns:
+            timings.reset("metrics.")
+            codes = np.concatenate(recs[N]) if recs[N] and len(targets) else np.full((0, N), -1, dtype=np.int32)
+            if inverse is not None and len(codes):
+                # Every distinct row gets the recommendations of its query
+                codes = codes[inverse]
+            # the minimum length of the Gini array is set to 1040, which is the number of items recommended by the ALS in a preivous experiment
+            metrics = compute_metrics(codes, targets, profiles, popularity, self._popular_items(), gini_length=1040,
+                                      weights=row_weights)
+            self.missing_recommendations = metrics['missing_recommendations']
+            results.append(dict(model=model, method=method, w1=w1, w2=w2, K=K, N=N,
+                                missing_bridge_count=self.HSEQ.missing_bridge_count, missing_cf_count=self.HSEQ.missing_cf_count,
+                                not_enough_bridge_count=self.HSEQ.not_enough_bridge_count, not_enough_cf_count=self.HSEQ.not_enough_cf_count,
+                                **metrics, rows=len(self.data[self.next_item_code_key]), queries=total,
+                                timings=dict(stages, **timings.summary("metrics.")) if timings.enabled else None))
+        # All cutoffs of the group share the time of the pass
+        for result in results:
+            result['seconds'] = time.perf_counter() - started
+        return results
+
+    def _report(self, result, experiment_id):
+        # Stores one result row of _evaluate_reranker and logs it
+        if self.store is not None:
+            # Committed before the CSV line, a case only counts as done once it is in the store
+            self.store.put(experiment_id, self.fingerprint(), result)
+        result = dict(result)
+        missing_recommendations = result.pop('missing_recommendations')
+        rows, queries, seconds = result.pop('rows'), result.pop('queries'), result.pop('seconds')
+        stages = result.pop('timings', None)
+        if stages is not None:
+            with open(f"{self.out_path}{experiment_id}.timings.jsonl", "a") as f:
+                case = {key: result[key] for key in ('model', 'method', 'w1', 'w2', 'K', 'N')}
+                f.write(json.dumps(dict(case, seconds=seconds, rows=rows, queries=queries, stages=stages)) + "\n")
+        self._store_recs(experiement_id=experiment_id, **result)
+        self.logger.info(f"Missing recommendations: {missing_recommendations}")
+        self.logger.info(f"Queries: {queries} for {rows} test rows, dedup ratio {rows / queries if queries else 1:.2f}, {seconds:.1f}s")
+        self.logger.info(f"Average CTR: {result['avgctr']}")
+        self.logger.info(f"Average MRR: {result['accuracy']}")
+        self.logger.info(f"Mean Average Precision: {result['map']}")
+        self.logger.info(f"Average Duration Popularity Score: {result['avg_popularity_score']}")
+        self.logger.info(f"Average Count Popularity Score: {result['avg_count_popularity_score']}")
+        self.logger.info(f"Coverage: {result['coverage']}")
+        self.logger.info(f"Gini Index: {result['gini_index']}")
+        self.logger.info(f"Rerank info: missing_bridges:{result['missing_bridge_count']}, missing_cf:{result['missing_cf_count']}, missing_enough_bridges:{result['not_enough_bridge_count']}, missing_enough_cf:{result['not_enough_cf_count']}")
         if self.slack:
             self.slack.send_results(
-            f"{model},{method},{w1},{w2},{K},{N}",
-            avg_ctr=avg_ctr,
-            mean_avg_precision=mean_avg_precision,
-            avg_popularity_score=avg_popularity_score,
-            avg_count_popularity_score=avg_count_popularity_score,
-            coverage=coverage,
-            gini_index=gini_index
+            f"{result['model']},{result['method']},{result['w1']},{result['w2']},{result['K']},{result['N']}",
+            avg_ctr=result['avgctr'],
+            mean_avg_precision=result['map'],
+            avg_popularity_score=result['avg_popularity_score'],
+            avg_count_popularity_score=result['avg_count_popularity_score'],
+            coverage=result['coverage'],
+            gini_index=result['gini_index']
         )
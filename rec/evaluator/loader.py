@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+
+def iter_chunks(path, columns, chunk_size=1000000):
+    """
+    Streams the given columns of a CSV file or Parquet file/directory as dicts of numpy arrays.
+    Rows with a missing value in any of the columns are dropped.
+    """
+    if path.endswith(".csv"):
+        for df in pd.read_csv(path, usecols=columns, chunksize=chunk_size):
+            df = df.dropna()
+            yield {column: df[column].to_numpy() for column in columns}
+    else:
+        for batch in ds.dataset(path, format="parquet").to_batches(columns=columns, batch_size=chunk_size):
+            df = batch.to_pandas().dropna()
+            yield {column: df[column].to_numpy() for column in columns}
+
+
+class Reservoir:
+    """
+    Seeded uniform sample of at most size rows from a stream of column chunks.
+
+    Every row draws a random key and the rows with the smallest keys are kept, so memory is bounded
+    by the sample plus one chunk. The sample keeps the order of the rows in the stream.
+    """
+    def __init__(self, size, seed=42123):
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+        self.keys = np.empty(0)
+        self.positions = np.empty(0, dtype=np.int64)
+        self.columns = None
+        self.seen = 0
+
+    def add(self, chunk):
+        n = len(next(iter(chunk.values())))
+        keys = np.concatenate([self.keys, self.rng.random(n)])
+        positions = np.concatenate([self.positions, np.arange(self.seen, self.seen + n)])
+        columns = chunk if self.columns is None else \
+            {column: np.concatenate([self.columns[column], values]) for column, values in chunk.items()}
+        self.seen += n
+        keep = np.argpartition(keys, self.size - 1)[:self.size] if len(keys) > self.size else slice(None)
+        self.keys, self.positions = keys[keep], positions[keep]
+        self.columns = {column: values[keep] for column, values in columns.items()}
+
+    def sample(self):
+        order = np.argsort(self.positions, kind='stable')
+        return {column: values[order] for column, values in (self.columns or {}).items()}
+
+
+def read_columns(path, columns, sample_size=None, seed=42123, converters=None, chunk_size=1000000):
+    """
+    Reads the given columns of a test set without materializing the whole file.
+
+    Parameters:
+    - path (str): A CSV file or a Parquet file/directory.
+    - columns (List[str]): The columns to read, all others are skipped by the reader.
+    - sample_size (int): Size of the seeded uniform sample, None to keep every row.
+    - seed (int): Seed of the sampler.
+    - converters (Dict[str, Callable]): Per column functions applied once to the rows that are kept, after
+      sampling, e.g. vocabulary encoders that turn raw IDs into int codes.
+    - chunk_size (int): The number of rows read at once.
+
+    Returns:
+    - columns (Dict[str, np.ndarray]): One array per column.
+    """
+    converters = converters or {}
+    reservoir = Reservoir(sample_size, seed) if sample_size is not None else None
+    chunks = []
+    for chunk in iter_chunks(path, columns, chunk_size):
+        if reservoir is not None:
+            reservoir.add(chunk)
+        else:
+            chunks.append(chunk)
+    if reservoir is not None:
+        chunks = [reservoir.sample()] if reservoir.columns is not None else []
+    if not chunks:
+        return {column: np.empty(0, dtype=np.int32) for column in columns}
+    # Only the kept raw values are converted, so encoders never see rows the sample dropped
+    columns = {column: np.concatenate([chunk[column] for chunk in chunks]) for column in columns}
+    return {column: converters[column](values) if column in converters else values for column, values in columns.items()}
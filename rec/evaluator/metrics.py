@@ -0,0 +1,144 @@
+import numpy as np
+from rec.utils.timing import timings
+
+
+def gini(array, min_lenght=None):
+    """Calculate the Gini coefficient of a numpy array."""
+    # All values are treated equally, arrays must be 1d:
+    if min_lenght:
+        pad_size = max(min_lenght - len(array), 0)
+        array = np.pad(array, (0, pad_size), 'constant', constant_values=(0))
+
+    array = array.flatten()
+    if np.amin(array) < 0:
+        # Values cannot be negative:
+        array -= np.amin(array)
+    # Values must be sorted:
+    array = np.sort(array)
+    # Index per array element:
+    index = np.arange(1, array.shape[0] + 1)
+    # Number of array elements:
+    n = array.shape[0]
+    # Gini coefficient:
+    return ((np.sum((2 * index - n - 1) * array)) / (n * np.sum(array)))
+
+
+def hit_ranks(recs, targets):
+    """1-based position of the target in every row of recs, 0 where it wasn't recommended."""
+    hits = (recs == targets[:, None]) & (recs >= 0)
+    return np.where(hits.any(axis=1), hits.argmax(axis=1) + 1, 0)
+
+
+def _pair_keys(users, items, n_items):
+    # (user, item) pairs as single int64 keys, so sets of pairs are sorted unique arrays
+    return users.astype(np.int64) * n_items + items
+
+
+def _unique(keys):
+    # Sorted distinct keys; a plain sort is faster here than np.unique, which hashes first
+    keys = np.sort(keys)
+    return keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(keys) else keys
+
+
+def overlap(recs, reference):
+    """Mean share of the items of every reference row that the same row of recs contains as well, e.g. recall@N."""
+    recs, reference = np.asarray(recs), np.asarray(reference)
+    rows = np.arange(len(reference))
+    n_items = max(int(max(recs.max(initial=-1), reference.max(initial=-1))) + 1, 1)
+    keys = _unique(_pair_keys(np.repeat(rows, reference.shape[1]), reference.ravel(), n_items)[reference.ravel() >= 0])
+    found = _pair_keys(np.repeat(rows, recs.shape[1]), recs.ravel(), n_items)[recs.ravel() >= 0]
+    positions = np.minimum(np.searchsorted(keys, found), max(len(keys) - 1, 0))
+    hits = np.bincount(found[keys[positions] == found] // n_items, minlength=len(reference)) if len(keys) else \
+        np.zeros(len(reference), dtype=np.int64)
+    totals = (reference >= 0).sum(axis=1)
+    return float((hits[totals > 0] / totals[totals > 0]).mean()) if (totals > 0).any() else None
+
+
+def _mean(values, weights=None):
+    return np.average(values, weights=weights) if len(values) else 0
+
+
+def _weighted_mean(scores, weights, mask):
+    weights = np.where(mask, weights[:len(scores)], 0)
+    total = weights.sum()
+    return np.dot(np.where(mask, scores, 0), weights) / total if total else 0
+
+
+def compute_metrics(recs, targets, profiles, popularity=None, items_count=None, gini_length=1040, weights=None):
+    """
+    Accuracy, popularity and diversity metrics of a set of recommendation lists.
+
+    Parameters:
+    - recs (np.ndarray): (rows, N) recommended item codes per test row, padded with -1.
+      Rows without any recommendation count as missing and are left out of every metric.
+    - targets (np.ndarray): The next item code of every row, -1 for items the models don't know.
+    - profiles (np.ndarray): The profile code of every row, MAP is averaged over these.
+    - popularity (Tuple[np.ndarray]): Duration, count and session popularity indexed by item code,
+      NaN for items without a score. None skips the popularity averages.
+    - items_count (int): The number of items coverage is relative to, coverage is 0 without any.
+    - gini_length (int): The Gini index pads the recommendation counts with zeros to this length.
+    - weights (np.ndarray): How many test rows every row stands for, when identical rows were collapsed.
+      The result is the same as for the expanded rows.
+
+    Returns:
+    - metrics (dict): map, accuracy (MRR), avgctr, the three popularity averages, coverage,
+      gini_index and missing_recommendations.
+    """
+    recs, targets, profiles = np.asarray(recs), np.asarray(targets), np.asarray(profiles)
+    weights = np.asarray(weights) if weights is not None else None
+    present = (recs >= 0).any(axis=1)
+    missing = int(np.count_nonzero(~present)) if weights is None else int(weights[~present].sum())
+    if not present.all():
+        recs, targets, profiles = recs[present], targets[present], profiles[present]
+        weights = weights[present] if weights is not None else None
+    valid = recs >= 0
+    # Lists are mostly full, indexing with an all-True mask would only copy
+    flat = (lambda values: values.ravel()) if valid.all() else (lambda values: values[valid])
+
+    with timings.stage("metrics.ctr_mrr", len(recs)):
+        ranks = hit_ranks(recs, targets)
+        avg_ctr = _mean(ranks > 0, weights)
+        average_mrr = _mean(np.where(ranks > 0, 1 / np.maximum(ranks, 1), 0), weights)
+
+    # Precision per profile: |actual next items ∩ recommended items| / |recommended items|, as sets,
+    # so it doesn't depend on how often a row occurs
+    with timings.stage("metrics.map", len(recs)):
+        users = profiles.astype(np.int64) - profiles.min(initial=0)
+        n_users = int(users.max(initial=-1)) + 1
+        n_items = max(int(max(recs.max(initial=-1), targets.max(initial=-1))) + 1, 1)
+        recommended = _unique(_pair_keys(flat(np.broadcast_to(users[:, None], recs.shape)), flat(recs), n_items))
+        known = targets >= 0
+        actual = _unique(_pair_keys(users[known], targets[known], n_items))
+        positions = np.minimum(np.searchsorted(recommended, actual), max(len(recommended) - 1, 0))
+        correct = np.bincount(actual[recommended[positions] == actual] // n_items, minlength=n_users) if len(recommended) else \
+            np.zeros(n_users, dtype=np.int64)
+        recommended_count = np.diff(np.searchsorted(recommended, np.arange(n_users + 1, dtype=np.int64) * n_items))
+        present_users = recommended_count > 0
+        mean_avg_precision = _mean(correct[present_users] / recommended_count[present_users])
+
+    # Popularity is averaged over the distinct items recommended to each profile, i.e. every item
+    # weighs as many times as there are profiles it was recommended to
+    with timings.stage("metrics.popularity", len(recs)):
+        profiles_per_item = np.bincount(recommended % n_items, minlength=n_items)
+        avg_popularity_score = avg_count_popularity_score = avg_session_popularity_score = None
+        if popularity is not None:
+            duration, count, session = (scores[:n_items] for scores in popularity)
+            avg_popularity_score = _weighted_mean(duration, profiles_per_item, ~np.isnan(duration))
+            avg_count_popularity_score = _weighted_mean(count, profiles_per_item, ~np.isnan(count))
+            # Items with a session score of 0 are left out
+            avg_session_popularity_score = _weighted_mean(session, profiles_per_item, ~np.isnan(session) & (session != 0))
+
+    # Gini index over how often each item was recommended, coverage over the distinct items
+    with timings.stage("metrics.gini_coverage", len(recs)):
+        if weights is None:
+            counts = np.bincount(flat(recs))
+        else:
+            counts = np.rint(np.bincount(flat(recs), weights=flat(np.broadcast_to(weights[:, None], recs.shape)))).astype(np.int64)
+        gini_index = gini(counts[counts > 0], gini_length)
+        unique_items = np.count_nonzero(counts)
+        coverage = unique_items / items_count if items_count else 0
+
+    return dict(map=mean_avg_precision, accuracy=average_mrr, avgctr=avg_ctr,
+                avg_popularity_score=avg_popularity_score, avg_count_popularity_score=avg_count_popularity_score,
+                avg_session_popularity_score=avg_session_popularity_score, coverage=coverage, gini_index=gini_index,
+                missing_recommendations=missing)
@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import threadpoolctl
+from rec.models.als import ALS
+from rec.models.mc import MC, TransitionIndex
+from rec.models.vomc import VariableOrderMC, ContextIndex
+from rec.models.hseq import HSEQ
+from rec.evaluator.cache import RecommendationCache
+from rec.utils.arrays import save_arrays, load_arrays
+from rec.utils.vocabulary import Vocabulary
+from rec.utils.timing import timings
+
+# The Evaluation of a worker process, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(path, config):
+    # Imported here as the evaluator module imports this one
+    from rec.evaluator.evaluator import Evaluation
+    logger = logging.getLogger("evaluator")
+    vocabulary = Vocabulary.from_arrays(load_arrays(os.path.join(path, "vocabulary")))
+    als = ALS.from_arrays(load_arrays(os.path.join(path, "als")), vocabulary, logger=logger)
+    arrays = load_arrays(os.path.join(path, "mc"))
+    if config['vomc'] is not None:
+        mc = VariableOrderMC.from_index(ContextIndex.from_arrays(arrays), vocabulary, logger=logger, **config['vomc'])
+    else:
+        mc = MC.from_index(TransitionIndex.from_arrays(arrays), vocabulary, method=config['method'], logger=logger)
+    threadpoolctl.threadpool_limits(config['blas_threads'], "blas")
+    timings.enabled = config['timings']
+
+    evaluation = Evaluation(logger=logger, popularity_scores=config['popularity_scores'],
+                            session_popularity_scores=config['session_popularity_scores'], cache_bytes=config['cache_bytes'],
+                            single_pass=config['single_pass'], dedup=config['dedup'])
+    evaluation.batch_size = config['batch_size']
+    evaluation.data = load_arrays(os.path.join(path, "test"))
+    evaluation.vocabulary = vocabulary
+    evaluation.ALS = als
+    evaluation.MC = mc
+    evaluation.cache = RecommendationCache(als, mc, config['als_n'], max_bytes=config['cache_bytes'], logger=logger)
+    evaluation.HSEQ = HSEQ(mc, als, logger=logger, cache=evaluation.cache)
+    _worker['evaluation'] = evaluation
+
+
+def _evaluate_group(group, experiment_id):
+    evaluation = _worker['evaluation']
+    model, method, w1, w2, K, Ns = group
+    # Every worker holds its own MC method, switching only selects another index column
+    if model != "als" and method != evaluation.MC.method:
+        evaluation.MC.change_method(method)
+    return evaluation._evaluate_cutoffs(method, w1, w2, K, Ns, experiment_id, model)
+
+
+def _share(evaluation, path, blas_threads):
+    # Writes the arrays the workers map under path, returns the config _init_worker sets them up with
+    save_arrays(evaluation.vocabulary.to_arrays(), os.path.join(path, "vocabulary"))
+    save_arrays(evaluation.ALS.to_arrays(), os.path.join(path, "als"))
+    save_arrays(evaluation.MC.index.to_arrays(), os.path.join(path, "mc"))
+    save_arrays(evaluation.data, os.path.join(path, "test"))
+    # The parameters of a VariableOrderMC, whose index is a ContextIndex rather than a TransitionIndex
+    vomc = evaluation.MC.params() if isinstance(evaluation.MC, VariableOrderMC) else None
+    return dict(method=evaluation.MC.method, vomc=vomc, als_n=evaluation.cache.als_n,
+                cache_bytes=evaluation.cache_bytes, blas_threads=blas_threads, timings=evaluation.timings,
+                popularity_scores=evaluation.popularity_scores,
+                session_popularity_scores=evaluation.session_popularity_scores,
+                single_pass=evaluation.single_pass, dedup=evaluation.dedup, batch_size=evaluation.batch_size)
+
+
+def evaluate_parallel(evaluation, experiment_id, workers, blas_threads=1, groups=None):
+    """
+    Evaluates the case groups (see Evaluation.case_groups, all cases unless groups is given) of a set up
+    Evaluation in a pool of worker processes.
+
+    The vocabulary, ALS factors (with the IVF index and candidate table, if built), interaction matrix, MC
+    (or VariableOrderMC) index and test set are written once as .npy files that every worker memory-maps, so the pages are
+    shared between processes instead of pickled.
+    Results are reported by the calling process into the usual CSV as cases complete.
+    """
+    path = tempfile.mkdtemp(prefix="rec-evaluation-")
+    try:
+        config = _share(evaluation, path, blas_threads)
+
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(path, config)) as pool:
+            futures = [pool.submit(_evaluate_group, group, experiment_id) for group in (groups if groups is not None else evaluation.case_groups())]
+            for future in as_completed(futures):
+                for result in future.result():
+                    evaluation._report(result, experiment_id)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,71 @@
+import json
+import sqlite3
+import time
+
+# Metric columns of a stored result, in the order of the dicts _evaluate_cutoffs returns
+METRICS = ['map', 'accuracy', 'avgctr', 'missing_bridge_count', 'missing_cf_count', 'not_enough_bridge_count',
+           'not_enough_cf_count', 'avg_popularity_score', 'avg_count_popularity_score', 'avg_session_popularity_score',
+           'coverage', 'gini_index', 'missing_recommendations', 'seconds']
+CASE = ['model', 'method', 'w1', 'w2', 'K', 'N']
+
+
+class ResultStore:
+    """
+    SQLite store of evaluation results, one row per (experiment_id, EvaluationCase, data fingerprint).
+
+    Every result is committed in its own transaction as soon as its case is done, so a run that dies
+    keeps the finished cases and a rerun of the same experiment on the same data only evaluates the rest.
+    Runs are recorded with their metadata (sample, seed, model parameters) and timings.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (experiment_id TEXT, fingerprint TEXT, "
+                + ", ".join(CASE) + ", "
+                + ", ".join(f"{metric} REAL" for metric in METRICS) + ", created REAL, "
+                "PRIMARY KEY (experiment_id, fingerprint, " + ", ".join(CASE) + "))")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, experiment_id TEXT, "
+                "fingerprint TEXT, metadata TEXT, started REAL, finished REAL, cases INTEGER, skipped INTEGER)")
+
+    @staticmethod
+    def case_key(case):
+        return (case.model, case.method, float(case.w1), float(case.w2), int(case.K), int(case.N))
+
+    def done(self, experiment_id, fingerprint):
+        """The keys (see case_key) of the cases that already have a result."""
+        rows = self.connection.execute(f"SELECT {', '.join(CASE)} FROM results WHERE experiment_id = ? AND fingerprint = ?",
+                                       (experiment_id, fingerprint))
+        return {(model, method, float(w1), float(w2), int(K), int(N)) for model, method, w1, w2, K, N in rows}
+
+    def put(self, experiment_id, fingerprint, result):
+        """Stores the result dict of one case, replacing an earlier result of the same case."""
+        values = [result[column] for column in CASE] + [result.get(metric) for metric in METRICS]
+        values = [value.item() if hasattr(value, 'item') else value for value in values]
+        with self.connection:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO results VALUES ({', '.join('?' * (len(values) + 3))})",
+                [experiment_id, fingerprint] + values + [time.time()])
+
+    def results(self, experiment_id, fingerprint=None):
+        """The stored results of an experiment as a list of dicts."""
+        query = "SELECT * FROM results WHERE experiment_id = ?" + (" AND fingerprint = ?" if fingerprint else "")
+        cursor = self.connection.execute(query, (experiment_id, fingerprint) if fingerprint else (experiment_id,))
+        columns = [description[0] for description in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def start_run(self, experiment_id, fingerprint, metadata, cases, skipped):
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (experiment_id, fingerprint, metadata, started, cases, skipped) VALUES (?, ?, ?, ?, ?, ?)",
+                (experiment_id, fingerprint, json.dumps(metadata, default=str), time.time(), cases, skipped))
+        return cursor.lastrowid
+
+    def finish_run(self, run_id):
+        with self.connection:
+            self.connection.execute("UPDATE runs SET finished = ? WHERE run_id = ?", (time.time(), run_id))
+
+    def close(self):
+        self.connection.close()
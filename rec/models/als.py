@@ -1,43 +1,59 @@
-import pyarrow.parquet as pq
-import glob
-
+import os
 import pandas as pd
 import numpy as np
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csr_matrix
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from implicit.als import AlternatingLeastSquares
 from implicit.nearest_neighbours import bm25_weight
 from rec.types.types import Recommendation, RecommendedItem
+from rec.utils.vocabulary import Vocabulary
+from rec.utils.dataset import read_table, sparse_sums, VIEWING_COLUMNS
+from rec.utils.arrays import save_arrays, load_arrays
+from rec.utils.timing import timings
+from rec.models.ann import IVFIndex
+from rec.models.quantize import quantize, dequantize
 import threadpoolctl
 
 class ALS:
-    def __init__(self, factors=20, use_gpu=False, use_cg=False, iterations=10, logger=None):
+    def __init__(self, factors=20, use_gpu=False, use_cg=False, iterations=10, logger=None, vocabulary=None):
 
         threadpoolctl.threadpool_limits(12, "blas")
 
         self.logger = logger
         self.logger.name = "als"
+        # Shared with MC and the evaluator, so all of them agree on item and profile codes
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
         self.model = AlternatingLeastSquares(
             factors=factors,
             use_gpu=use_gpu,
             use_cg=use_cg,
             iterations=iterations
         )
+        self.sessions = None
+        # Per-row scales of int8 factors, see quantize
+        self.user_scales = self.item_scales = None
+        # Optional approximate top-K index over the item factors, see build_index
+        self.index = None
+        # Optional (users, Kmax) table of precomputed top lists per matrix row, see build_candidates
+        self.candidate_items = None
+        self.candidate_scores = None
 
-    def load_data(self, path, nested=False, limit=-1):
-        i = 0
-        if nested:
-            dfs = []
-            for file in glob.glob(path + "/**/*.parquet", recursive=True):
-                if i > limit and limit != -1:
-                    break
-                df = pq.read_table(file).to_pandas()
-                self.logger.debug("Loaded file: " + file + " with shape: " + str(df.shape))
-                dfs.append(df)
-                i += 1
-            self.data = pd.concat(dfs, ignore_index=True)
-        else:
-            self.data = pq.read_table(path).to_pandas()
+    def load_data(self, path, nested=False, limit=-1, filter=None):
+        self.data = read_table(path, VIEWING_COLUMNS, nested, limit, filter, self.logger).to_pandas()
+
+    def load_matrix(self, path, nested=False, limit=-1, filter=None, batch_size=1000000):
+        """
+        Replaces load_data and preprocess: sums durationSec per (profileId, itemId) straight from the Parquet
+        files into the interaction matrix with Arrow, batch by batch, see rec.utils.dataset.sparse_sums.
+        fit then trains on that matrix, which is identical to the one of the pandas path.
+        """
+        user_ids, item_ids, self.uim = sparse_sums(path, "profileId", "itemId", "durationSec", nested, limit, filter,
+                                                   batch_size, self.logger)
+        self.data = self.sessions = None
+        self.item_codes = self.vocabulary.items.encode(item_ids, add=True)
+        self.user_codes = self.vocabulary.profiles.encode(user_ids, add=True)
+        self._set_user_rows()
 
     def _bm25(self, uim, K1=3.0, B=1.0):
 
@@ -50,17 +66,27 @@ class ALS:
             .reset_index()
 
     def fit(self, K1=1.2, B=0.75):
+        if self.sessions is not None:
+            self._build_matrix()
+
+        # Fit model
+
+        self._bm25(self.uim, K1, B)
+        self.model.fit(self.uim, show_progress=True)
+        self._set_factors()
+        self.index = None
+        self.candidate_items = self.candidate_scores = None
+
+    def _build_matrix(self):
         # set types for user and item IDs
         self.sessions['userId'] = self.sessions['userId'].astype("category")
         self.sessions['itemId'] = self.sessions['itemId'].astype("category")
 
-        # Dicts of item/usery IDX to ID
-        self.items = dict(enumerate(self.sessions['itemId'].cat.categories))
-        self.users = dict(enumerate(self.sessions['userId'].cat.categories))
+        # Rows/columns of the interaction matrix follow the sorted categories, arrays map them to vocabulary codes
+        self.item_codes = self.vocabulary.items.encode(self.sessions['itemId'].cat.categories, add=True)
+        self.user_codes = self.vocabulary.profiles.encode(self.sessions['userId'].cat.categories, add=True)
+        self._set_user_rows()
 
-        # Reverse dicts of user/item mappings
-        self.items_rev = {val: key for key, val in self.items.items()}
-        self.users_rev = {val: key for key, val in self.users.items()}
         # Build Item-User interaction matrix
         self.uim = coo_matrix(
             (self.sessions['score'].astype(np.float32),
@@ -68,72 +94,300 @@ class ALS:
               self.sessions['itemId'].cat.codes))
         ).tocsr()
 
-        # Fit model
+    def _set_factors(self):
+        # Scoring is done on host arrays, GPU models are copied over once after fitting
+        model = self.model if isinstance(self.model.user_factors, np.ndarray) else self.model.to_cpu()
+        self.user_factors = model.user_factors
+        self.item_factors = model.item_factors
+        self.user_scales = self.item_scales = None
 
-        self._bm25(self.uim, K1, B)
-        self.model.fit(self.uim, show_progress=True)
+    @property
+    def precision(self):
+        return str(self.item_factors.dtype)
+
+    def quantize(self, precision='float16'):
+        """
+        Stores the factors as float16, or as int8 with a float32 scale per row, to keep more models resident.
+        recommend_batch scores directly on the reduced factors, dequantizing blocks of rows as it goes; see
+        rec.models.quantize.precision_report for the effect on accuracy. The float32 factors of the implicit
+        model are released, so recommend and recommend_items are no longer available. Quantize before
+        building an index or a candidate table.
+        """
+        if self.precision != 'float32':
+            raise ValueError(f"The factors are already stored as {self.precision}")
+        before = self.factor_bytes()
+        self.user_factors, self.user_scales = quantize(self.user_factors, precision)
+        self.item_factors, self.item_scales = quantize(self.item_factors, precision)
+        if precision != 'float32':
+            self.model.user_factors = self.model.item_factors = None
+        self.logger.info(f"Quantized the factors to {precision}: {before} -> {self.factor_bytes()} bytes")
+
+    def factor_bytes(self):
+        return sum(array.nbytes for array in (self.user_factors, self.item_factors, self.user_scales, self.item_scales)
+                   if array is not None)
+
+    def _scores(self, users, block=65536):
+        # (len(users), items) scores of the given matrix rows, quantized item factors are dequantized in blocks
+        queries = dequantize(self.user_factors, self.user_scales, users)
+        if self.precision == 'float32':
+            return queries @ self.item_factors.T
+        scores = np.empty((len(users), self.item_factors.shape[0]), dtype=np.float32)
+        for start in range(0, self.item_factors.shape[0], block):
+            items = slice(start, start + block)
+            scores[:, items] = queries @ dequantize(self.item_factors, self.item_scales, items).T
+        return scores
+
+    def build_index(self, n_lists=None, nprobe=8, iterations=10, seed=0):
+        """
+        Builds an IVFIndex over the item factors, recommend_batch uses it instead of scoring every item
+        until the model is refitted. See IVFIndex.build for the parameters and rec.models.ann.recall_report
+        to pick n_lists and nprobe.
+        """
+        self.index = IVFIndex.build(dequantize(self.item_factors, self.item_scales), n_lists, nprobe, iterations, seed=seed)
+        self.logger.info(f"Built an index of {len(self.index.offsets) - 1} lists over {len(self.item_codes)} items")
+        return self.index
+
+    def build_candidates(self, Kmax=100, workers=1, batch_size=512, path=None):
+        """
+        Precomputes the exact top Kmax unseen items and raw scores of every user the model was fitted on. Until the
+        model is refitted, recommend_batch answers N <= Kmax with row reads of this table instead of scoring.
+
+        Parameters:
+        - Kmax (int): The length of the stored lists, the largest N (or HSEQ K) served from the table.
+        - workers (int): The number of threads scoring chunks of users at once.
+        - batch_size (int): The number of users a thread scores per matrix product.
+        - path (str): Write the table to path as memory-mapped .npy files instead of keeping it in memory,
+          e.g. the directory of ALS.save so ALS.load picks it up.
+        """
+        self.candidate_items = self.candidate_scores = None
+        shape = (len(self.user_codes), Kmax)
+        if path is None:
+            items = np.empty(shape, dtype=np.int32)
+            scores = np.empty(shape, dtype=np.float32)
+        else:
+            os.makedirs(path, exist_ok=True)
+            items = np.lib.format.open_memmap(os.path.join(path, "candidate_items.npy"), "w+", np.int32, shape)
+            scores = np.lib.format.open_memmap(os.path.join(path, "candidate_scores.npy"), "w+", np.float32, shape)
+
+        def chunk(start):
+            rows = slice(start, start + batch_size)
+            # Exact lists, the table is served ahead of an index and must not inherit its recall
+            items[rows], scores[rows] = self.recommend_batch(self.user_codes[rows], N=Kmax, batch_size=batch_size,
+                                                             encoded=True, exact=True)
+
+        # Matrix products and partitions release the GIL, so threads share the factors without copies
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(chunk, range(0, shape[0], batch_size)))
+        if path is not None:
+            items.flush()
+            scores.flush()
+        self.candidate_items, self.candidate_scores = items, scores
+        self.logger.info(f"Built the top {Kmax} candidates of {shape[0]} users ({items.nbytes + scores.nbytes} bytes)")
+
+    def has_candidates(self, N):
+        return self.candidate_items is not None and N <= self.candidate_items.shape[1]
+
+    def _set_user_rows(self):
+        # Reverse of user_codes: vocabulary profile code to matrix row, -1 for profiles ALS wasn't fitted on
+        self.user_rows = np.full(len(self.vocabulary.profiles), -1, dtype=np.int64)
+        self.user_rows[self.user_codes] = np.arange(len(self.user_codes))
+
+    def _rows(self, codes):
+        codes = np.asarray(codes, dtype=np.int64)
+        rows = np.full(len(codes), -1, dtype=np.int64)
+        known = (codes >= 0) & (codes < len(self.user_rows))
+        rows[known] = self.user_rows[codes[known]]
+        return rows
+
+    def _user_row(self, user_id):
+        row = self._rows([self.vocabulary.profiles.code(user_id)])[0]
+        return None if row < 0 else row
+
+    def to_arrays(self):
+        """The fitted state as a dict of arrays, see from_arrays."""
+        arrays = {
+            'user_factors': self.user_factors,
+            'item_factors': self.item_factors,
+            'uim_data': self.uim.data,
+            'uim_indices': self.uim.indices,
+            'uim_indptr': self.uim.indptr,
+            'user_codes': self.user_codes,
+            'item_codes': self.item_codes,
+        }
+        if self.user_scales is not None:
+            arrays['user_scales'] = self.user_scales
+            arrays['item_scales'] = self.item_scales
+        if self.candidate_items is not None:
+            arrays['candidate_items'] = self.candidate_items
+            arrays['candidate_scores'] = self.candidate_scores
+        if self.index is not None:
+            arrays.update({f'index.{name}': array for name, array in self.index.to_arrays().items()})
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, vocabulary, logger=None):
+        """Rebuilds a fitted model around the arrays of to_arrays without copying them, e.g. memory-mapped files."""
+        als = cls(factors=arrays['user_factors'].shape[1], logger=logger, vocabulary=vocabulary)
+        als.user_factors = arrays['user_factors']
+        als.item_factors = arrays['item_factors']
+        als.user_scales = arrays.get('user_scales')
+        als.item_scales = arrays.get('item_scales')
+        # implicit only scores float32 factors
+        if als.precision == 'float32':
+            als.model.user_factors, als.model.item_factors = als.user_factors, als.item_factors
+        als.user_codes = arrays['user_codes']
+        als.item_codes = arrays['item_codes']
+        als.uim = csr_matrix((arrays['uim_data'], arrays['uim_indices'], arrays['uim_indptr']),
+                             shape=(len(als.user_codes), len(als.item_codes)), copy=False)
+        als.candidate_items = arrays.get('candidate_items')
+        als.candidate_scores = arrays.get('candidate_scores')
+        if 'index.centroids' in arrays:
+            als.index = IVFIndex.from_arrays({name[len('index.'):]: array for name, array in arrays.items()
+                                              if name.startswith('index.')})
+        als._set_user_rows()
+        return als
+
+    def save(self, path):
+        """Saves the fitted model as .npy files (and its vocabulary) that load can memory-map."""
+        save_arrays(self.to_arrays(), path)
+        self.vocabulary.save(os.path.join(path, "vocabulary"))
+
+    @classmethod
+    def load(cls, path, mmap=True, logger=None, vocabulary=None):
+        """
+        Loads a model written by save without refitting.
+
+        Parameters:
+        - path (str): The directory passed to save.
+        - mmap (bool): Memory-map the arrays read-only instead of reading them into memory.
+        - logger (logging.Logger): The logger of the model.
+        - vocabulary (Vocabulary): Vocabulary to share with other loaded models, see Vocabulary.load.
+        """
+        vocabulary = Vocabulary.load(os.path.join(path, "vocabulary"), vocabulary)
+        als = cls.from_arrays(load_arrays(path, mmap), vocabulary, logger=logger or logging.getLogger(__name__))
+        # Models saved before the index was part of to_arrays keep it in a subdirectory
+        if als.index is None and os.path.isdir(os.path.join(path, "index")):
+            als.index = IVFIndex.from_arrays(load_arrays(os.path.join(path, "index"), mmap))
+        return als
+
+    def _seen_items(self, users):
+        # Gather the CSR row ranges of the given users into (row, item) coordinates
+        starts = self.uim.indptr[users]
+        lengths = self.uim.indptr[users + 1] - starts
+        rows = np.repeat(np.arange(len(users)), lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return rows, self.uim.indices[np.repeat(starts, lengths) + offsets]
+
+    @timings.timed("als.recommend_batch", batch=True)
+    def recommend_batch(self, user_ids, N=5, batch_size=512, encoded=False, exact=False, nprobe=None, use_candidates=True):
+        """
+        Recommends the top N unseen items for every user in user_ids. With a candidate table covering N
+        (see build_candidates) the lists are read from it, else with an index built (see build_index) the
+        items are searched approximately; exact scores every item either way.
+
+        Parameters:
+        - user_ids (iterable): Raw user IDs, or vocabulary profile codes when encoded is set. Unknown users get an empty row.
+        - N (int): The number of items to recommend per user.
+        - batch_size (int): The number of unique users scored per matrix product.
+        - encoded (bool): Whether user_ids are already vocabulary codes.
+        - exact (bool): Score every item even if a candidate table or an index is built.
+        - nprobe (int): The number of index lists to search, the index default when None.
+        - use_candidates (bool): Read the candidate table when it covers N, False searches the index (or
+          scores exactly) even then, e.g. to measure the index.
+
+        Returns:
+        - items (np.ndarray): (len(user_ids), N) int32 vocabulary item codes, padded with -1.
+        - scores (np.ndarray): (len(user_ids), N) float32 raw scores, padded with -inf.
+        """
+        codes = user_ids if encoded else self.vocabulary.profiles.encode(user_ids)
+        rows = self._rows(codes)
+        items = np.full((len(rows), N), -1, dtype=np.int32)
+        scores = np.full((len(rows), N), -np.inf, dtype=np.float32)
+        if self.has_candidates(N) and use_candidates and not exact:
+            # Lists are sorted, the top N are the first N columns of a user's row
+            known = rows >= 0
+            items[known] = self.candidate_items[rows[known], :N]
+            scores[known] = self.candidate_scores[rows[known], :N]
+            return items, scores
+        users, inverse = np.unique(rows, return_inverse=True)
+        known = np.flatnonzero(users >= 0)
+        k = min(N, self.item_factors.shape[0])
+        if k == 0 or len(known) == 0:
+            return items, scores
+        unique_items = np.full((len(users), N), -1, dtype=np.int32)
+        unique_scores = np.full((len(users), N), -np.inf, dtype=np.float32)
+        approximate = self.index is not None and not exact
+        for start in range(0, len(known), batch_size):
+            rows = known[start:start + batch_size]
+            if approximate:
+                # The index filters seen items among its candidates the same way as the exact path below
+                queries = dequantize(self.user_factors, self.user_scales, users[rows])
+                top, top_scores = self.index.search(queries, k, self._seen_items(users[rows]), nprobe)
+                unique_items[rows, :k] = np.where(top < 0, -1, self.item_codes[top])
+                unique_scores[rows, :k] = top_scores
+                continue
+            batch = self._scores(users[rows])
+            batch[self._seen_items(users[rows])] = -np.inf
+            top = np.argpartition(-batch, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(batch, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            unique_items[rows, :k] = np.where(np.isneginf(top_scores), -1, self.item_codes[top])
+            unique_scores[rows, :k] = top_scores
+        return unique_items[inverse], unique_scores[inverse]
+
+    @timings.timed("als.to_recommendation")
+    def to_recommendation(self, user_id, items, scores) -> Recommendation:
+        # Builds a min-max normalized recommendation from one row of recommend_batch
+        valid = items >= 0
+        items, scores = items[valid], scores[valid]
+        if len(items) == 0:
+            return None
+        if len(scores) > 1:
+            scores = (scores - scores.min()) / (scores.max() - scores.min())
+        else:
+            scores = np.array([1.0])
+        recommendation = Recommendation(user_id, None, {}, [], [])
+        item_ids = self.vocabulary.items.decode(items)
+        recommendation.items = [RecommendedItem(item_ids[i], scores[i], "CF") for i in range(len(items))]
+        return recommendation
 
     def recommend(self, user_id, N=5):
-        u = self.users_rev.get(user_id, None)
-        try:
-            i = self.uim[self.users_rev[user_id]]
-        except Exception as e:
-            self.logger.error(e)
-            i = None
+        if self.precision != 'float32':
+            self.logger.error(f"recommend needs float32 factors, not {self.precision}")
+            return None
+        u = self._user_row(user_id)
         if u is None:
             self.logger.error("User not found")
             return None
-        if i is None:
-            self.logger.error("Item not found")
-            return None
-        return self.model.recommend(u, self.uim[self.users_rev[user_id]], N=N)
+        return self.model.recommend(u, self.uim[u], N=N)
 
     def recommend_items(self, user_id, N=5):
-        u = self.users_rev.get(user_id, None)
-        try:
-            i = self.uim[self.users_rev[user_id]]
-        except Exception as e:
-            self.logger.error(e)
-            i = None
+        if self.precision != 'float32':
+            self.logger.error(f"recommend_items needs float32 factors, not {self.precision}")
+            return None
+        u = self._user_row(user_id)
         if u is None:
             self.logger.error("User not found")
             return None
-        if i is None:
-            self.logger.error("Item not found")
-            return None
 
         try:
-            recs = self.model.recommend(u, self.uim[self.users_rev[user_id]], N=N)[0]
-            return [self.items.get(rec) for rec in recs]
+            recs = self.model.recommend(u, self.uim[u], N=N)[0]
+            return list(self.vocabulary.items.decode(self.item_codes[recs]))
         except Exception as e:
             self.logger.error(e)
             return None
 
+    @timings.timed("als.recommend_standard")
     def recommend_standard(self, user_id, N=5) -> Recommendation:
-        recommendation = Recommendation(user_id, None, {}, [], [])
-        u = self.users_rev.get(user_id, None)
-        try:
-            i = self.uim[self.users_rev[user_id]]
-        except Exception as e:
-            self.logger.error(e)
-            i = None
-        if u is None:
+        if self._user_row(user_id) is None:
             self.logger.error("User not found")
             return None
-        if i is None:
-            self.logger.error("Item not found")
-            return None
 
         try:
-            recs = self.model.recommend(u, self.uim[self.users_rev[user_id]], N=N)
-            items, scores = recs[0], recs[1]
-            scores_np = np.array(scores)
-            if len(scores_np) > 1:
-                scores = (scores_np - scores_np.min()) / (scores_np.max() - scores_np.min())
-            else:
-                scores = np.array([1.0])
-            recommendation.items = [RecommendedItem(self.items.get(items[i]), scores[i], "CF") for i in range(len(items))]
-            return recommendation
+            items, scores = self.recommend_batch([user_id], N=N)
+            return self.to_recommendation(user_id, items[0], scores[0])
         except Exception as e:
             self.logger.error(e)
             return None
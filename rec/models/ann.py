@@ -0,0 +1,180 @@
+import time
+import logging
+import numpy as np
+from rec.evaluator.metrics import overlap
+
+
+def _nearest(x, centroids, chunk=65536):
+    # Index of the closest centroid of every row, argmin |x - c|^2 = argmax x.c - |c|^2 / 2
+    half_norms = 0.5 * (centroids ** 2).sum(axis=1)
+    assignment = np.empty(len(x), dtype=np.int32)
+    for start in range(0, len(x), chunk):
+        assignment[start:start + chunk] = np.argmax(x[start:start + chunk] @ centroids.T - half_norms, axis=1)
+    return assignment
+
+
+def kmeans(x, k, iterations=10, seed=0):
+    """
+    Lloyd's k-means on the rows of x.
+
+    Returns:
+    - centroids (np.ndarray): (k, dim) float32 cluster centers.
+    - assignment (np.ndarray): The cluster of every row of x.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=np.float32)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _nearest(x, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.stack([np.bincount(assignment, weights=x[:, d], minlength=k) for d in range(x.shape[1])], axis=1)
+        empty = counts == 0
+        centroids[~empty] = (sums[~empty] / counts[~empty, None]).astype(np.float32)
+        # Empty clusters restart at random rows
+        centroids[empty] = x[rng.choice(len(x), empty.sum(), replace=False)]
+    return centroids, _nearest(x, centroids)
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate maximum inner product search over item factors.
+
+    Items are clustered with k-means. A query scores only the items of the nprobe lists whose centroids
+    have the largest inner product with it, exactly, instead of every item; nprobe trades recall for speed
+    and nprobe = n_lists scores every item. Like TransitionIndex the lists are a CSR layout: the items of
+    list l are order[offsets[l]:offsets[l + 1]] and their factors the same rows of factors.
+    """
+    def __init__(self, centroids, offsets, order, factors, nprobe=8):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.order = order
+        self.factors = factors
+        self.nprobe = nprobe
+        # List and position within the list of every item, to filter seen items
+        self.lists = np.repeat(np.arange(len(offsets) - 1, dtype=np.int32), np.diff(offsets))[np.argsort(order)]
+        self.positions = np.empty(len(order), dtype=np.int64)
+        self.positions[order] = np.arange(len(order)) - offsets[self.lists[order]]
+
+    @classmethod
+    def build(cls, item_factors, n_lists=None, nprobe=8, iterations=10, sample=256, seed=0):
+        """
+        Clusters the item factors into n_lists lists.
+
+        Parameters:
+        - item_factors (np.ndarray): (items, factors) array, e.g. ALS.item_factors.
+        - n_lists (int): The number of lists, the square root of the number of items by default.
+        - nprobe (int): The default number of lists a query scores.
+        - iterations (int): k-means iterations.
+        - sample (int): k-means is trained on at most sample items per list.
+        - seed (int): Seed of the k-means initialization and sample.
+        """
+        item_factors = np.asarray(item_factors, dtype=np.float32)
+        n_lists = min(n_lists or max(1, int(np.sqrt(len(item_factors)))), len(item_factors))
+        rng = np.random.default_rng(seed)
+        training = item_factors
+        if len(item_factors) > sample * n_lists:
+            training = item_factors[rng.choice(len(item_factors), sample * n_lists, replace=False)]
+        centroids, _ = kmeans(training, n_lists, iterations, seed)
+        assignment = _nearest(item_factors, centroids)
+        order = np.argsort(assignment, kind='stable').astype(np.int64)
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=offsets[1:])
+        return cls(centroids, offsets, order, item_factors[order], min(nprobe, n_lists))
+
+    def to_arrays(self):
+        return {'centroids': self.centroids, 'offsets': self.offsets, 'order': self.order, 'factors': self.factors,
+                'nprobe': np.array(self.nprobe)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['centroids'], arrays['offsets'], arrays['order'], arrays['factors'], int(arrays['nprobe']))
+
+    def search(self, queries, N, exclude=None, nprobe=None):
+        """
+        Approximate top N items of every query vector.
+
+        Parameters:
+        - queries (np.ndarray): (n, factors) query vectors, e.g. rows of ALS.user_factors.
+        - N (int): The number of items per query.
+        - exclude (Tuple[np.ndarray, np.ndarray]): (query, item) coordinates never to return, e.g. seen items.
+        - nprobe (int): The number of lists to score, the index default when None.
+
+        Returns:
+        - items (np.ndarray): (n, N) item rows of the factors the index was built on, padded with -1.
+        - scores (np.ndarray): (n, N) float32 inner products, padded with -inf.
+        """
+        n_lists = len(self.offsets) - 1
+        nprobe = min(nprobe or self.nprobe, n_lists)
+        lengths = np.diff(self.offsets)
+        probe = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe] \
+            if nprobe < n_lists else np.broadcast_to(np.arange(n_lists), (len(queries), n_lists))
+        # The probed lists of a query are laid out back to back, list slot s starting at column starts[q, s]
+        sizes = lengths[probe]
+        starts = np.cumsum(sizes, axis=1) - sizes
+        width = max(int(sizes.sum(axis=1).max()), 1)
+        candidates = np.full((len(queries), width), -np.inf, dtype=np.float32)
+        candidate_items = np.full((len(queries), width), -1, dtype=np.int64)
+        flat = probe.ravel()
+        visits = np.argsort(flat, kind='stable')
+        bounds = np.searchsorted(flat[visits], np.arange(n_lists + 1))
+        for l in np.flatnonzero(np.diff(bounds)):
+            visit = visits[bounds[l]:bounds[l + 1]]
+            rows = visit // nprobe
+            start, end = self.offsets[l], self.offsets[l + 1]
+            columns = starts.ravel()[visit][:, None] + np.arange(end - start)[None, :]
+            candidates[rows[:, None], columns] = queries[rows] @ self.factors[start:end].T
+            candidate_items[rows[:, None], columns] = self.order[start:end]
+        if exclude is not None:
+            rows, items = exclude
+            list_starts = np.full((len(queries), n_lists), -1, dtype=np.int64)
+            list_starts[np.arange(len(queries))[:, None], probe] = starts
+            start = list_starts[rows, self.lists[items]]
+            probed = start >= 0
+            candidates[rows[probed], start[probed] + self.positions[items[probed]]] = -np.inf
+
+        k = min(N, width)
+        top = np.argpartition(-candidates, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(candidates, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        items = np.full((len(queries), N), -1, dtype=np.int64)
+        scores = np.full((len(queries), N), -np.inf, dtype=np.float32)
+        items[:, :k] = np.where(np.isneginf(top_scores), -1, np.take_along_axis(candidate_items, top, axis=1))
+        scores[:, :k] = top_scores
+        return items, scores
+
+    def nbytes(self):
+        return self.centroids.nbytes + self.offsets.nbytes + self.order.nbytes + self.factors.nbytes
+
+
+def recall_report(als, user_ids, N=20, nprobes=(1, 2, 4, 8, 16, 32), encoded=False, logger=None):
+    """
+    Compares the approximate recommendations of an ALS model with a built index to its exact ones. A
+    candidate table is bypassed, the report measures the index alone.
+
+    Parameters:
+    - als (ALS): A fitted model, see ALS.build_index.
+    - user_ids (iterable): The users to recommend for, raw IDs or profile codes when encoded is set.
+    - N (int): The recall cutoff K.
+    - nprobes (List[int]): The numbers of probed lists to report.
+
+    Returns:
+    - report (List[dict]): Per nprobe the recall@N against the exact top N and the milliseconds per user
+      of both paths.
+    """
+    logger = logger or logging.getLogger("ann")
+    codes = user_ids if encoded else als.vocabulary.profiles.encode(user_ids)
+    start = time.perf_counter()
+    exact, _ = als.recommend_batch(codes, N, encoded=True, exact=True)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(codes)
+    report = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        approximate, _ = als.recommend_batch(codes, N, encoded=True, nprobe=nprobe, use_candidates=False)
+        ms = (time.perf_counter() - start) * 1000 / len(codes)
+        report.append(dict(nprobe=nprobe, recall=overlap(approximate, exact), ms_per_user=ms, exact_ms_per_user=exact_ms,
+                           speedup=exact_ms / ms))
+        logger.info(f"nprobe {nprobe:>4} recall@{N} {report[-1]['recall']:.4f} {ms:.3f} ms/user "
+                    f"(exact {exact_ms:.3f} ms/user)")
+    return report
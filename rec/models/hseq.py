@@ -1,18 +1,33 @@
 from typing import List, Dict
 from rec.types.types import Recommendation, RecommendedItem
 import logging
+import numpy as np
+from rec.utils.timing import timings
+
+
+def softmax(scores):
+    # Row-wise softmax of a (B, K) score matrix, in float32 like Recommendation.softmax_normalize_scores
+    # so that rerank_batch breaks exact ties the way _rerank does
+    exp_scores = np.exp(scores.astype(np.float32))
+    return exp_scores / exp_scores.sum(axis=1, keepdims=True)
+
 
 class HSEQ:
-    def __init__(self, MC, ALS, logger) -> None:
+    def __init__(self, MC, ALS, logger, cache=None) -> None:
         self.logger = logger
         self.logger.name = "hseq"
+        if MC is not None and ALS is not None and MC.vocabulary is not ALS.vocabulary:
+            raise ValueError("MC and ALS must share one Vocabulary")
         self.MC = MC
         self.ALS = ALS
+        # Optional RecommendationCache that serves the ALS and MC candidate lists
+        self.cache = cache
         self.missing_bridge_count = 0
         self.missing_cf_count = 0
         self.not_enough_bridge_count = 0
         self.not_enough_cf_count = 0
 
+    @timings.timed("hseq.recommend")
     def recommend(self, userId, item_id, N=5, w1=0.5, w2=0.5, K=5):
         """
         Recommends a list of items for a given user.
@@ -34,15 +49,155 @@ class HSEQ:
         recommended_items = self._rerank(userId, item_id, als_recs, mc, w1, w2, N)
         return recommended_items
 
+    def item_ids(self, codes):
+        """Maps item codes returned by recommend_batch back to raw item IDs (codes of -1 map to None)."""
+        return np.where(codes >= 0, self.ALS.vocabulary.items.decode(np.maximum(codes, 0)), None)
+
+    def recommend_batch(self, user_ids, item_ids, N=5, w1=0.5, w2=0.5, K=5, encoded=False):
+        """
+        Recommends a list of items for every (user, item) pair, scoring all users in one ALS batch.
+
+        Parameters are the same as for recommend, with user_ids and item_ids given as equally long sequences
+        of raw IDs, or of vocabulary codes when encoded is set.
+
+        Returns:
+        - items (np.ndarray): (len(user_ids), N) vocabulary item codes, rows without a recommendation are -1.
+        - scores (np.ndarray): (len(user_ids), N) reranked scores.
+        """
+        items, scores, distinct = self._recommend_batch(user_ids, item_ids, N, w1, w2, K, encoded)
+        complete = distinct > 0
+        valid = distinct > N
+        if (complete & ~valid).any():
+            self.logger.error(f"Reranked recommendations less than K for {int((complete & ~valid).sum())} rows.")
+        items[~valid] = -1
+        scores[~valid] = -np.inf
+        return items, scores
+
+    def recommend_prefixes(self, user_ids, item_ids, Ns, w1=0.5, w2=0.5, K=5, encoded=False, weights=None):
+        """
+        recommend_batch for several N at once. The reranked lists are sorted, so the list for a smaller N
+        is a prefix of the one for the largest N and only that one is computed. weights, if given, is the
+        number of queries every (user, item) pair stands for in the missing/not enough counts.
+
+        Returns:
+        - items (Dict[int, np.ndarray]): The (len(user_ids), N) item codes recommend_batch returns, per N.
+        """
+        items, _, distinct = self._recommend_batch(user_ids, item_ids, max(Ns), w1, w2, K, encoded, weights)
+        prefixes = {}
+        for N in Ns:
+            prefix = items[:, :N].copy()
+            prefix[distinct <= N] = -1
+            prefixes[N] = prefix
+        return prefixes
+
+    def _recommend_batch(self, user_ids, item_ids, N, w1, w2, K, encoded, weights=None):
+        # Reranked (B, N) lists of every row and its number of distinct candidates, 0 for rows missing candidates
+        if not encoded:
+            user_ids = self.ALS.vocabulary.profiles.encode(user_ids)
+            item_ids = self.ALS.vocabulary.items.encode(item_ids)
+        if self.cache is not None:
+            als_items, als_scores = self.cache.als(user_ids, N=K)
+            mc_items, mc_scores = self.cache.mc_batch(item_ids, N=K)
+        else:
+            als_items, als_scores = self.ALS.recommend_batch(user_ids, N=K, encoded=True)
+            mc_items, mc_scores = self.MC.recommend_batch(item_ids, N=K, encoded=True)
+
+        # Same checks, in the same order, as _get_recs
+        als_count = (als_items >= 0).sum(axis=1)
+        mc_count = (mc_items >= 0).sum(axis=1)
+        missing_cf = als_count == 0
+        missing_bridge = ~missing_cf & (mc_count == 0)
+        not_enough_cf = ~missing_cf & ~missing_bridge & (als_count < K)
+        not_enough_bridge = ~missing_cf & ~missing_bridge & ~not_enough_cf & (mc_count < K)
+        weights = np.ones(len(als_items), dtype=np.int64) if weights is None else np.asarray(weights)
+        self.missing_cf_count += int(weights[missing_cf].sum())
+        self.missing_bridge_count += int(weights[missing_bridge].sum())
+        self.not_enough_cf_count += int(weights[not_enough_cf].sum())
+        self.not_enough_bridge_count += int(weights[not_enough_bridge].sum())
+        complete = np.flatnonzero(~(missing_cf | missing_bridge | not_enough_cf | not_enough_bridge))
+
+        items = np.full((len(als_items), N), -1, dtype=np.int64)
+        scores = np.full((len(als_items), N), -np.inf)
+        distinct = np.zeros(len(als_items), dtype=np.int64)
+        if len(complete) == 0:
+            return items, scores, distinct
+        # Min-max normalization of the ALS scores, as in ALS.to_recommendation
+        als_scores = als_scores[complete]
+        if K > 1:
+            low, high = als_scores.min(axis=1, keepdims=True), als_scores.max(axis=1, keepdims=True)
+            als_scores = (als_scores - low) / (high - low)
+        else:
+            als_scores = np.ones_like(als_scores)
+        # Lists longer than all candidates are never valid, only the candidates are ranked
+        n = min(N, 2 * K)
+        items[complete, :n], scores[complete, :n], distinct[complete] = self.rerank_batch(
+            als_items[complete], als_scores, mc_items[complete], mc_scores[complete], w1, w2, n)
+        return items, scores, distinct
+
+    @timings.timed("hseq.rerank_batch", batch=True)
+    def rerank_batch(self, als_ids, als_scores, mc_ids, mc_scores, w1, w2, N):
+        """
+        Vectorized version of _rerank over B candidate lists given as vocabulary item codes.
+
+        Parameters:
+        - als_ids, als_scores (np.ndarray): (B, K) ALS candidate item codes and min-max normalized scores.
+        - mc_ids, mc_scores (np.ndarray): (B, K) MC candidate codes and scores.
+        - w1 (float): The weight for the collaborative filtering score.
+        - w2 (float): The weight for the mc score.
+        - N (int): The number of recommendations to keep, at most 2 * K.
+
+        Returns:
+        - items (np.ndarray): (B, N) reranked item codes.
+        - scores (np.ndarray): (B, N) reranked scores.
+        - distinct (np.ndarray): (B,) number of distinct candidates, _rerank returns None where it is N or less.
+        """
+        B, K = als_ids.shape
+        # softmax on both the CF and bridge scores
+        als_scores = w1 * softmax(als_scores)
+        mc_scores = w2 * softmax(mc_scores)
+
+        # Overlap detection: offset the codes of every row into their own range and binary search
+        width = max(als_ids.max(), mc_ids.max()) + 2
+        offsets = np.arange(B, dtype=np.int64)[:, None] * width
+        mc_keys = (mc_ids + 1 + offsets).ravel()
+        mc_order = np.argsort(mc_keys, kind='stable')
+        als_keys = (als_ids + 1 + offsets).ravel()
+        position = np.minimum(np.searchsorted(mc_keys[mc_order], als_keys), len(mc_keys) - 1)
+        overlap = mc_keys[mc_order[position]] == als_keys
+        match = mc_order[position[overlap]]
+
+        # ALS items get the weighted bridge score added, overlapping bridge items are dropped
+        als_scores = als_scores.ravel()
+        als_scores[overlap] = als_scores[overlap] + mc_scores.ravel()[match]
+        mc_scores = mc_scores.ravel()
+        mc_scores[match] = -np.inf
+        candidates = np.concatenate([als_ids, mc_ids], axis=1)
+        candidate_scores = np.concatenate([als_scores.reshape(B, K), mc_scores.reshape(B, -1)], axis=1)
+        candidate_scores[np.isnan(candidate_scores)] = -np.inf
+        distinct = 2 * K - overlap.reshape(B, K).sum(axis=1)
+
+        # Select the top N without a full sort; ties at the cut keep their candidate order like a stable sort
+        negative = -candidate_scores
+        kth = np.partition(negative, N - 1, axis=1)[:, N - 1:N]
+        better = negative < kth
+        tied = negative == kth
+        chosen = better | (tied & (np.cumsum(tied, axis=1) <= N - better.sum(axis=1, keepdims=True)))
+        selected = np.nonzero(chosen)[1].reshape(B, N)
+        order = np.argsort(np.take_along_axis(negative, selected, axis=1), axis=1, kind='stable')
+        selected = np.take_along_axis(selected, order, axis=1)
+        return np.take_along_axis(candidates, selected, axis=1), np.take_along_axis(candidate_scores, selected, axis=1), distinct
+
     def _get_recs(self, user_id, item_id, N, K):
         # WE CONSIDER K
-        als_recs = self.ALS.recommend_standard(user_id, N=K)
+        return self._check_recs(self.ALS.recommend_standard(user_id, N=K), item_id, K)
+
+    def _check_recs(self, als_recs, item_id, K):
         if als_recs is None:
             self.missing_cf_count += 1
             return None, None
 
         # WE CONSIDER K
-        mc_recs = self.MC.recommend_standard(item_id, N=K)
+        mc_recs = self.cache.mc(item_id, N=K) if self.cache is not None else self.MC.recommend_standard(item_id, N=K)
         if mc_recs is None:
             self.missing_bridge_count += 1
             return None, None
@@ -55,6 +210,7 @@ class HSEQ:
             return None, None
         return als_recs, mc_recs
 
+    @timings.timed("hseq._rerank")
     def _rerank(self, user_id: str, item_id: str, als_recs: Recommendation, mc_recs: Recommendation, w1: float, w2: float, N: int) -> Recommendation:
         recs = Recommendation(user_id=user_id, item_id=item_id, items_map={}, items=[], item_ids=[])
         # we perform softmax on both the CF and bridge scores
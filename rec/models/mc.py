@@ -1,35 +1,172 @@
-import pyarrow.parquet as pq
-import glob
+import os
 import pandas as pd
 import numpy as np
 import logging
 from rec.types.types import Recommendation, RecommendedItem
+from rec.utils.vocabulary import Vocabulary
+from rec.utils.dataset import read_table, SESSION_COLUMNS
+from rec.utils.arrays import save_arrays, load_arrays, save_params, load_params
+from rec.utils.timing import timings
+
+# Scoring columns produced by MC.fit, each can be selected with MC.change_method
+METHODS = ['frequencyScore', 'frequencyScoreNormalized', 'frequencyScoreNormalizedLog2',
+           'frequencyScoreNormalizedLog10', 'rankScaledScoreLin', 'rankScaledScoreLog']
+
+
+class TransitionIndex:
+    """
+    CSR layout of the transition table over vocabulary item codes. The outgoing transitions of the
+    source item with code c live in offsets[c]:offsets[c + 1]; for every method next_codes[method]
+    and scores[method] hold the target codes and float32 scores of each source, sorted by descending score.
+    """
+    def __init__(self, offsets, next_codes, scores):
+        self.offsets = offsets
+        self.next_codes = next_codes
+        self.scores = scores
+
+    @classmethod
+    def from_counts(cls, data, vocabulary, minScore=0.1, maxScore=1.0, bridgeThresholds=2):
+        """
+        Scores aggregated (itemId, nextItemId, count) rows with every method in one pass.
+
+        Rows are sorted once by source and descending count, per-source sums, extremes and lengths follow
+        from the segment boundaries, and every method is computed on the sorted arrays and stored as float32.
+        All methods increase with the count (or its rank) within a source, so the one order and target
+        array serve all of them.
+        """
+        # Only distinct IDs are encoded; sources with fewer transitions than the bridge threshold are
+        # dropped first, so the vocabulary grows exactly as when encoding the kept rows
+        local, sources = pd.factorize(data['itemId'], use_na_sentinel=False)
+        kept = np.bincount(local, minlength=len(sources)) >= bridgeThresholds
+        keep = kept[local]
+        codes = np.full(len(sources), -1, dtype=np.int32)
+        codes[kept] = vocabulary.items.encode(sources[kept], add=True)
+        source = codes[local[keep]]
+        local, targets = pd.factorize(data['nextItemId'][keep], use_na_sentinel=False)
+        target = vocabulary.items.encode(targets, add=True)[local]
+        count = data['count'].to_numpy(dtype=np.float64)[keep]
+        # Ties keep the table order, like rank(method='first')
+        order = np.lexsort((-count, source))
+        target, count = target[order], count[order]
+        lengths = np.bincount(source, minlength=len(vocabulary.items))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        starts = offsets[:-1][lengths > 0]
+        segment = np.repeat(np.arange(len(starts)), lengths[lengths > 0])
+        items = lengths[lengths > 0][segment].astype(np.float64)
+        rank = np.arange(len(count)) - starts[segment] + 1
+        total = np.add.reduceat(count, starts)[segment] if len(starts) else count
+        # Counts are sorted descending within a source: the first is the maximum, the last the minimum
+        high = count[starts][segment]
+        low = count[offsets[1:][lengths > 0] - 1][segment]
+        spread = maxScore - minScore
+        scores = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores['frequencyScore'] = (count / total).astype(np.float32)
+            scores['frequencyScoreNormalized'] = (minScore + (count / high) * spread).astype(np.float32)
+            for method, log in (('frequencyScoreNormalizedLog2', np.log2), ('frequencyScoreNormalizedLog10', np.log10)):
+                log_low = log(low + 1)
+                scores[method] = (((log(count + 1) - log_low) / (log(high + 1) - log_low) * spread) + minScore).astype(np.float32)
+            scores['rankScaledScoreLin'] = (minScore + ((items - rank) * spread / (items - 1))).astype(np.float32)
+            scores['rankScaledScoreLog'] = (minScore * np.exp((items - rank) * np.log(maxScore / minScore) /
+                                                              (items - 1))).astype(np.float32)
+        return cls(offsets, {method: target for method in METHODS}, scores)
+
+    def to_arrays(self):
+        arrays = {'offsets': self.offsets}
+        for method in self.scores:
+            arrays[f'next_codes.{method}'] = self.next_codes[method]
+            arrays[f'scores.{method}'] = self.scores[method]
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        methods = [name[len('scores.'):] for name in arrays if name.startswith('scores.')]
+        return cls(arrays['offsets'],
+                   {method: arrays[f'next_codes.{method}'] for method in methods},
+                   {method: arrays[f'scores.{method}'] for method in methods})
+
+    def _ranges(self, codes):
+        # Start and end of the transitions of every code, codes the index doesn't know get empty ranges
+        codes = np.asarray(codes, dtype=np.int64)
+        starts = np.zeros(len(codes), dtype=np.int64)
+        ends = np.zeros(len(codes), dtype=np.int64)
+        known = (codes >= 0) & (codes < len(self.offsets) - 1)
+        starts[known] = self.offsets[codes[known]]
+        ends[known] = self.offsets[codes[known] + 1]
+        return starts, ends
+
+    def lookup(self, code, method, N=-1):
+        # Top N (all for N -1) (code, score) slices of one source item, empty when the item has no transitions
+        (start,), (end,) = self._ranges([code])
+        end = end if N < 0 else min(end, start + N)
+        return self.next_codes[method][start:end], self.scores[method][start:end]
+
+    def lookup_batch(self, codes, method, N):
+        # (len(codes), N) top codes and scores, padded with -1 / -inf
+        starts, ends = self._ranges(codes)
+        columns = np.arange(N)
+        valid = columns[None, :] < np.minimum(ends - starts, N)[:, None]
+        positions = np.where(valid, starts[:, None] + columns[None, :], 0)
+        items = np.full((len(starts), N), -1, dtype=np.int32)
+        scores = np.full((len(starts), N), -np.inf, dtype=np.float32)
+        if valid.any():
+            items[valid] = self.next_codes[method][positions[valid]]
+            scores[valid] = self.scores[method][positions[valid]]
+        return items, scores
+
+    def merge(self, other, sources):
+        """
+        A new index with the transitions of the given source codes taken from other and those of
+        every other source from this index. other must cover at least the codes of this index.
+        """
+        size = len(other.offsets) - 1
+        starts = np.zeros(size, dtype=np.int64)
+        lengths = np.zeros(size, dtype=np.int64)
+        known = len(self.offsets) - 1
+        starts[:known] = self.offsets[:-1]
+        lengths[:known] = np.diff(self.offsets)
+        # Positions of other's transitions in the concatenation of both indexes
+        sources = np.asarray(sources, dtype=np.int64)
+        starts[sources] = other.offsets[sources] + self.offsets[-1]
+        lengths[sources] = np.diff(other.offsets)[sources]
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        next_codes = {method: np.concatenate([self.next_codes[method], other.next_codes[method]])[positions]
+                      for method in self.scores}
+        scores = {method: np.concatenate([self.scores[method], other.scores[method]])[positions]
+                  for method in self.scores}
+        return TransitionIndex(offsets, next_codes, scores)
+
+    def has_transitions(self, code):
+        start, end = self._ranges([code])
+        return bool(end[0] > start[0])
+
+    def nbytes(self):
+        # Methods may share one target array, see from_counts
+        targets = {id(a): a for a in self.next_codes.values()}
+        return self.offsets.nbytes + sum(a.nbytes for a in targets.values()) + sum(a.nbytes for a in self.scores.values())
+
 
 class MC():
-    def __init__(self, minScore=0.1, maxScore=1.0, bridgeThresholds=2, method='frequencyScoreNormalized', logger=None):
+    def __init__(self, minScore=0.1, maxScore=1.0, bridgeThresholds=2, method='frequencyScoreNormalized', logger=None, vocabulary=None):
         self.logger = logger
         self.logger.name = "MC"
+        # Shared with ALS and the evaluator, so all of them agree on item codes
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
         self.method = method
         self.minScore = minScore
         self.maxScore = maxScore
         self.bridgeThresholds = bridgeThresholds
-        self.model = None
+        self.index = None
         self.data = None
+        # Aggregated (itemId, nextItemId, count) rows before the bridge threshold, kept for partial_fit
+        self.counts = None
 
-    def load_data(self, path, nested=False, limit=-1):
-        i = 0
-        if nested:
-            dfs = []
-            for file in glob.glob(path + "/**/*.parquet", recursive=True):
-                if i > limit and limit != -1:
-                    break
-                df = pq.read_table(file).to_pandas()
-                # print("Loaded file: " + file + " with shape: " + str(df.shape))
-                dfs.append(df)
-                i += 1
-            self.data = pd.concat(dfs, ignore_index=True)
-        else:
-            self.data = pq.read_table(path).to_pandas()
+    def load_data(self, path, nested=False, limit=-1, filter=None):
+        self.data = read_table(path, SESSION_COLUMNS, nested, limit, filter, self.logger).to_pandas()
 
     def remove_self_links(self):
         self.logger.debug("Removing self-links...")
@@ -39,96 +176,125 @@ class MC():
         self.logger.debug("Aggregating counts...")
         self.data = self.data.groupby(['itemId', 'nextItemId']).agg(count=('count', 'sum')).reset_index()
 
-    def calculate_frequency_score(self):
-        self.logger.debug("Calculating frequency score...")
-        self.data['sumCount'] = self.data.groupby('itemId')['count'].transform('sum')
-        self.data['maxCount'] = self.data.groupby('itemId')['count'].transform('max')
-        self.data['minCount'] = self.data.groupby('itemId')['count'].transform('min')
-        self.data['numItems'] = self.data.groupby('itemId')['itemId'].transform('count')
-        self.data = self.data[self.data['numItems'] >= self.bridgeThresholds]
-        self.data['frequencyScore'] = self.data['count'] / self.data['sumCount']
-
-    def log_transformation(self):
-        self.logger.debug("Performing log transformation...")
-        self.data['log2TransformedCount'] = np.log2(self.data['count'] + 1)
-        self.data['log10TransformedCount'] = np.log10(self.data['count'] + 1)
-        self.data['minLog2Score'] = self.data.groupby('itemId')['log2TransformedCount'].transform('min')
-        self.data['maxLog2Score'] = self.data.groupby('itemId')['log2TransformedCount'].transform('max')
-        self.data['minLog10Score'] = self.data.groupby('itemId')['log10TransformedCount'].transform('min')
-        self.data['maxLog10Score'] = self.data.groupby('itemId')['log10TransformedCount'].transform('max')
-
-    def linear_normalization(self):
-        self.logger.debug("Performing linear normalization...")
-        self.data['frequencyScoreNormalized'] = self.minScore + (self.data['count'] / self.data['maxCount']) * (self.maxScore - self.minScore)
-
-    def log_normalization(self):
-        self.logger.debug("Performing log normalization...")
-        self.data['frequencyScoreNormalizedLog2'] = ((self.data['log2TransformedCount'] - self.data['minLog2Score']) /
-                                                     (self.data['maxLog2Score'] - self.data['minLog2Score']) *
-                                                     (self.maxScore - self.minScore)) + self.minScore
-        self.data['frequencyScoreNormalizedLog10'] = ((self.data['log10TransformedCount'] - self.data['minLog10Score']) /
-                                                      (self.data['maxLog10Score'] - self.data['minLog10Score']) *
-                                                      (self.maxScore - self.minScore)) + self.minScore
-
-    def rank_and_score(self):
-        self.logger.debug("Ranking and scoring...")
-        self.data['rank'] = self.data.groupby('itemId')['frequencyScore'].rank(method='first', ascending=False)
-        self.data['rankScaledScoreLin'] = (self.minScore +
-                                           ((self.data['numItems'] - self.data['rank']) *
-                                            (self.maxScore - self.minScore) / (self.data['numItems'] - 1)))
-        self.data['rankScaledScoreLog'] = (self.minScore *
-                                           np.exp((self.data['numItems'] - self.data['rank']) *
-                                                  np.log(self.maxScore / self.minScore) / (self.data['numItems'] - 1)))
-    def set_data_to_dict(self):
-        self.model = {}
-        for row in self.data.to_dict(orient='records'):
-            if row['itemId'] not in self.model:
-                self.model[row['itemId']] = []
-            self.model[row['itemId']].append((row['nextItemId'], row[self.method]))
-        for key in self.model:
-            self.model[key] = sorted(self.model[key], key=lambda x: x[1], reverse=True)
+    @classmethod
+    def from_index(cls, index, vocabulary, method='frequencyScoreNormalized', logger=None):
+        """An MC model around an already built TransitionIndex, e.g. one backed by memory-mapped arrays."""
+        mc = cls(method=method, logger=logger, vocabulary=vocabulary)
+        mc.index = index
+        return mc
+
+    def save(self, path):
+        """Saves the transition index as .npy files (and the vocabulary) that load can memory-map."""
+        save_arrays(self.index.to_arrays(), path)
+        if self.counts is not None:
+            save_arrays({column: self.counts[column].to_numpy() for column in SESSION_COLUMNS}, os.path.join(path, "counts"))
+        save_params({'method': self.method, 'minScore': self.minScore, 'maxScore': self.maxScore,
+                     'bridgeThresholds': self.bridgeThresholds}, path)
+        self.vocabulary.save(os.path.join(path, "vocabulary"))
+
+    @classmethod
+    def load(cls, path, mmap=True, logger=None, vocabulary=None):
+        """
+        Loads a model written by save without refitting.
+
+        Parameters:
+        - path (str): The directory passed to save.
+        - mmap (bool): Memory-map the arrays read-only instead of reading them into memory.
+        - logger (logging.Logger): The logger of the model.
+        - vocabulary (Vocabulary): Vocabulary to share with other loaded models, see Vocabulary.load.
+        """
+        params = load_params(path)
+        mc = cls(params['minScore'], params['maxScore'], params['bridgeThresholds'], params['method'],
+                 logger=logger or logging.getLogger(__name__),
+                 vocabulary=Vocabulary.load(os.path.join(path, "vocabulary"), vocabulary))
+        mc.index = TransitionIndex.from_arrays(load_arrays(path, mmap))
+        if os.path.isdir(os.path.join(path, "counts")):
+            mc.counts = pd.DataFrame(load_arrays(os.path.join(path, "counts"), mmap=False))[SESSION_COLUMNS]
+        return mc
 
     def change_method(self, method):
+        if method not in METHODS:
+            raise ValueError(f"Method must be one of {METHODS}")
         self.method = method
-        self.set_data_to_dict()
 
-    def fit(self, path, nested=False, limit=-1):
-        self.load_data(path, nested, limit)
+    def fit(self, path, nested=False, limit=-1, filter=None):
+        self.load_data(path, nested, limit, filter)
         self.remove_self_links()
         self.aggregate_counts()
-        self.calculate_frequency_score()
-        self.log_transformation()
-        self.linear_normalization()
-        self.log_normalization()
-        self.rank_and_score()
-        self.set_data_to_dict()
+        self.counts = self.data[SESSION_COLUMNS]
+        self.index = self._score_index(self.data)
         self.logger.debug("Model fitting completed.")
 
+    def _score_index(self, data):
+        self.logger.debug("Scoring transitions...")
+        index = TransitionIndex.from_counts(data, self.vocabulary, self.minScore, self.maxScore, self.bridgeThresholds)
+        self.logger.debug(f"Transition index uses {index.nbytes() / 1024 ** 2:.1f} MB.")
+        return index
+
+    def partial_fit(self, new_files, filter=None):
+        """
+        Adds new session data to a fitted model without refitting on the full history.
+
+        The new (itemId, nextItemId, count) rows are aggregated and merged into the stored counts.
+        All scores are per source item, so only the sources with new rows are rescored and replaced
+        in the transition index; the result is the same as fitting on the old and new data together.
+
+        Parameters:
+        - new_files (List[str]): The new Parquet files.
+        - filter (pyarrow.dataset.Expression): Optional row filter, see rec.utils.dataset.date_filter.
+        """
+        if self.counts is None or self.index is None:
+            raise ValueError("partial_fit needs a model fitted with fit or loaded with its counts")
+        self.load_data(list(new_files), filter=filter)
+        self.remove_self_links()
+        self.aggregate_counts()
+        changed = self.counts['itemId'].isin(self.data['itemId'].unique())
+        self.data = pd.concat([self.counts[changed], self.data], ignore_index=True)
+        self.aggregate_counts()
+        sources = self.vocabulary.items.encode(self.data['itemId'].unique(), add=True)
+        self.counts = pd.concat([self.counts[~changed], self.data], ignore_index=True)
+        self.logger.debug(f"Rescoring {len(sources)} source items with {len(self.data)} transitions...")
+        self.index = self.index.merge(self._score_index(self.data), sources)
+
     def recommend(self, itemId):
-        result = self.model[self.model['itemId'] == str(itemId)].sort_values('frequencyScore', ascending=False)
-        if result.empty:
-            return None
-        else:
-            return result
+        """Every transition of itemId by frequencyScore, see recommend_items."""
+        return self.recommend_items(itemId, 'frequencyScore', -1)
 
     def recommend_items(self, itemId, method, K):
-        result = self.model[self.model['itemId'] == str(itemId)].sort_values(method, ascending=False).head(K)
-        if result.empty:
+        """The top K (all for K -1) transitions of itemId by method as an itemId, nextItemId, method frame, None when it has none."""
+        codes, scores = self.index.lookup(self.vocabulary.items.code(itemId), method, K)
+        if len(codes) == 0:
             return None
-        else:
-            return result[['itemId', 'nextItemId', method]]
+        return pd.DataFrame({'itemId': itemId, 'nextItemId': self.vocabulary.items.decode(codes), method: scores})
 
     def has_item(self, itemId):
-        return str(itemId) in self.model.keys()
+        return self.index.has_transitions(self.vocabulary.items.code(itemId))
+
+    @timings.timed("mc.recommend_batch", batch=True)
+    def recommend_batch(self, item_ids, N=5, encoded=False):
+        """
+        Looks up the top N next items for every item in item_ids.
+
+        Parameters:
+        - item_ids (iterable): Raw item IDs, or vocabulary item codes when encoded is set.
+        - N (int): The number of next items per item.
+        - encoded (bool): Whether item_ids are already vocabulary codes.
+
+        Returns:
+        - items (np.ndarray): (len(item_ids), N) int32 vocabulary item codes, padded with -1.
+        - scores (np.ndarray): (len(item_ids), N) float32 scores, padded with -inf.
+        """
+        codes = item_ids if encoded else self.vocabulary.items.encode(item_ids)
+        return self.index.lookup_batch(codes, self.method, N)
 
+    @timings.timed("mc.recommend_standard")
     def recommend_standard(self, itemId, N=-1) -> Recommendation:
         recs = Recommendation(item_id=itemId, user_id=None, items_map={}, items=[], item_ids=[])
-        result = self.model.get(str(itemId), None)
-        if not result:
+        codes, scores = self.index.lookup(self.vocabulary.items.code(itemId), self.method, N)
+        if len(codes) == 0:
             return None
-        else:
-            for row in result[:N]:
-                r = RecommendedItem(row[0], row[1], "BR")
-                recs.items_map[r.item_id] = r
-                recs.items.append(r)
-            return recs
+        for next_item_id, score in zip(self.vocabulary.items.decode(codes), scores):
+            r = RecommendedItem(next_item_id, score, "BR")
+            recs.items_map[r.item_id] = r
+            recs.items.append(r)
+        return recs
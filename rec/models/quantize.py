@@ -0,0 +1,69 @@
+import time
+import logging
+import numpy as np
+from rec.evaluator.metrics import compute_metrics, overlap
+
+# Storage precisions of ALS factors, see ALS.quantize
+PRECISIONS = ['float32', 'float16', 'int8']
+
+
+def quantize(factors, precision):
+    """
+    Converts float32 factors to a storage precision.
+
+    Returns:
+    - factors (np.ndarray): The factors as float32, float16 or int8.
+    - scales (np.ndarray): The float32 scale of every int8 row (row = int8 row * scale), None otherwise.
+    """
+    factors = np.asarray(factors, dtype=np.float32)
+    if precision == 'float32':
+        return factors, None
+    if precision == 'float16':
+        return factors.astype(np.float16), None
+    if precision == 'int8':
+        scales = np.abs(factors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        return np.rint(factors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+
+
+def dequantize(factors, scales, rows=slice(None)):
+    """float32 values of the given rows of quantized factors, float32 factors are returned as they are."""
+    values = np.asarray(factors[rows], dtype=np.float32)
+    return values if scales is None else values * scales[rows, None]
+
+
+def precision_report(als, user_ids, next_item_ids, N=10, precisions=('float16', 'int8'), logger=None):
+    """
+    Compares the recommendations of a float32 ALS model to copies of it quantized to other precisions.
+
+    Parameters:
+    - als (ALS): A fitted float32 model, it is left unchanged.
+    - user_ids (iterable): Raw profile IDs of the test rows, e.g. profile_id of the test set.
+    - next_item_ids (iterable): Raw IDs of the item watched next in every test row.
+    - N (int): The length of the recommendation lists.
+    - precisions (List[str]): The precisions to compare, see PRECISIONS.
+
+    Returns:
+    - report (List[dict]): Per precision (float32 first) the bytes of the factors, MRR (accuracy), CTR
+      (avgctr) and MAP of the top N lists, their overlap with the float32 top N and the milliseconds per user.
+    """
+    logger = logger or logging.getLogger("quantize")
+    profiles = als.vocabulary.profiles.encode(user_ids)
+    targets = als.vocabulary.items.encode(next_item_ids)
+    arrays = {name: array for name, array in als.to_arrays().items() if not name.startswith(('candidate_', 'index.'))}
+    report, reference = [], None
+    for precision in ['float32'] + [precision for precision in precisions if precision != 'float32']:
+        model = type(als).from_arrays(arrays, als.vocabulary, logger=als.logger)
+        if precision != 'float32':
+            model.quantize(precision)
+        start = time.perf_counter()
+        recs, _ = model.recommend_batch(profiles, N=N, encoded=True, exact=True)
+        ms = (time.perf_counter() - start) * 1000 / len(profiles)
+        reference = recs if reference is None else reference
+        metrics = compute_metrics(recs, targets, profiles, items_count=len(model.item_codes))
+        report.append(dict(precision=precision, factor_bytes=model.factor_bytes(), accuracy=metrics['accuracy'],
+                           avgctr=metrics['avgctr'], map=metrics['map'], overlap=overlap(recs, reference), ms_per_user=ms))
+        logger.info(f"{precision:>8} {report[-1]['factor_bytes'] / 1024 ** 2:8.1f} MB MRR {metrics['accuracy']:.4f} "
+                    f"CTR {metrics['avgctr']:.4f} overlap@{N} {report[-1]['overlap']:.4f} {ms:.3f} ms/user")
+    return report
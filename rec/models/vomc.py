@@ -0,0 +1,370 @@
+import os
+import time
+import logging
+import numpy as np
+import pandas as pd
+from rec.types.types import Recommendation, RecommendedItem
+from rec.utils.vocabulary import Vocabulary
+from rec.utils.dataset import read_table
+from rec.utils.arrays import save_arrays, load_arrays, save_params, load_params
+from rec.utils.timing import timings
+
+# Contexts are scored by their relative frequency, the only method the back-off combines
+METHODS = ['frequencyScore']
+
+
+def _runs(*columns):
+    # Start of every run of equal rows in sorted columns
+    change = np.zeros(len(columns[0]), dtype=bool)
+    change[:1] = True
+    for column in columns:
+        change[1:] |= column[1:] != column[:-1]
+    return np.flatnonzero(change)
+
+
+class ContextIndex:
+    """
+    Suffix index of the contexts of a variable-order Markov chain over vocabulary item codes.
+
+    The contexts of order k (the last k items of a session, oldest first) are packed into one int64 key,
+    bits per item, and kept in the sorted array keys[k]; like TransitionIndex the transitions of the
+    context keys[k][i] live in offsets[k][i]:offsets[k][i + 1] of next_codes[k] and scores[k], sorted by
+    descending score. A lookup is one binary search per order instead of a dict of tuples.
+    """
+    def __init__(self, keys, offsets, next_codes, scores, bits, items):
+        self.keys = keys
+        self.offsets = offsets
+        self.next_codes = next_codes
+        self.scores = scores
+        self.bits = bits
+        # Codes from items on were added to the vocabulary after fitting and have no contexts
+        self.items = items
+
+    @property
+    def max_order(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_sequences(cls, sessions, codes, items, max_order=3, min_count=2, min_support=5, max_next=100):
+        """
+        Counts the transitions of every context of order 1 to max_order in session-ordered events.
+
+        Repeated events of the same item are collapsed first, like MC.remove_self_links. Orders above 1
+        are pruned: transitions seen fewer than min_count times and contexts seen fewer than min_support
+        times are dropped and a context keeps at most its max_next most frequent transitions. Scores are
+        count / context count, with the context count taken before pruning.
+
+        Parameters:
+        - sessions (np.ndarray): Session of every event, events of a session are contiguous and in order.
+        - codes (np.ndarray): Vocabulary item code of every event.
+        - items (int): The size of the vocabulary, codes are below it.
+        """
+        keep = np.ones(len(codes), dtype=bool)
+        keep[1:] = (codes[1:] != codes[:-1]) | (sessions[1:] != sessions[:-1])
+        sessions, codes = sessions[keep], codes[keep].astype(np.int64)
+        bits = max(1, int(items - 1).bit_length())
+        if bits * max_order > 63:
+            raise ValueError(f"{items} items need {bits} bits per code, contexts of order {max_order} don't fit in int64")
+
+        keys, offsets, next_codes, scores = [], [], [], []
+        context = codes.copy()
+        for k in range(1, max_order + 1):
+            if k > 1:
+                # The key of the context ending before event i: the one of order k - 1 shifted by the item k back
+                context = (codes[:-k + 1] << (bits * (k - 1))) | context[1:]
+            valid = sessions[k:] == sessions[:len(sessions) - k]
+            source, target = context[:len(codes) - k][valid], codes[k:][valid]
+            order = np.lexsort((target, source))
+            source, target = source[order], target[order]
+            starts = _runs(source, target)
+            count = np.diff(np.append(starts, len(source)))
+            source, target = source[starts], target[starts]
+            contexts = _runs(source)
+            total = np.add.reduceat(count, contexts) if len(contexts) else count
+            total = np.repeat(total, np.diff(np.append(contexts, len(source))))
+            # Most frequent first within a context, ties by item code
+            order = np.lexsort((target, -count, source))
+            source, target, count, total = source[order], target[order], count[order], total[order]
+            if k > 1:
+                rank = np.arange(len(source)) - np.repeat(contexts, np.diff(np.append(contexts, len(source))))
+                kept = (count >= min_count) & (total >= min_support) & (rank < max_next)
+                source, target, count, total = source[kept], target[kept], count[kept], total[kept]
+            contexts = _runs(source)
+            keys.append(source[contexts])
+            offsets.append(np.append(contexts, len(source)).astype(np.int64))
+            next_codes.append(target.astype(np.int32))
+            scores.append((count / total).astype(np.float32))
+        return cls(keys, offsets, next_codes, scores, bits, items)
+
+    def to_arrays(self):
+        arrays = {'bits': np.array(self.bits), 'items': np.array(self.items)}
+        for k in range(self.max_order):
+            arrays.update({f'keys.{k + 1}': self.keys[k], f'offsets.{k + 1}': self.offsets[k],
+                           f'next_codes.{k + 1}': self.next_codes[k], f'scores.{k + 1}': self.scores[k]})
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        orders = range(1, len([name for name in arrays if name.startswith('keys.')]) + 1)
+        return cls([arrays[f'keys.{k}'] for k in orders], [arrays[f'offsets.{k}'] for k in orders],
+                   [arrays[f'next_codes.{k}'] for k in orders], [arrays[f'scores.{k}'] for k in orders],
+                   int(arrays['bits']), int(arrays['items']))
+
+    def _find(self, contexts, k):
+        # Position of the order k context ending every row of contexts in keys[k], -1 when there is none
+        last = contexts[:, contexts.shape[1] - k:]
+        known = ((last >= 0) & (last < self.items)).all(axis=1)
+        keys = np.zeros(len(contexts), dtype=np.int64)
+        for column in range(k):
+            keys = (keys << self.bits) | np.maximum(last[:, column], 0)
+        position = np.minimum(np.searchsorted(self.keys[k - 1], keys), max(len(self.keys[k - 1]) - 1, 0))
+        found = known & (len(self.keys[k - 1]) > 0)
+        found[found] = self.keys[k - 1][position[found]] == keys[found]
+        return np.where(found, position, -1)
+
+    def lookup(self, code, method, N=-1):
+        # Top N (code, score) slices of the order 1 context of one item, see TransitionIndex.lookup; a
+        # single item has no longer context to back off from and every context is scored by method
+        if method not in METHODS:
+            raise ValueError(f"Method must be one of {METHODS}")
+        position = self._find(np.array([[code]], dtype=np.int64), 1)[0]
+        if position < 0:
+            return self.next_codes[0][:0], self.scores[0][:0]
+        start, end = self.offsets[0][position], self.offsets[0][position + 1]
+        end = end if N < 0 else min(end, start + N)
+        return self.next_codes[0][start:end], self.scores[0][start:end]
+
+    def lookup_batch(self, contexts, N, alpha=0.4):
+        """
+        Top N next items of every context with stupid back-off: candidates of the longest matching order h
+        keep their scores, those of a lower order k that are not already candidates get alpha^(h - k) times theirs.
+
+        Parameters:
+        - contexts (np.ndarray): (B, L) item codes of the last L items of every session, most recent last,
+          left-padded with -1.
+        - N (int): The number of next items per context.
+        - alpha (float): The back-off weight per order.
+
+        Returns:
+        - items (np.ndarray): (B, N) int32 item codes, padded with -1.
+        - scores (np.ndarray): (B, N) float32 scores, padded with -inf.
+        - orders (np.ndarray): (B,) longest matching order of every context, 0 for none.
+        """
+        contexts = np.asarray(contexts, dtype=np.int64).reshape(len(contexts), -1)
+        B = len(contexts)
+        orders = np.zeros(B, dtype=np.int64)
+        candidates, candidate_scores, columns = [], [], np.arange(N)
+        for k in range(min(self.max_order, contexts.shape[1]), 0, -1):
+            position = self._find(contexts, k)
+            found = position >= 0
+            orders[found & (orders == 0)] = k
+            starts = np.where(found, self.offsets[k - 1][np.maximum(position, 0)], 0)
+            ends = np.where(found, self.offsets[k - 1][np.maximum(position, 0) + 1], 0)
+            valid = columns[None, :] < np.minimum(ends - starts, N)[:, None]
+            positions = np.where(valid, starts[:, None] + columns[None, :], 0)
+            items = np.full((B, N), -1, dtype=np.int32)
+            scores = np.full((B, N), -np.inf, dtype=np.float32)
+            if valid.any():
+                items[valid] = self.next_codes[k - 1][positions[valid]]
+                scores[valid] = self.scores[k - 1][positions[valid]]
+            candidates.append(items)
+            candidate_scores.append(scores * np.float32(alpha) ** np.maximum(orders - k, 0)[:, None].astype(np.float32))
+        if not candidates:
+            return np.full((B, N), -1, dtype=np.int32), np.full((B, N), -np.inf, dtype=np.float32), orders
+        candidates = np.concatenate(candidates, axis=1)
+        candidate_scores = np.concatenate(candidate_scores, axis=1)
+
+        # An item found at several orders keeps its first, highest order, score
+        width = int(max(candidates.max(), 0)) + 2
+        keys = (candidates + 1 + np.arange(B, dtype=np.int64)[:, None] * width).ravel()
+        order = np.argsort(keys, kind='stable')
+        duplicate = np.zeros(len(keys), dtype=bool)
+        duplicate[order[1:]] = (keys[order[1:]] == keys[order[:-1]]) & (candidates.ravel()[order[1:]] >= 0)
+        candidate_scores[duplicate.reshape(B, -1)] = -np.inf
+        top = np.argsort(-candidate_scores, axis=1, kind='stable')[:, :N]
+        scores = np.take_along_axis(candidate_scores, top, axis=1)
+        items = np.where(np.isneginf(scores), -1, np.take_along_axis(candidates, top, axis=1)).astype(np.int32)
+        return items, scores, orders
+
+    def sizes(self):
+        """Per order the number of contexts, transitions and bytes."""
+        return [dict(order=k + 1, contexts=len(self.keys[k]), transitions=len(self.next_codes[k]),
+                     bytes=self.keys[k].nbytes + self.offsets[k].nbytes + self.next_codes[k].nbytes + self.scores[k].nbytes)
+                for k in range(self.max_order)]
+
+    def nbytes(self):
+        return sum(size['bytes'] for size in self.sizes())
+
+
+class VariableOrderMC:
+    """
+    Markov chain over the last max_order items of a session instead of the last one, trained from raw
+    session-ordered events rather than mined (itemId, nextItemId, count) rules.
+
+    Lookups take the longest context the index knows and back off to shorter ones, see
+    ContextIndex.lookup_batch. recommend_batch and recommend_standard follow MC, with the item of a row
+    replaced by the session so far, so the model can be passed to HSEQ in place of MC.
+    """
+    def __init__(self, max_order=3, min_count=2, min_support=5, max_next=100, alpha=0.4, session_column='profileId',
+                 order_column='firstStart', logger=None, vocabulary=None):
+        self.logger = logger or logging.getLogger("VOMC")
+        # Shared with ALS and the evaluator, so all of them agree on item codes
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+        self.method = 'frequencyScore'
+        self.max_order = max_order
+        self.min_count = min_count
+        self.min_support = min_support
+        self.max_next = max_next
+        self.alpha = alpha
+        # Events are grouped into sessions by session_column and ordered by order_column within them,
+        # or taken in file order when order_column is None
+        self.session_column = session_column
+        self.order_column = order_column
+        self.index = None
+        self.data = None
+
+    def load_data(self, path, nested=False, limit=-1, filter=None):
+        columns = [self.session_column, 'itemId'] + ([self.order_column] if self.order_column else [])
+        self.data = read_table(path, columns, nested, limit, filter, self.logger).to_pandas()
+        self.data = self.data.dropna(subset=[self.session_column, 'itemId'])
+
+    def fit(self, path, nested=False, limit=-1, filter=None):
+        """Reads session events (e.g. the viewing data: profileId, itemId, firstStart) and builds the context index."""
+        self.load_data(path, nested, limit, filter)
+        sessions, _ = pd.factorize(self.data[self.session_column])
+        local, ids = pd.factorize(self.data['itemId'])
+        codes = self.vocabulary.items.encode(ids, add=True)[local]
+        if self.order_column:
+            order = np.lexsort((self.data[self.order_column].to_numpy(), sessions))
+            sessions, codes = sessions[order], codes[order]
+        self.data = None
+        self.logger.debug(f"Counting contexts of order 1 to {self.max_order} in {len(codes)} events...")
+        self.index = ContextIndex.from_sequences(sessions, codes, len(self.vocabulary.items), self.max_order,
+                                                 self.min_count, self.min_support, self.max_next)
+        for size in self.index.sizes():
+            self.logger.debug(f"Order {size['order']}: {size['contexts']} contexts, {size['transitions']} transitions, "
+                              f"{size['bytes'] / 1024 ** 2:.1f} MB")
+
+    def params(self):
+        """The constructor parameters of the model, as save writes them."""
+        return {'max_order': self.max_order, 'min_count': self.min_count, 'min_support': self.min_support,
+                'max_next': self.max_next, 'alpha': self.alpha, 'session_column': self.session_column,
+                'order_column': self.order_column}
+
+    @classmethod
+    def from_index(cls, index, vocabulary, logger=None, **params):
+        """A model around an already built ContextIndex, e.g. one backed by memory-mapped arrays, see MC.from_index."""
+        mc = cls(**params, logger=logger, vocabulary=vocabulary)
+        mc.index = index
+        return mc
+
+    def save(self, path):
+        """Saves the context index as .npy files (and the vocabulary) that load can memory-map."""
+        save_arrays(self.index.to_arrays(), path)
+        save_params(self.params(), path)
+        self.vocabulary.save(os.path.join(path, "vocabulary"))
+
+    @classmethod
+    def load(cls, path, mmap=True, logger=None, vocabulary=None):
+        """Loads a model written by save without refitting, see MC.load."""
+        mc = cls(**load_params(path), logger=logger,
+                 vocabulary=Vocabulary.load(os.path.join(path, "vocabulary"), vocabulary))
+        mc.index = ContextIndex.from_arrays(load_arrays(path, mmap))
+        return mc
+
+    def change_method(self, method):
+        if method not in METHODS:
+            raise ValueError(f"Method must be one of {METHODS}")
+        self.method = method
+
+    def contexts(self, sessions, encoded=False):
+        """
+        (B, max_order) item codes of the last max_order items of every session, most recent last and
+        left-padded with -1. A session is a sequence of raw item IDs (or codes when encoded is set), a
+        single item stands for a session of one.
+        """
+        if isinstance(sessions, np.ndarray) and sessions.ndim == 2 and encoded:
+            return sessions[:, -self.max_order:]
+        contexts = np.full((len(sessions), self.max_order), -1, dtype=np.int64)
+        for row, session in enumerate(sessions):
+            session = [session] if np.ndim(session) == 0 else list(session)[-self.max_order:]
+            if session:
+                codes = np.asarray(session) if encoded else self.vocabulary.items.encode(session)
+                contexts[row, self.max_order - len(codes):] = codes
+        return contexts
+
+    def has_item(self, itemId):
+        return bool(self.index.lookup_batch(self.contexts([itemId]), 1, self.alpha)[2][0] > 0)
+
+    @timings.timed("vomc.recommend_batch", batch=True)
+    def recommend_batch(self, sessions, N=5, encoded=False):
+        """
+        Looks up the top N next items for every session, see MC.recommend_batch.
+
+        Parameters:
+        - sessions: Per row the session so far (see contexts), or a (B, L) array of codes when encoded is set;
+          a 1-D array of codes is read as sessions of one item, like MC.
+        - N (int): The number of next items per session.
+        - encoded (bool): Whether sessions are already vocabulary codes.
+
+        Returns:
+        - items (np.ndarray): (B, N) int32 vocabulary item codes, padded with -1.
+        - scores (np.ndarray): (B, N) float32 scores, padded with -inf.
+        """
+        if encoded and np.ndim(sessions) == 1:
+            sessions = np.asarray(sessions)[:, None]
+        items, scores, _ = self.index.lookup_batch(self.contexts(sessions, encoded), N, self.alpha)
+        return items, scores
+
+    @timings.timed("vomc.recommend_standard")
+    def recommend_standard(self, itemId, N=-1) -> Recommendation:
+        """The Recommendation MC.recommend_standard returns, itemId may be a session of raw item IDs."""
+        recs = Recommendation(item_id=itemId, user_id=None, items_map={}, items=[], item_ids=[])
+        # Every transition of every order, as MC returns every transition of an item
+        N = N if N > 0 else sum(int(np.diff(offsets).max(initial=0)) for offsets in self.index.offsets)
+        codes, scores, _ = self.index.lookup_batch(self.contexts([itemId]), N, self.alpha)
+        codes, scores = codes[0][codes[0] >= 0], scores[0][codes[0] >= 0]
+        if len(codes) == 0:
+            return None
+        for next_item_id, score in zip(self.vocabulary.items.decode(codes), scores):
+            r = RecommendedItem(next_item_id, score, "BR")
+            recs.items_map[r.item_id] = r
+            recs.items.append(r)
+        return recs
+
+
+def lookup_report(model, sessions, N=20, encoded=False, single=1000, logger=None):
+    """
+    Index size and lookup latency of a fitted VariableOrderMC.
+
+    Parameters:
+    - model (VariableOrderMC): The model to measure.
+    - sessions: Sessions to look up, see VariableOrderMC.contexts.
+    - N (int): The number of next items per lookup.
+    - single (int): The number of sessions also looked up one at a time, for per-request latency.
+
+    Returns:
+    - report (dict): sizes (per order contexts, transitions and bytes), bytes, the share of lookups answered
+      at every order (0 for none), the milliseconds per session of one batch and the p50 / p99
+      milliseconds of single lookups.
+    """
+    logger = logger or logging.getLogger("vomc")
+    contexts = model.contexts(sessions, encoded)
+    start = time.perf_counter()
+    _, _, orders = model.index.lookup_batch(contexts, N, model.alpha)
+    batch_ms = (time.perf_counter() - start) * 1000 / len(contexts)
+    latencies = []
+    for row in range(min(single, len(contexts))):
+        start = time.perf_counter()
+        model.index.lookup_batch(contexts[row:row + 1], N, model.alpha)
+        latencies.append((time.perf_counter() - start) * 1000)
+    p50, p99 = np.percentile(latencies, [50, 99]) if latencies else (None, None)
+    matched = np.bincount(orders, minlength=model.index.max_order + 1) / max(len(orders), 1)
+    report = dict(sizes=model.index.sizes(), bytes=model.index.nbytes(), matched=matched.tolist(),
+                  batch_ms_per_lookup=batch_ms, p50_ms=p50, p99_ms=p99)
+    for size in report['sizes']:
+        logger.info(f"order {size['order']} {size['contexts']:>10} contexts {size['transitions']:>10} transitions "
+                    f"{size['bytes'] / 1024 ** 2:8.1f} MB, answers {matched[size['order']]:.1%} of lookups")
+    logger.info(f"{report['bytes'] / 1024 ** 2:.1f} MB, {batch_ms:.4f} ms/lookup batched, single lookups p50 "
+                f"{p50:.3f} ms p99 {p99:.3f} ms")
+    return report
@@ -0,0 +1,106 @@
+import json
+import time
+import asyncio
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+
+
+async def _client(host, port, queries, deadline, latencies, errors, params):
+    # One keep-alive connection sending requests back to back until the deadline
+    reader, writer = await asyncio.open_connection(host, port)
+    rng = np.random.default_rng()
+    try:
+        while time.perf_counter() < deadline:
+            user_id, item_id = queries[rng.integers(len(queries))]
+            body = json.dumps(dict(params, user_id=str(user_id), item_id=str(item_id))).encode()
+            start = time.perf_counter()
+            writer.write(f"POST /recommend HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+            status = await reader.readline()
+            length = 0
+            while (header := await reader.readline()) not in (b"\r\n", b""):
+                name, _, value = header.decode().partition(":")
+                if name.lower() == "content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+            if b" 200 " in status:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(status.decode().strip())
+    finally:
+        writer.close()
+
+
+async def run_level(host, port, queries, concurrency, duration, params):
+    """Keeps concurrency requests in flight for duration seconds, returns throughput and latency percentiles."""
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*[_client(host, port, queries, deadline, latencies, errors, params) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000 if latencies else (None, None, None)
+    return dict(concurrency=concurrency, requests=len(latencies), errors=len(errors), requests_per_second=len(latencies) / elapsed,
+                p50_ms=p50, p95_ms=p95, p99_ms=p99)
+
+
+async def load_test(host, port, queries, levels=(1, 8, 32, 128), duration=10, params=None):
+    """
+    Measures throughput against p99 latency of a running service at increasing numbers of concurrent clients.
+
+    Parameters:
+    - host, port: The address of the service.
+    - queries (List[Tuple]): (user_id, item_id) pairs the clients draw their requests from.
+    - levels (List[int]): The numbers of concurrent clients.
+    - duration (float): Seconds every level runs.
+    - params (dict): Further request fields, e.g. N, w1, w2, K and budget_ms.
+    """
+    logger = logging.getLogger("loadgen")
+    results = []
+    for concurrency in levels:
+        result = await run_level(host, port, queries, concurrency, duration, params or {})
+        logger.info(f"{concurrency:>5} clients {result['requests_per_second']:10.0f} req/s "
+                    f"p50 {result['p50_ms']:.1f} ms p95 {result['p95_ms']:.1f} ms p99 {result['p99_ms']:.1f} ms "
+                    f"({result['errors']} errors)")
+        results.append(result)
+    return results
+
+
+async def _main(args):
+    queries = pd.read_csv(args.queries, usecols=['profile_id', 'item_id']).dropna()
+    # Item IDs of CSVs with missing values are read as floats
+    queries = list(zip(queries['profile_id'].astype(np.int64), queries['item_id'].astype(np.int64)))
+    server = None
+    if args.serve:
+        from rec.serving.service import Service, MicroBatcher, load_hseq
+        service = Service(MicroBatcher(load_hseq(args.serve), args.window_ms / 1000, args.max_batch), args.budget_ms / 1000)
+        server = await service.start(args.host, args.port)
+    params = dict(N=args.N, w1=args.w1, w2=1 - args.w1, K=args.K, budget_ms=args.budget_ms)
+    results = await load_test(args.host, args.port, queries, args.levels, args.duration, params)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if server is not None:
+        server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load generator for rec.serving.service, reports throughput vs. latency.")
+    parser.add_argument('queries', help="A test CSV with profile_id and item_id columns to draw requests from")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 8, 32, 128], help="Concurrent clients per level")
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--N', type=int, default=5)
+    parser.add_argument('--w1', type=float, default=0.5)
+    parser.add_argument('--K', type=int, default=20)
+    parser.add_argument('--budget-ms', type=float, default=100.0)
+    parser.add_argument('--serve', help="Directory of saved models to serve in this process instead of a running service")
+    parser.add_argument('--window-ms', type=float, default=2.0)
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--out', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    asyncio.run(_main(args))
@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+from urllib.parse import urlsplit, parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from rec.models.als import ALS
+from rec.models.mc import MC
+from rec.models.hseq import HSEQ
+from rec.utils.timing import Timings
+
+
+def load_hseq(path, logger=None):
+    """HSEQ over the ALS and MC models saved with save to path/als and path/mc."""
+    logger = logger or logging.getLogger("service")
+    als = ALS.load(os.path.join(path, "als"), logger=logger)
+    mc = MC.load(os.path.join(path, "mc"), logger=logger, vocabulary=als.vocabulary)
+    return HSEQ(mc, als, logger=logger)
+
+
+class Request:
+    def __init__(self, user_id, item_id, N, w1, w2, K):
+        self.user_id = user_id
+        self.item_id = item_id
+        self.params = (N, w1, w2, K)
+        self.received = time.perf_counter()
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests for at most window seconds (or until max_batch are waiting) and scores
+    them together: one ALS and one MC lookup plus a vectorized rerank per batch instead of per request.
+
+    Batches are scored one at a time in a worker thread, so the event loop keeps accepting requests while
+    a batch is scored and the next batch fills up meanwhile.
+    """
+    def __init__(self, hseq, window=0.002, max_batch=256):
+        self.hseq = hseq
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = []
+        self.ready = None
+        self.executor = ThreadPoolExecutor(1)
+        self.timings = Timings(enabled=True)
+        self.batches = 0
+        self.requests = 0
+
+    async def run(self):
+        self.ready = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.ready.wait()
+            # Wait for the window to fill, measured from the oldest waiting request
+            delay = self.window - (time.perf_counter() - self.queue[0].received)
+            if len(self.queue) < self.max_batch and delay > 0:
+                await asyncio.sleep(delay)
+            batch, self.queue = self.queue[:self.max_batch], self.queue[self.max_batch:]
+            if not self.queue:
+                self.ready.clear()
+            batch = [request for request in batch if not request.future.done()]
+            if not batch:
+                continue
+            try:
+                results = await loop.run_in_executor(self.executor, self._score, batch)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            for request, result in zip(batch, results):
+                if not request.future.done():
+                    request.future.set_result(result)
+
+    def _score(self, batch):
+        # Requests with the same N, w1, w2 and K are reranked in one call
+        with self.timings.stage("batch", len(batch)):
+            groups = {}
+            for position, request in enumerate(batch):
+                groups.setdefault(request.params, []).append(position)
+            results = [None] * len(batch)
+            for (N, w1, w2, K), positions in groups.items():
+                items, scores = self.hseq.recommend_batch([batch[i].user_id for i in positions],
+                                                          [batch[i].item_id for i in positions], N=N, w1=w1, w2=w2, K=K)
+                ids = self.hseq.item_ids(items)
+                for row, i in enumerate(positions):
+                    valid = items[row] >= 0
+                    results[i] = dict(items=[str(item) for item in ids[row][valid]],
+                                      scores=[float(score) for score in scores[row][valid]])
+        self.batches += 1
+        self.requests += len(batch)
+        return results
+
+    async def recommend(self, user_id, item_id, N=5, w1=0.5, w2=0.5, K=20, budget=None):
+        """
+        Queues one request and waits for its batch, raises asyncio.TimeoutError once budget seconds passed.
+        A timed-out request is cancelled, so a batch that has not started yet skips it.
+        """
+        request = Request(user_id, item_id, N, w1, w2, K)
+        self.queue.append(request)
+        self.ready.set()
+        try:
+            result = await asyncio.wait_for(request.future, budget)
+        finally:
+            latency = time.perf_counter() - request.received
+            self.timings.add("request", latency)
+        return dict(result, latency_ms=latency * 1000)
+
+    def stats(self):
+        return dict(batches=self.batches, requests=self.requests, queued=len(self.queue),
+                    mean_batch_size=self.requests / self.batches if self.batches else 0, stages=self.timings.summary())
+
+
+class Service:
+    """
+    HTTP/1.1 front end of a MicroBatcher, with keep-alive so clients can reuse connections.
+
+    Endpoints:
+    - GET /recommend?user_id=..&item_id=..[&N=5&w1=0.5&w2=0.5&K=20&budget_ms=..], or POST /recommend with
+      the same fields as a JSON object. Answers {"items": [...], "scores": [...], "latency_ms": ..}, empty
+      lists when HSEQ has no recommendation and 504 when the latency budget ran out.
+    - GET /stats[?reset=1]: Batch sizes and latency percentiles (since the last reset).
+    - GET /health
+    """
+    def __init__(self, batcher, budget=0.1, logger=None):
+        self.batcher = batcher
+        self.budget = budget
+        self.logger = logger or logging.getLogger("service")
+
+    async def start(self, host="127.0.0.1", port=8080):
+        asyncio.get_running_loop().create_task(self.batcher.run())
+        server = await asyncio.start_server(self._connection, host, port)
+        self.logger.info(f"Serving on {host}:{port}")
+        return server
+
+    async def _read_request(self, reader):
+        # (method, target, headers, body) of the next request, None at the end of the connection;
+        # raises ValueError for a malformed request line or headers
+        line = await reader.readline()
+        if not line:
+            return None
+        parts = line.decode().split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise ValueError(f"Malformed request line {line[:100]!r}")
+        method, target, _ = parts
+        headers = {}
+        while (header := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, colon, value = header.decode().partition(":")
+            if not colon or not name.strip():
+                raise ValueError(f"Malformed header {header[:100]!r}")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length < 0:
+            raise ValueError(f"Negative content-length {length}")
+        return method, target, headers, await reader.readexactly(length)
+
+    def _respond(self, writer, status, payload, close=False):
+        data = json.dumps(payload).encode()
+        head = f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+        if close:
+            head += "Connection: close\r\n"
+        writer.write((head + "\r\n").encode() + data)
+
+    async def _connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except ValueError as e:
+                    # The rest of the stream can't be framed, answer and close the connection
+                    self._respond(writer, "400 Bad Request", {"error": str(e)}, close=True)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, target, headers, body = request
+                status, payload = await self._handle(method, target, body)
+                self._respond(writer, status, payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == "/health":
+            return "200 OK", {"status": "ok"}
+        if url.path == "/stats":
+            stats = self.batcher.stats()
+            if dict(parse_qsl(url.query)).get("reset"):
+                self.batcher.timings.reset()
+            return "200 OK", stats
+        if url.path != "/recommend":
+            return "404 Not Found", {"error": "not found"}
+        try:
+            fields = json.loads(body) if method == "POST" else dict(parse_qsl(url.query))
+            budget = float(fields["budget_ms"]) / 1000 if "budget_ms" in fields else self.budget
+            result = await self.batcher.recommend(
+                fields["user_id"], fields["item_id"], N=int(fields.get("N", 5)), w1=float(fields.get("w1", 0.5)),
+                w2=float(fields.get("w2", 0.5)), K=int(fields.get("K", 20)), budget=budget)
+        except (KeyError, ValueError) as e:
+            return "400 Bad Request", {"error": str(e)}
+        except asyncio.TimeoutError:
+            return "504 Gateway Timeout", {"error": "latency budget exceeded"}
+        return "200 OK", result
+
+
+async def serve(path, host="127.0.0.1", port=8080, window=0.002, max_batch=256, budget=0.1):
+    logger = logging.getLogger("service")
+    hseq = load_hseq(path, logger)
+    # Warm up, the first call pays for loading the memory-mapped factors
+    hseq.recommend_batch(np.zeros(1, dtype=np.int32), np.zeros(1, dtype=np.int32), encoded=True)
+    server = await Service(MicroBatcher(hseq, window, max_batch), budget, logger).start(host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serves HSEQ recommendations of saved ALS and MC models over HTTP.")
+    parser.add_argument('models', help="Directory with the als and mc models written by ALS.save and MC.save")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--window-ms', type=float, default=2.0, help="How long a batch collects requests")
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--budget-ms', type=float, default=100.0, help="Default latency budget of a request")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(args.models, args.host, args.port, args.window_ms / 1000, args.max_batch, args.budget_ms / 1000))
@@ -0,0 +1,44 @@
+import os
+import glob
+import json
+import numpy as np
+
+
+def _storable(array):
+    # Raw IDs come as object arrays of strings, fixed-width unicode keeps them memory-mappable
+    array = np.asarray(array)
+    if array.dtype == object and all(isinstance(value, str) for value in array):
+        return array.astype(str)
+    return array
+
+
+def save_arrays(arrays, path):
+    """Writes a dict of arrays to path as one .npy file per array."""
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), _storable(array), allow_pickle=True)
+
+
+def load_arrays(path, mmap=True):
+    """Reads the arrays written by save_arrays, memory-mapped read-only when mmap is set."""
+    arrays = {}
+    for file in sorted(glob.glob(os.path.join(path, "*.npy"))):
+        name = os.path.basename(file)[:-len(".npy")]
+        try:
+            arrays[name] = np.load(file, mmap_mode='r' if mmap else None)
+        except ValueError:
+            # Arrays of mixed Python objects can't be memory-mapped and are loaded as copies
+            arrays[name] = np.load(file, allow_pickle=True)
+    return arrays
+
+
+def save_params(params, path):
+    """Writes the scalar settings of a model next to its arrays."""
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "params.json"), "w") as f:
+        json.dump(params, f)
+
+
+def load_params(path):
+    with open(os.path.join(path, "params.json")) as f:
+        return json.load(f)
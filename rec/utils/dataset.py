@@ -0,0 +1,132 @@
+import glob
+import logging
+import numpy as np
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from scipy.sparse import coo_matrix
+
+# Columns each loader needs, everything else is skipped when reading
+VIEWING_COLUMNS = ["profileId", "itemId", "durationSec"]
+POPULARITY_COLUMNS = ["itemId", "durationSec", "firstStart", "contentType"]
+SESSION_COLUMNS = ["itemId", "nextItemId", "count"]
+
+
+def parquet_files(path, nested=False, limit=-1):
+    """
+    The Parquet files under path (or path itself), the first limit of them when limit is not -1.
+    A list of paths is taken as the files to read.
+    """
+    if isinstance(path, (list, tuple)):
+        return list(path)
+    if not nested:
+        return [path]
+    files = sorted(glob.glob(path + "/**/*.parquet", recursive=True))
+    return files if limit == -1 else files[:limit]
+
+
+def date_filter(column, start=None, end=None):
+    """A filter keeping rows with start <= column < end, pushed down to the row group statistics."""
+    expression = None
+    if start is not None:
+        expression = ds.field(column) >= start
+    if end is not None:
+        upper = ds.field(column) < end
+        expression = upper if expression is None else expression & upper
+    return expression
+
+
+def read_table(path, columns=None, nested=False, limit=-1, filter=None, logger=None):
+    """
+    Reads Parquet data into one Arrow table.
+
+    Files are scanned in parallel, only the given columns are decoded and the filter expression
+    (see date_filter) skips row groups whose statistics can't match.
+
+    Parameters:
+    - path (str): A Parquet file, or a directory searched recursively when nested is set, or a list of files.
+    - columns (List[str]): The columns to read, None for all.
+    - nested (bool): Whether path is a directory of Parquet files.
+    - limit (int): The number of files to read, -1 for all.
+    - filter (pyarrow.dataset.Expression): Optional row filter.
+    """
+    logger = logger or logging.getLogger(__name__)
+    files = parquet_files(path, nested, limit)
+    table = ds.dataset(files, format="parquet").to_table(columns=columns, filter=filter, use_threads=True)
+    logger.debug(f"Loaded {len(files)} files from {path} with shape: ({table.num_rows}, {table.num_columns})")
+    return table
+
+
+def _batches(path, columns, nested=False, limit=-1, filter=None, batch_size=1000000):
+    # Record batches of the given columns with both key columns (the first two) present
+    files = parquet_files(path, nested, limit)
+    for batch in ds.dataset(files, format="parquet").to_batches(columns=columns, filter=filter, batch_size=batch_size):
+        if batch.column(0).null_count or batch.column(1).null_count:
+            batch = batch.filter(pc.and_(pc.is_valid(batch.column(0)), pc.is_valid(batch.column(1))))
+        if batch.num_rows:
+            yield batch
+
+
+def _distinct(chunks):
+    # Sorted distinct values of the per-batch uniques, sorting is faster than the hashing np.unique does
+    if not chunks:
+        return np.empty(0)
+    values = np.sort(np.concatenate(chunks))
+    return values[np.concatenate([[True], values[1:] != values[:-1]])]
+
+
+def _codes(column, ids):
+    # Dictionary-encodes a batch column in Arrow, only its distinct values are looked up in the sorted ids
+    encoded = pc.dictionary_encode(column)
+    return np.searchsorted(ids, encoded.dictionary.to_numpy(zero_copy_only=False))[encoded.indices.to_numpy()]
+
+
+def _sum_matrices(matrices, shape):
+    # Sums COO/CSR matrices into one CSR matrix, keeping explicit zeros like coo_matrix(...).tocsr() does
+    parts = [matrix.tocoo() for matrix in matrices]
+    return coo_matrix((np.concatenate([part.data for part in parts]),
+                       (np.concatenate([part.row for part in parts]), np.concatenate([part.col for part in parts]))),
+                      shape=shape).tocsr()
+
+
+def sparse_sums(path, row_column, col_column, value_column, nested=False, limit=-1, filter=None, batch_size=1000000,
+                logger=None):
+    """
+    Sums value_column per (row_column, col_column) pair straight into a CSR matrix, batch by batch, without
+    building a DataFrame of the rows. The first pass collects the distinct keys, the second one
+    dictionary-encodes every batch against them and adds it to the matrix, so memory is bounded by the
+    matrix and one batch rather than the whole table.
+
+    Parameters:
+    - path, nested, limit, filter: See read_table.
+    - row_column, col_column (str): The key columns, e.g. profileId and itemId. Rows missing a key are skipped.
+    - value_column (str): The column summed per pair, missing values count as 0.
+    - batch_size (int): The number of rows read at once.
+
+    Returns:
+    - row_ids (np.ndarray): The sorted distinct values of row_column, the raw ID of every matrix row.
+    - col_ids (np.ndarray): The sorted distinct values of col_column, the raw ID of every matrix column.
+    - matrix (scipy.sparse.csr_matrix): float32 sums of value_column.
+    """
+    logger = logger or logging.getLogger(__name__)
+    columns = [row_column, col_column, value_column]
+    row_ids, col_ids = [], []
+    for batch in _batches(path, columns[:2], nested, limit, filter, batch_size):
+        row_ids.append(pc.unique(batch.column(0)).to_numpy(zero_copy_only=False))
+        col_ids.append(pc.unique(batch.column(1)).to_numpy(zero_copy_only=False))
+    row_ids, col_ids = _distinct(row_ids), _distinct(col_ids)
+    shape = (len(row_ids), len(col_ids))
+
+    # Batch matrices are summed once they hold as many entries as the total, so every entry is merged
+    # O(log batches) times instead of once per batch
+    total, pending, rows = coo_matrix(shape, dtype=np.float64).tocsr(), [], 0
+    for batch in _batches(path, columns, nested, limit, filter, batch_size):
+        values = pc.fill_null(batch.column(2), 0).to_numpy(zero_copy_only=False).astype(np.float64)
+        pending.append(coo_matrix((values, (_codes(batch.column(0), row_ids), _codes(batch.column(1), col_ids))),
+                                  shape=shape).tocsr())
+        rows += batch.num_rows
+        if sum(matrix.nnz for matrix in pending) >= total.nnz:
+            total, pending = _sum_matrices([total] + pending, shape), []
+    if pending:
+        total = _sum_matrices([total] + pending, shape)
+    logger.debug(f"Summed {rows} rows from {path} into a {shape} matrix with {total.nnz} entries")
+    return row_ids, col_ids, total.astype(np.float32)
@@ -0,0 +1,209 @@
+import os
+import shutil
+import logging
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from rec.utils.dataset import parquet_files, _batches, SESSION_COLUMNS
+
+# Rule keys pack the item and next item IDs into one non-negative int64, so IDs must be below 2^ID_BITS
+ID_BITS = 31
+
+
+def _pack(items, next_items):
+    items, next_items = items.astype(np.int64), next_items.astype(np.int64)
+    if len(items) and (min(items.min(), next_items.min()) < 0 or max(items.max(), next_items.max()) >= 1 << ID_BITS):
+        raise ValueError(f"Item IDs must be integers in [0, 2^{ID_BITS}) to be mined")
+    return (items << ID_BITS) | next_items
+
+
+class _Aggregate:
+    """
+    Hash aggregate of rule keys to counts. Keys of new batches are buffered and folded in with one
+    factorize once they take as much memory as the table; when the table outgrows memory bytes it is
+    written to path as a sorted run and emptied.
+    """
+    def __init__(self, path, memory):
+        self.path = path
+        self.memory = memory
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.pending = []
+        self.runs = []
+
+    def add(self, keys, counts=None):
+        self.pending.append((keys, np.ones(len(keys), dtype=np.int64) if counts is None else counts))
+        pending = sum(keys.nbytes for keys, _ in self.pending)
+        if pending >= max(self.keys.nbytes, self.memory // 4):
+            self._fold()
+            if self.keys.nbytes + self.counts.nbytes > self.memory // 2:
+                self.spill()
+
+    def _fold(self):
+        if not self.pending:
+            return
+        keys = np.concatenate([self.keys] + [keys for keys, _ in self.pending])
+        counts = np.concatenate([self.counts] + [counts for _, counts in self.pending])
+        codes, self.keys = pd.factorize(keys)
+        self.counts = np.bincount(codes, counts, len(self.keys)).astype(np.int64)
+        self.pending = []
+
+    def spill(self):
+        """Writes the table as a sorted run of keys.npy and counts.npy files, returns nothing when it is empty."""
+        self._fold()
+        if len(self.keys) == 0:
+            return
+        order = np.argsort(self.keys)
+        run = os.path.join(self.path, f"run-{len(self.runs)}")
+        os.makedirs(run)
+        np.save(os.path.join(run, "keys.npy"), self.keys[order])
+        np.save(os.path.join(run, "counts.npy"), self.counts[order])
+        self.runs.append(run)
+        self.keys, self.counts = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+
+def _sessions(column):
+    # Session values of a batch as numbers that are equal exactly where the sessions are
+    if pa.types.is_integer(column.type):
+        return column.to_numpy()
+    return pc.dictionary_encode(column).indices.to_numpy()
+
+
+def _mine_file(file, path, session_column, item_column, memory, batch_size):
+    """
+    Counts the transitions of one file into sorted runs under path.
+
+    Returns:
+    - runs (List[str]): The run directories.
+    - first, last (Tuple): (session, item) of the first and last event of the file, None when it has none,
+      so transitions across files can be added by the caller.
+    """
+    aggregate = _Aggregate(path, memory)
+    first = last = None
+    for batch in _batches(file, [session_column, item_column], batch_size=batch_size):
+        sessions, items = batch.column(0), batch.column(1)
+        if not pa.types.is_integer(items.type):
+            raise ValueError(f"{item_column} must be an integer column to be mined, got {items.type}")
+        items = items.to_numpy()
+        same = _sessions(sessions)
+        same = same[1:] == same[:-1]
+        head = (sessions[0].as_py(), int(items[0]))
+        if last is not None and last[0] == head[0] and last[1] != head[1]:
+            aggregate.add(_pack(np.array([last[1]]), np.array([head[1]])))
+        first = first or head
+        last = (sessions[-1].as_py(), int(items[-1]))
+        # Consecutive events of a session, repeated events of an item are no transition (see MC.remove_self_links)
+        pairs = same & (items[1:] != items[:-1])
+        aggregate.add(_pack(items[:-1][pairs], items[1:][pairs]))
+    aggregate.spill()
+    return aggregate.runs, first, last
+
+
+def _merge(runs, out, memory, logger):
+    # Merges sorted runs into the rule file one key range at a time, a range holds at most chunk entries of all runs
+    keys = [np.load(os.path.join(run, "keys.npy"), mmap_mode='r') for run in runs]
+    counts = [np.load(os.path.join(run, "counts.npy"), mmap_mode='r') for run in runs]
+    chunk = max(memory // 16, 1)
+    stride = max(chunk // max(len(runs), 1), 1)
+    bounds = np.unique(np.concatenate([run[::stride] for run in keys] + [np.empty(0, dtype=np.int64)]))
+    bounds = np.append(bounds, np.iinfo(np.int64).max)
+    schema = pa.schema([(column, pa.int64()) for column in SESSION_COLUMNS])
+    rules = 0
+    with pq.ParquetWriter(out, schema) as writer:
+        for low, high in zip(bounds[:-1], bounds[1:]):
+            parts = [(run_keys[start:end], run_counts[start:end]) for run_keys, run_counts in zip(keys, counts)
+                     for start, end in [np.searchsorted(run_keys, [low, high])] if end > start]
+            if not parts:
+                continue
+            range_keys = np.concatenate([part[0] for part in parts])
+            range_counts = np.concatenate([part[1] for part in parts])
+            order = np.argsort(range_keys, kind='stable')
+            range_keys, range_counts = range_keys[order], range_counts[order]
+            starts = np.flatnonzero(np.concatenate([[True], range_keys[1:] != range_keys[:-1]]))
+            range_keys, range_counts = range_keys[starts], np.add.reduceat(range_counts, starts)
+            writer.write_table(pa.table({'itemId': range_keys >> ID_BITS, 'nextItemId': range_keys & ((1 << ID_BITS) - 1),
+                                         'count': range_counts}, schema=schema))
+            rules += len(range_keys)
+    logger.debug(f"Merged {len(runs)} runs into {rules} rules")
+    return rules
+
+
+def mine_rules(path, out, nested=False, limit=-1, session_column='profileId', item_column='itemId', workers=1,
+               memory=256 * 1024 ** 2, batch_size=1000000, tmp=None, logger=None):
+    """
+    Mines the (itemId, nextItemId, count) rules MC.fit reads from raw events, with memory bounded by memory
+    per worker instead of the size of the data.
+
+    Events must be session-ordered: the events of a session are consecutive rows, in the order they
+    happened, across the files in the sorted order parquet_files returns them. Every pair of consecutive
+    events of a session with different items counts once. Files are mined in parallel, each one batch by
+    batch into a hash aggregate that is spilled to disk as a sorted run whenever it outgrows memory; the
+    runs are merged at the end, so the counts equal those of an exact in-memory count.
+
+    Parameters:
+    - path, nested, limit: See read_table. Rows missing the session or item are skipped.
+    - out (str): The Parquet file to write, with int64 itemId, nextItemId and count sorted by itemId and nextItemId.
+    - session_column (str): The column identifying a session, e.g. profileId.
+    - item_column (str): The integer item ID column.
+    - workers (int): The number of files mined at once, in separate processes.
+    - memory (int): Bytes the aggregate of one worker (and the merge) may hold before spilling.
+    - batch_size (int): The number of rows read at once.
+    - tmp (str): Directory for the runs, a temporary one by default.
+
+    Returns:
+    - rules (int): The number of rules written.
+    """
+    logger = logger or logging.getLogger(__name__)
+    files = parquet_files(path, nested, limit)
+    directory = tempfile.mkdtemp(prefix="rec-mining-", dir=tmp)
+    try:
+        paths = [os.path.join(directory, f"file-{i}") for i in range(len(files))]
+        for file_path in paths:
+            os.makedirs(file_path)
+        arguments = [(file, file_path, session_column, item_column, memory, batch_size) for file, file_path in zip(files, paths)]
+        if workers > 1:
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                results = list(pool.map(_mine_file, *zip(*arguments)))
+        else:
+            results = [_mine_file(*argument) for argument in arguments]
+
+        # Sessions that continue in the next file
+        boundary = _Aggregate(os.path.join(directory, "boundary"), memory)
+        os.makedirs(boundary.path)
+        last = None
+        for _, first, file_last in results:
+            if first is None:
+                continue
+            if last is not None and last[0] == first[0] and last[1] != first[1]:
+                boundary.add(_pack(np.array([last[1]]), np.array([first[1]])))
+            last = file_last
+        boundary.spill()
+        runs = [run for result in results for run in result[0]] + boundary.runs
+        logger.debug(f"Mined {len(files)} files into {len(runs)} sorted runs")
+        os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+        return _merge(runs, out, memory, logger)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mines (itemId, nextItemId, count) rules from session-ordered events.")
+    parser.add_argument('events', help="A Parquet file or a directory of them")
+    parser.add_argument('out', help="The rule Parquet file to write")
+    parser.add_argument('--session-column', default='profileId')
+    parser.add_argument('--item-column', default='itemId')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--memory-mb', type=int, default=256, help="Memory of the aggregate of one worker before it spills")
+    parser.add_argument('--batch-size', type=int, default=1000000)
+    parser.add_argument('--tmp', help="Directory for the spilled runs")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+    mine_rules(args.events, args.out, nested=os.path.isdir(args.events), session_column=args.session_column,
+               item_column=args.item_column, workers=args.workers, memory=args.memory_mb * 1024 ** 2,
+               batch_size=args.batch_size, tmp=args.tmp)
@@ -1,8 +1,49 @@
+import os
 import pandas as pd
-import pyarrow.parquet as pq
-import glob
 from datetime import datetime, timedelta
 import logging
+import numpy as np
+from rec.utils.dataset import read_table, POPULARITY_COLUMNS, SESSION_COLUMNS
+from rec.utils.arrays import save_arrays, load_arrays, save_params, load_params
+from rec.utils.vocabulary import Vocabulary
+
+# Content types that count towards viewing popularity
+VIEWED_TYPES = ['SERIES', 'MOVIE']
+
+
+def _encode(vocabulary, values):
+    # Vocabulary codes of a column, encoding only its distinct values
+    local, ids = pd.factorize(values, use_na_sentinel=False)
+    return vocabulary.items.encode(ids, add=True)[local]
+
+
+def _normalized(values, present):
+    # Min-max normalization over the present items, NaN for the others (0 when all values are equal)
+    scores = np.full(len(values), np.nan)
+    if present.any():
+        low, high = values[present].min(), values[present].max()
+        scores[present] = (values[present] - low) / (high - low) if high > low else 0
+    return scores
+
+
+def session_popularity(data, vocabulary):
+    """
+    The scores of PopularityScore.calculate_popularity_scores_sessions as an array indexed by item code:
+    the min-max normalized sum of the counts of the rules an item is the source or target of, NaN for
+    items in no rule.
+
+    Parameters:
+    - data (pd.DataFrame): Session rules with itemId, nextItemId and count.
+    - vocabulary (Vocabulary): Item codes, IDs it doesn't know yet are added.
+    """
+    sources = _encode(vocabulary, data['itemId'])
+    targets = _encode(vocabulary, data['nextItemId'])
+    weights = data['count'].to_numpy(dtype=np.float64)
+    size = len(vocabulary.items)
+    totals = np.bincount(sources, weights, size) + np.bincount(targets, weights, size)
+    present = (np.bincount(sources, minlength=size) + np.bincount(targets, minlength=size)) > 0
+    return _normalized(totals, present)
+
 
 class PopularityScore:
     def __init__(self, logger=None):
@@ -14,25 +55,14 @@ class PopularityScore:
         self.popularity_scores = {}
         self.type = None
 
-    def load_data(self, path, nested=False, limit=-1, type=None):
+    def load_data(self, path, nested=False, limit=-1, type=None, filter=None):
         if type is None:
             raise ValueError("Type must be set before loading data, accepted values are 'viewing' and 'sessions'")
         if type not in ['viewing', 'sessions']:
             raise ValueError("Type must be either 'viewing' or 'sessions'")
         self.type = type
-        i = 0
-        if nested:
-            dfs = []
-            for file in glob.glob(path + "/**/*.parquet", recursive=True):
-                if i > limit and limit != -1:
-                    break
-                df = pq.read_table(file).to_pandas()
-                self.logger.debug("Loaded file: " + file + " with shape: " + str(df.shape))
-                dfs.append(df)
-                i += 1
-            self.data = pd.concat(dfs, ignore_index=True)
-        else:
-            self.data = pq.read_table(path).to_pandas()
+        columns = POPULARITY_COLUMNS if type == 'viewing' else SESSION_COLUMNS
+        self.data = read_table(path, columns, nested, limit, filter, self.logger).to_pandas()
 
 
     def calculate_popularity_scores(self, days):
@@ -97,3 +127,172 @@ class PopularityScore:
             item: (count - min_count) / (max_count - min_count) if max_count != min_count else 0
             for item, count in combined_dict.items()
         }
+
+    def save(self, path):
+        """Saves the calculated popularity scores as one .npy vector per score."""
+        items = list(self.popularity_scores)
+        if self.type == 'viewing':
+            arrays = {
+                'item_ids': np.asarray(items),
+                'count_score': np.array([self.popularity_scores[item]['count_score'] for item in items], dtype=np.float64),
+                'duration_score': np.array([self.popularity_scores[item]['duration_score'] for item in items], dtype=np.float64),
+            }
+        else:
+            arrays = {'item_ids': np.asarray(items), 'score': np.array([self.popularity_scores[item] for item in items], dtype=np.float64)}
+        save_arrays(arrays, path)
+        save_params({'type': self.type}, path)
+
+    @classmethod
+    def load(cls, path, mmap=True, logger=None):
+        """Loads popularity scores written by save, without the raw data."""
+        popularity = cls(logger=logger)
+        popularity.type = load_params(path)['type']
+        arrays = load_arrays(path, mmap)
+        items = arrays['item_ids'].tolist()
+        if popularity.type == 'viewing':
+            popularity.popularity_scores = {
+                item: {"count_score": count, "duration_score": duration}
+                for item, count, duration in zip(items, arrays['count_score'].tolist(), arrays['duration_score'].tolist())
+            }
+        else:
+            popularity.popularity_scores = dict(zip(items, arrays['score'].tolist()))
+        return popularity
+
+
+class DailyPopularity:
+    """
+    Time-windowed viewing popularity kept as arrays instead of dicts.
+
+    Views of SERIES and MOVIE items are aggregated per day into dense (days, items) count and duration
+    arrays indexed by vocabulary item code. Any window is a difference of their cumulative sums, so it
+    costs one pass over the items instead of a rescan of the raw data, and new days are appended with add.
+    Windows are whole days: scores(days) covers the latest day and the days days before it, the same rows
+    as PopularityScore.calculate_popularity_scores plus the earlier part of the first day.
+    """
+    def __init__(self, vocabulary=None, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        # Share the vocabulary of the models to get arrays aligned with their item codes
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+        self.first_day = None
+        # (day, item) capacity grows geometrically, counts and durations are views of the filled part
+        self._counts = np.zeros((0, 0), dtype=np.int64)
+        self._durations = np.zeros((0, 0), dtype=np.float64)
+        self._days = 0
+        self._items = 0
+        # Cumulative sums of the same capacity plus a leading row of zeros, valid for the first _summed days
+        self._cumulative = None
+        self._summed = 0
+
+    @property
+    def counts(self):
+        return self._counts[:self._days, :self._items]
+
+    @property
+    def durations(self):
+        return self._durations[:self._days, :self._items]
+
+    def load_data(self, path, nested=False, limit=-1, filter=None):
+        self.add(read_table(path, POPULARITY_COLUMNS, nested, limit, filter, self.logger).to_pandas())
+
+    def _reserve(self, days, items, shift=0):
+        # Makes room for days x items with the filled part moved shift days down. The arrays are only
+        # reallocated when they run out of capacity, which then doubles, or are read-only memory maps
+        capacity = self._counts.shape
+        if shift or days > capacity[0] or items > capacity[1] or not self._counts.flags.writeable:
+            shape = tuple(max(needed, 2 * size) if needed > size else size for needed, size in zip((days, items), capacity))
+            filled = (slice(shift, shift + self._days), slice(0, self._items))
+            counts, durations = np.zeros(shape, dtype=np.int64), np.zeros(shape, dtype=np.float64)
+            counts[filled], durations[filled] = self.counts, self.durations
+            if self._cumulative is not None:
+                # Earlier days change every sum, otherwise the valid rows are kept
+                self._summed = 0 if shift else self._summed
+                cumulative = tuple(np.zeros((shape[0] + 1, shape[1]), dtype=daily.dtype) for daily in (counts, durations))
+                for new, old in zip(cumulative, self._cumulative):
+                    new[:self._summed + 1, :self._items] = old[:self._summed + 1, :self._items]
+                self._cumulative = cumulative
+            self._counts, self._durations = counts, durations
+        self._days, self._items = days, items
+
+    def add(self, data):
+        """Adds viewing rows (itemId, durationSec, firstStart, contentType), typically the next day(s) of data."""
+        data = data[data['contentType'].isin(VIEWED_TYPES)]
+        if len(data) == 0:
+            return
+        days = data['firstStart'].to_numpy().astype('datetime64[D]').astype(np.int64)
+        codes = _encode(self.vocabulary, data['itemId'])
+        durations = data['durationSec'].fillna(0).to_numpy(dtype=np.float64)
+
+        first = int(days.min()) if self.first_day is None else min(self.first_day, int(days.min()))
+        shift = 0 if self.first_day is None else self.first_day - first
+        self.first_day = first
+        days = days - first
+        start, end = int(days.min()), int(days.max()) + 1
+        self._reserve(max(self._days + shift, end), max(self._items, len(self.vocabulary.items)), shift)
+
+        # Only the rows of the added days are counted and summed into
+        shape = (end - start, self._items)
+        cells = (days - start) * shape[1] + codes
+        self._counts[start:end, :shape[1]] += np.bincount(cells, minlength=shape[0] * shape[1]).reshape(shape)
+        self._durations[start:end, :shape[1]] += np.bincount(cells, durations, shape[0] * shape[1]).reshape(shape)
+        self._summed = min(self._summed, start)
+        self.logger.debug(f"Daily popularity covers {self._days} days of {self._items} items")
+
+    def _sums(self):
+        # Cumulative counts and durations with a leading row of zeros, row d sums the days before day d.
+        # Only the days from the first one that changed since the last call are summed again
+        if self._cumulative is None:
+            self._cumulative = tuple(np.zeros((len(daily) + 1, daily.shape[1]), dtype=daily.dtype)
+                                     for daily in (self._counts, self._durations))
+            self._summed = 0
+        for cumulative, daily in zip(self._cumulative, (self.counts, self.durations)):
+            summed = cumulative[self._summed:self._days + 1, :self._items]
+            np.cumsum(daily[self._summed:], axis=0, out=summed[1:])
+            summed[1:] += summed[0]
+        self._summed = self._days
+        return tuple(cumulative[:self._days + 1, :self._items] for cumulative in self._cumulative)
+
+    def window(self, days):
+        """
+        Returns:
+        - counts (np.ndarray): Views per item code over the latest day and the days days before it.
+        - durations (np.ndarray): Watched seconds per item code over the same days.
+        """
+        size = len(self.vocabulary.items)
+        if self.first_day is None:
+            return np.zeros(size, dtype=np.int64), np.zeros(size)
+        counts, durations = self._sums()
+        start = max(len(self.counts) - 1 - days, 0)
+        window = [np.pad(total[-1] - total[start], (0, size - total.shape[1])) for total in (counts, durations)]
+        return window[0], window[1]
+
+    def scores(self, days):
+        """
+        Returns:
+        - duration (np.ndarray): Min-max normalized watched seconds per item code, NaN for items not viewed in the window.
+        - count (np.ndarray): Min-max normalized views per item code, NaN likewise.
+        """
+        counts, durations = self.window(days)
+        present = counts > 0
+        return _normalized(durations, present), _normalized(counts.astype(np.float64), present)
+
+    def to_dict(self, days):
+        """The scores of a window in the dict form of PopularityScore.popularity_scores."""
+        duration, count = self.scores(days)
+        present = np.flatnonzero(~np.isnan(count))
+        return {item: {"count_score": c, "duration_score": d} for item, c, d in
+                zip(self.vocabulary.items.decode(present), count[present].tolist(), duration[present].tolist())}
+
+    def save(self, path):
+        save_arrays({'counts': self.counts, 'durations': self.durations}, path)
+        save_params({'first_day': self.first_day}, path)
+        self.vocabulary.save(os.path.join(path, "vocabulary"))
+
+    @classmethod
+    def load(cls, path, mmap=True, logger=None, vocabulary=None):
+        """Loads daily aggregates written by save, appending to them with add works as before saving."""
+        popularity = cls(Vocabulary.load(os.path.join(path, "vocabulary"), vocabulary), logger)
+        arrays = load_arrays(path, mmap)
+        popularity.first_day = load_params(path)['first_day']
+        popularity._counts, popularity._durations = arrays['counts'], arrays['durations']
+        popularity._days, popularity._items = popularity._counts.shape
+        return popularity
@@ -0,0 +1,102 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+
+def _zipf(n, alpha):
+    # Power-law probabilities of n ranks
+    weights = 1 / np.arange(1, n + 1) ** alpha
+    return weights / weights.sum()
+
+
+def _next_items(rng, items, popularity, locality):
+    # Follow-up items: mostly a close neighbour (the next episode of a series), otherwise a popular item
+    n_items = len(popularity)
+    local = rng.random(len(items)) < locality
+    neighbours = (items + rng.geometric(0.5, len(items))) % n_items
+    return np.where(local, neighbours, rng.choice(n_items, len(items), p=popularity))
+
+
+def generate(path, users=10000, items=2000, viewing_rows=1000000, session_rows=200000, test_rows=100000,
+             files=4, alpha=1.1, locality=0.6, days=60, seed=0):
+    """
+    Writes a synthetic dataset in the layout main.py expects, for benchmarks and reproducible runs.
+
+    Item popularity follows a power law, so a few items get most views and rules like in the real data.
+    Viewing and session rules are split over files Parquet files each, the test set only uses profiles
+    and items that occur in the training data.
+
+    Parameters:
+    - path (str): The data directory, als/train, mc/train, testdata and evaluations are created in it.
+    - users (int): The number of profiles.
+    - items (int): The number of items.
+    - viewing_rows (int): The number of rows of als/train (profileId, itemId, durationSec, firstStart, contentType).
+    - session_rows (int): The number of mined rules in mc/train (itemId, nextItemId, count).
+    - test_rows (int): The number of rows of testdata/test.csv (profile_id, item_id, next_item_id, measure_date).
+    - files (int): The number of Parquet files the training data is split into.
+    - alpha (float): The exponent of the item popularity power law.
+    - locality (float): The share of follow-up items that are neighbours of the previous item.
+    - days (int): The number of days firstStart spans, ending at 2024-01-01.
+    - seed (int): Seed of the generator.
+
+    Returns:
+    - paths (Dict[str, str]): The viewing, sessions and test paths.
+    """
+    rng = np.random.default_rng(seed)
+    popularity = _zipf(items, alpha)
+    # Raw IDs are not dense in real data, ranks are mapped to scattered IDs
+    item_ids = rng.choice(10 * items, items, replace=False) + 100000
+    profile_ids = rng.choice(10 * users, users, replace=False) + 1000000
+    content_types = np.array(['SERIES', 'MOVIE', 'OTHER'])
+    item_types = rng.choice(len(content_types), items, p=[0.6, 0.3, 0.1])
+    end = np.datetime64('2024-01-01T00:00:00', 's')
+    paths = {'viewing': os.path.join(path, "als", "train"), 'sessions': os.path.join(path, "mc", "train"),
+             'test': os.path.join(path, "testdata", "test.csv")}
+    for directory in [paths['viewing'], paths['sessions'], os.path.dirname(paths['test']), os.path.join(path, "evaluations")]:
+        os.makedirs(directory, exist_ok=True)
+
+    for file, rows in enumerate(np.array_split(np.arange(viewing_rows), files)):
+        n = len(rows)
+        viewed = rng.choice(items, n, p=popularity)
+        pd.DataFrame({
+            'profileId': profile_ids[rng.integers(0, users, n)],
+            'itemId': item_ids[viewed],
+            'durationSec': rng.gamma(1.5, 900, n).astype(np.int64) + 1,
+            'firstStart': end - rng.integers(0, days * 86400, n).astype('timedelta64[s]'),
+            'contentType': content_types[item_types[viewed]],
+        }).to_parquet(os.path.join(paths['viewing'], f"part-{file}.parquet"), index=False)
+
+    for file, rows in enumerate(np.array_split(np.arange(session_rows), files)):
+        n = len(rows)
+        sources = rng.choice(items, n, p=popularity)
+        pd.DataFrame({
+            'itemId': item_ids[sources],
+            'nextItemId': item_ids[_next_items(rng, sources, popularity, locality)],
+            'count': rng.zipf(2.0, n).astype(np.int64),
+        }).to_parquet(os.path.join(paths['sessions'], f"part-{file}.parquet"), index=False)
+
+    viewed = rng.choice(items, test_rows, p=popularity)
+    pd.DataFrame({
+        'profile_id': profile_ids[rng.integers(0, users, test_rows)],
+        'item_id': item_ids[viewed],
+        'next_item_id': item_ids[_next_items(rng, viewed, popularity, locality)],
+        'measure_date': end + rng.integers(0, 7 * 86400, test_rows).astype('timedelta64[s]'),
+    }).to_csv(paths['test'], index=False)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Writes a synthetic viewing, session rule and test dataset.")
+    parser.add_argument('path')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--items', type=int, default=2000)
+    parser.add_argument('--viewing-rows', type=int, default=1000000)
+    parser.add_argument('--session-rows', type=int, default=200000)
+    parser.add_argument('--test-rows', type=int, default=100000)
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--alpha', type=float, default=1.1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.path, args.users, args.items, args.viewing_rows, args.session_rows, args.test_rows,
+             args.files, args.alpha, seed=args.seed)
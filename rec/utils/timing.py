@@ -0,0 +1,143 @@
+import math
+import time
+import cProfile
+import inspect
+import functools
+from contextlib import contextmanager, nullcontext
+import numpy as np
+
+
+# Latencies are counted in log-spaced buckets from 1 microsecond to about 3 hours, BUCKETS_PER_DECADE
+# buckets per factor of 10, so a percentile is off by at most half a bucket (about 6% with 20 buckets)
+MIN_SECONDS = 1e-6
+BUCKETS_PER_DECADE = 20
+BUCKETS = 10 * BUCKETS_PER_DECADE + 1
+
+
+class _Histogram:
+    # Calls, items, total seconds and bucket counts of one stage, a fixed size whatever the number of calls
+    __slots__ = ('calls', 'items', 'seconds', 'low', 'high', 'buckets')
+
+    def __init__(self):
+        self.calls = self.items = 0
+        self.seconds = 0.0
+        self.low, self.high = math.inf, 0.0
+        self.buckets = [0] * BUCKETS
+
+    def add(self, seconds, items):
+        self.calls += 1
+        self.items += items
+        self.seconds += seconds
+        if seconds < self.low:
+            self.low = seconds
+        if seconds > self.high:
+            self.high = seconds
+        bucket = int(math.log10(seconds / MIN_SECONDS) * BUCKETS_PER_DECADE) + 1 if seconds > MIN_SECONDS else 0
+        self.buckets[min(bucket, BUCKETS - 1)] += 1
+
+    def percentiles(self, qs):
+        # Geometric middle of the bucket holding each nearest-rank percentile, clamped to the observed range
+        ranks = np.maximum(np.ceil(np.asarray(qs) / 100 * self.calls), 1)
+        buckets = np.searchsorted(np.cumsum(self.buckets), ranks)
+        middles = MIN_SECONDS * 10 ** ((buckets - 0.5) / BUCKETS_PER_DECADE)
+        return np.clip(middles, self.low, self.high)
+
+
+class Timings:
+    """
+    Per-stage wall clock timers. Every timed call of a stage adds its duration (and the number of items
+    it handled) so summary can report call counts, throughput and latency percentiles per stage.
+
+    Durations are counted into a fixed-size log-spaced histogram per stage rather than kept, so long runs
+    and servers hold constant memory. Timing is off by default and a disabled stage costs one attribute
+    check, so the hot paths of the models can stay instrumented.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = {}
+
+    def add(self, name, seconds, items=1):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = _Histogram()
+        stage.add(seconds, items)
+
+    @contextmanager
+    def _stage(self, name, items):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, items)
+
+    def stage(self, name, items=1):
+        """Context manager timing the enclosed block as one call of the stage name."""
+        return self._stage(name, items) if self.enabled else nullcontext()
+
+    def timed(self, name, batch=False):
+        """
+        Decorator timing every call of a method as the stage name. With batch set, a call counts as many
+        items as its first argument (after self) has elements, whether it is passed by position or by name.
+        """
+        def decorator(function):
+            # Name of the batch argument, for calls that pass it as a keyword
+            argument = list(inspect.signature(function).parameters)[1] if batch else None
+
+            def items(args, kwargs):
+                if not batch:
+                    return 1
+                return len(args[1] if len(args) > 1 else kwargs[argument])
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.add(name, time.perf_counter() - start, items(args, kwargs))
+            return wrapper
+        return decorator
+
+    def reset(self, prefix=""):
+        for name in [name for name in self.stages if name.startswith(prefix)]:
+            del self.stages[name]
+
+    def summary(self, prefix=""):
+        """
+        Returns:
+        - stages (Dict[str, dict]): Per stage the number of calls and items, the total seconds, items per
+          second and the p50/p95/p99 latency of a call in milliseconds, read from the histogram.
+        """
+        stages = {}
+        for name, stage in sorted(self.stages.items()):
+            if not name.startswith(prefix):
+                continue
+            p50, p95, p99 = stage.percentiles([50, 95, 99]) * 1000
+            stages[name] = dict(calls=stage.calls, items=stage.items, seconds=stage.seconds,
+                                items_per_second=stage.items / stage.seconds if stage.seconds else None,
+                                p50_ms=float(p50), p95_ms=float(p95), p99_ms=float(p99))
+        return stages
+
+
+# Shared by the models and the evaluator, enabled per evaluation run
+timings = Timings()
+
+
+@contextmanager
+def profiled(path=None):
+    """
+    Runs the enclosed block under cProfile and dumps the stats to path (readable with pstats or snakeviz).
+    With path None nothing is profiled, which keeps the hook cheap to leave in place.
+    """
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
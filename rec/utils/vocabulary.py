@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+from rec.utils.arrays import save_arrays, load_arrays
+from rec.utils.timing import timings
+
+
+def canonical_ids(values):
+    """
+    Raw IDs as canonical strings, the form they are compared in across datasets.
+    Floats (IDs read from a CSV with missing values) are truncated to integers first.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        values = values.astype(np.int64)
+    return values.astype(str).astype(object)
+
+
+class IdMap:
+    """Append-only mapping between raw IDs and dense int32 codes."""
+    def __init__(self, ids=()):
+        self.ids = canonical_ids(ids) if len(ids) else np.empty(0, dtype=object)
+        self._index = pd.Index(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @timings.timed("vocabulary.encode", batch=True)
+    def encode(self, values, add=False):
+        """Codes of the raw IDs in values, unknown IDs are appended when add is set and -1 otherwise."""
+        keys = canonical_ids(values)
+        codes = self._index.get_indexer(keys)
+        if add and (codes < 0).any():
+            # New IDs get codes in sorted order, so a fresh map follows the order of pandas categories
+            self.append(np.sort(pd.unique(keys[codes < 0])))
+            codes = self._index.get_indexer(keys)
+        return codes.astype(np.int32)
+
+    def append(self, values):
+        """Appends raw IDs that are not in the map yet, in the given order."""
+        self.ids = np.concatenate([self.ids, canonical_ids(values)])
+        self._index = pd.Index(self.ids)
+
+    def code(self, value):
+        """Code of a single raw ID, -1 when unknown."""
+        try:
+            return self._index.get_loc(canonical_ids([value])[0])
+        except KeyError:
+            return -1
+
+    @timings.timed("vocabulary.decode")
+    def decode(self, codes):
+        return self.ids[codes]
+
+
+class Vocabulary:
+    """
+    Dense int32 codes for raw item and profile IDs, shared by ALS, MC, HSEQ and the evaluator.
+
+    Models add the IDs of their training data when fitting and work on codes internally, raw IDs
+    are only looked up at the boundaries (loading test data and returning recommendations).
+    """
+    def __init__(self, item_ids=(), profile_ids=()):
+        self.items = IdMap(item_ids)
+        self.profiles = IdMap(profile_ids)
+
+    def to_arrays(self):
+        return {'item_ids': self.items.ids, 'profile_ids': self.profiles.ids}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['item_ids'], arrays['profile_ids'])
+
+    def save(self, path):
+        save_arrays(self.to_arrays(), path)
+
+    @classmethod
+    def load(cls, path, vocabulary=None):
+        """
+        Loads a saved vocabulary. When vocabulary is given the saved IDs are added to it instead, which
+        only works if the saved codes are still valid in it (both grew from the same fitting session).
+        """
+        arrays = load_arrays(path)
+        if vocabulary is None:
+            return cls.from_arrays(arrays)
+        for ids, id_map in ((arrays['item_ids'], vocabulary.items), (arrays['profile_ids'], vocabulary.profiles)):
+            shared = min(len(ids), len(id_map))
+            if not np.array_equal(canonical_ids(ids[:shared]), id_map.ids[:shared]):
+                raise ValueError(f"Saved vocabulary in {path} does not match the given vocabulary")
+            id_map.append(ids[shared:])
+        return vocabulary
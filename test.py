@@ -5,6 +5,7 @@ import logging
 import colorlog
 from rec.evaluator.evaluator import Evaluation
 from rec.utils.popularity import PopularityScore
+from rec.utils.vocabulary import Vocabulary
 import threadpoolctl
 import os
 from rec.utils.slack import Slack
@@ -58,14 +59,17 @@ if __name__ == '__main__':
 		PS.load_data('./data/mc/train', nested=True, limit=-1, type='sessions')
 		PS.calculate_popularity_scores_sessions()
 
+		# ALS, MC and the evaluator share one vocabulary of item and profile codes
+		vocabulary = Vocabulary()
+
 		logger.info("Fitting ALS model...")
-		CFR = ALS(factors=1, use_gpu=False, use_cg=False, iterations=1, logger=logger)
+		CFR = ALS(factors=1, use_gpu=False, use_cg=False, iterations=1, logger=logger, vocabulary=vocabulary)
 		CFR.load_data('./data/als/train', nested=True, limit=-1)
 		CFR.preprocess()
 		CFR.fit()
 
 		logger.info("Fitting MC model...")
-		B = MC(method='frequencyScoreNormalizedLog2', logger=logger)
+		B = MC(method='frequencyScoreNormalizedLog2', logger=logger, vocabulary=vocabulary)
 		B.fit(path='./data/mc/train-short', nested=True, limit=-1)
 
 		logger.info("Fitting HSEQ model...")
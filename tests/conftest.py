@@ -0,0 +1,69 @@
+import logging
+import numpy as np
+import pytest
+import threadpoolctl
+from rec.models.als import ALS
+from rec.models.mc import MC
+from rec.models.hseq import HSEQ
+from rec.models.vomc import VariableOrderMC
+from rec.evaluator.evaluator import Evaluation
+from rec.utils.popularity import PopularityScore
+from rec.utils.vocabulary import Vocabulary
+from rec.utils.synthetic import generate
+
+
+@pytest.fixture(scope="session")
+def paths(tmp_path_factory):
+    # A small synthetic dataset shared by all tests
+    return generate(str(tmp_path_factory.mktemp("data")), users=300, items=200, viewing_rows=20000,
+                    session_rows=5000, test_rows=2000, files=2)
+
+
+@pytest.fixture
+def models(paths):
+    """Fitted ALS and MC models sharing one vocabulary."""
+    logger = logging.getLogger("tests")
+    vocabulary = Vocabulary()
+    np.random.seed(0)
+    als = ALS(factors=8, iterations=3, logger=logger, vocabulary=vocabulary)
+    als.model.random_state = 0
+    als.load_data(paths['viewing'], nested=True)
+    als.preprocess()
+    als.fit()
+    threadpoolctl.threadpool_limits(1, "blas")
+    mc = MC(method='frequencyScoreNormalizedLog2', logger=logger, vocabulary=vocabulary)
+    mc.fit(path=paths['sessions'], nested=True)
+    return als, mc
+
+
+@pytest.fixture
+def evaluation(paths, models, tmp_path):
+    """An Evaluation of the fitted models with a small grid of cases, writing to tmp_path."""
+    als, mc = models
+    logger = logging.getLogger("tests")
+    viewing = PopularityScore(logger=logger)
+    viewing.load_data(paths['viewing'], nested=True, type='viewing')
+    viewing.calculate_popularity_scores(1000)
+    sessions = PopularityScore(logger=logger)
+    sessions.load_data(paths['sessions'], nested=True, type='sessions')
+    sessions.calculate_popularity_scores_sessions()
+    evaluation = Evaluation(out_path=f"{tmp_path}/", logger=logger, popularity_scores=viewing.popularity_scores,
+                            session_popularity_scores=sessions.popularity_scores, resume=False)
+    evaluation.setup(als, mc, HSEQ(mc, als, logger=logger), path=paths['test'])
+    evaluation.prepare_reranker_evaluations(["hseq", "mc", "als"], ['frequencyScore', 'frequencyScoreNormalizedLog2'],
+                                            [0.5], [5], [1, 3])
+    return evaluation
+
+
+@pytest.fixture
+def vomc_evaluation(paths, models, tmp_path):
+    """An Evaluation of HSEQ over ALS and a VariableOrderMC fitted on the viewing data."""
+    als, _ = models
+    logger = logging.getLogger("tests")
+    vomc = VariableOrderMC(max_order=2, logger=logger, vocabulary=als.vocabulary)
+    vomc.fit(paths['viewing'], nested=True)
+    evaluation = Evaluation(out_path=f"{tmp_path}/", logger=logger, popularity_scores={}, session_popularity_scores={},
+                            resume=False)
+    evaluation.setup(als, vomc, HSEQ(vomc, als, logger=logger), path=paths['test'])
+    evaluation.prepare_reranker_evaluations(["hseq", "mc"], ['frequencyScore'], [0.5], [5], [1, 3])
+    return evaluation
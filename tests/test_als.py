@@ -0,0 +1,26 @@
+import logging
+import numpy as np
+from rec.models.als import ALS
+
+
+def test_candidates_are_exact_with_an_index(models):
+    als, _ = models
+    als.build_index(n_lists=8, nprobe=1)
+    als.build_candidates(Kmax=10, batch_size=64)
+    exact, _ = als.recommend_batch(als.user_codes, 10, encoded=True, exact=True)
+    assert np.array_equal(als.candidate_items, exact)
+
+
+def test_load_matrix_matches_the_pandas_matrix(paths):
+    logger = logging.getLogger("tests")
+    expected = ALS(factors=8, logger=logger)
+    expected.load_data(paths['viewing'], nested=True)
+    expected.preprocess()
+    expected._build_matrix()
+    # Batches much smaller than the files, so partial matrices are summed several times
+    actual = ALS(factors=8, logger=logger)
+    actual.load_matrix(paths['viewing'], nested=True, batch_size=700)
+    assert (actual.vocabulary.profiles.decode(actual.user_codes) == expected.vocabulary.profiles.decode(expected.user_codes)).all()
+    assert (actual.vocabulary.items.decode(actual.item_codes) == expected.vocabulary.items.decode(expected.item_codes)).all()
+    assert actual.uim.dtype == expected.uim.dtype and actual.uim.shape == expected.uim.shape
+    assert (actual.uim != expected.uim).nnz == 0
@@ -0,0 +1,11 @@
+from rec.models.ann import recall_report
+
+
+def test_recall_report_bypasses_candidates(models):
+    als, _ = models
+    als.build_index(n_lists=8)
+    als.build_candidates(Kmax=20, batch_size=64)
+    report = recall_report(als, als.user_codes, N=10, nprobes=(1, 8), encoded=True)
+    assert report[0]['recall'] < 1
+    # Probing every list is exact
+    assert report[1]['recall'] == 1
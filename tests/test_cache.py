@@ -0,0 +1,30 @@
+import numpy as np
+from rec.evaluator.cache import RecommendationCache
+
+
+def test_least_recently_used_lists_are_evicted_within_max_bytes(models):
+    als, mc = models
+    # Ten lists of 5 codes and scores plus their bookkeeping fit
+    cache = RecommendationCache(als, mc, 5, max_bytes=10 * (5 * 8 + 3 * 8))
+    users = als.user_codes[:15]
+    for batch in (users[:10], users[:5], users[10:15]):
+        items, scores = cache.als(batch, N=3)
+        expected_items, expected_scores = als.recommend_batch(batch, N=3, encoded=True)
+        np.testing.assert_array_equal(items, expected_items)
+        np.testing.assert_allclose(scores, expected_scores)
+    assert cache.stats()['entries'] == 10 and cache.evictions == 5 and cache.hits == 5
+    # The lists of users[5:10] were used least recently
+    assert (cache._slots(users[5:10]) < 0).all() and (cache._slots(np.concatenate([users[:5], users[10:]])) >= 0).all()
+
+
+def test_mc_lists_follow_change_method(models):
+    als, mc = models
+    cache = RecommendationCache(als, mc, 5)
+    codes = np.arange(len(als.vocabulary.items))
+    before = cache.mc_batch(codes, N=5)
+    mc.change_method('frequencyScore')
+    after = cache.mc_batch(codes, N=5)
+    expected = mc.recommend_batch(codes, N=5, encoded=True)
+    for served, new in zip(after, expected):
+        np.testing.assert_array_equal(served, new)
+    assert not np.array_equal(before[1], after[1])
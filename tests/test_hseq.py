@@ -0,0 +1,23 @@
+import logging
+import numpy as np
+from rec.models.hseq import HSEQ
+from rec.types.types import Recommendation, RecommendedItem
+
+
+def _recommendation(ids, scores):
+    recs = Recommendation(item_id=None, user_id=None, items_map={}, items=[], item_ids=[])
+    for item_id, score in zip(ids, scores):
+        recs.items_map[item_id] = RecommendedItem(item_id, score, "BR")
+        recs.items.append(recs.items_map[item_id])
+    return recs
+
+
+def test_rerank_batch_breaks_ties_like_rerank():
+    hseq = HSEQ(None, None, logger=logging.getLogger("tests"))
+    # Softmax is shift invariant, so both lists get the same probabilities and every rank is an exact tie
+    als_ids, als_scores = np.array([0, 1, 2]), np.array([1, 0.5, 0], dtype=np.float32)
+    mc_ids, mc_scores = np.array([3, 4, 5]), np.array([1.25, 0.75, 0.25], dtype=np.float32)
+    items, _, _ = hseq.rerank_batch(als_ids[None], als_scores[None].copy(), mc_ids[None], mc_scores[None].copy(), 0.5, 0.5, 4)
+    recs = hseq._rerank("user", "item", _recommendation(als_ids.tolist(), list(als_scores)),
+                        _recommendation(mc_ids.tolist(), list(mc_scores)), 0.5, 0.5, 4)
+    assert items[0].tolist() == [item.item_id for item in recs.items]
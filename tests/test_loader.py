@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+from rec.evaluator.loader import read_columns
+
+
+def test_converters_only_see_sampled_rows(paths):
+    seen = []
+
+    def convert(values):
+        seen.append(len(values))
+        return values
+
+    columns = read_columns(paths['test'], ['profile_id', 'item_id'], sample_size=100, converters={'profile_id': convert},
+                           chunk_size=300)
+    assert seen == [100]
+    assert len(columns['profile_id']) == len(columns['item_id']) == 100
+
+
+def test_test_profiles_are_not_added_to_the_vocabulary(evaluation, paths, tmp_path):
+    test = pd.read_csv(paths['test'])
+    test.loc[:9, 'profile_id'] = np.arange(10) + 1
+    test.loc[10, 'profile_id'] = 1
+    test.to_csv(tmp_path / "test.csv", index=False)
+    vocabulary = evaluation.vocabulary
+    size = len(vocabulary.profiles)
+    evaluation.load_data(str(tmp_path / "test.csv"))
+    assert len(vocabulary.profiles) == size
+    codes = evaluation.data['profile_code']
+    # Unknown profiles get distinct codes past the vocabulary, known ones keep theirs
+    assert sorted(codes[:10].tolist()) == list(range(size, size + 10))
+    assert codes[10] == codes[0]
+    assert (vocabulary.profiles.decode(codes[11:]) == test['profile_id'][11:].astype(str)).all()
+
+
+def test_default_sample_is_the_pandas_sample(evaluation, paths):
+    evaluation.sample, evaluation.sample_size = True, 100
+    evaluation.load_data(paths['test'])
+    expected = pd.read_csv(paths['test']).dropna().sample(n=100, random_state=evaluation.seed)
+    items = evaluation.vocabulary.items.decode(evaluation.data['item_code'])
+    assert (items == expected['item_id'].astype(str)).all()
@@ -0,0 +1,85 @@
+import logging
+import os
+import numpy as np
+import pytest
+from rec.models.mc import MC, METHODS, TransitionIndex
+from rec.utils.vocabulary import Vocabulary
+
+
+def _pandas_scores(data, minScore, maxScore, bridgeThresholds):
+    # The groupby scoring MC ran before TransitionIndex.from_counts, as the reference for it
+    data = data.copy()
+    by = data.groupby('itemId')
+    data['sumCount'] = by['count'].transform('sum')
+    data['maxCount'] = by['count'].transform('max')
+    data['numItems'] = by['itemId'].transform('count')
+    data = data[data['numItems'] >= bridgeThresholds].copy()
+    data['frequencyScore'] = data['count'] / data['sumCount']
+    data['frequencyScoreNormalized'] = minScore + (data['count'] / data['maxCount']) * (maxScore - minScore)
+    for method, log in (('frequencyScoreNormalizedLog2', np.log2), ('frequencyScoreNormalizedLog10', np.log10)):
+        transformed = log(data['count'] + 1)
+        low, high = transformed.groupby(data['itemId']).transform('min'), transformed.groupby(data['itemId']).transform('max')
+        data[method] = ((transformed - low) / (high - low) * (maxScore - minScore)) + minScore
+    rank = data.groupby('itemId')['frequencyScore'].rank(method='first', ascending=False)
+    data['rankScaledScoreLin'] = minScore + ((data['numItems'] - rank) * (maxScore - minScore) / (data['numItems'] - 1))
+    data['rankScaledScoreLog'] = minScore * np.exp((data['numItems'] - rank) * np.log(maxScore / minScore) / (data['numItems'] - 1))
+    return data
+
+
+@pytest.mark.parametrize("bridgeThresholds", [1, 2, 5])
+def test_from_counts_matches_the_pandas_scores(paths, bridgeThresholds):
+    mc = MC(logger=logging.getLogger("tests"))
+    mc.load_data(paths['sessions'], nested=True)
+    mc.remove_self_links()
+    mc.aggregate_counts()
+    vocabulary = Vocabulary()
+    index = TransitionIndex.from_counts(mc.data, vocabulary, 0.1, 1.0, bridgeThresholds)
+
+    expected = _pandas_scores(mc.data, 0.1, 1.0, bridgeThresholds)
+    reference = Vocabulary()
+    source = reference.items.encode(expected['itemId'], add=True)
+    target = reference.items.encode(expected['nextItemId'], add=True)
+    assert reference.items.decode(np.arange(len(reference.items))).tolist() == vocabulary.items.decode(np.arange(len(vocabulary.items))).tolist()
+    offsets = np.zeros(len(reference.items) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(source, minlength=len(reference.items)), out=offsets[1:])
+    np.testing.assert_array_equal(index.offsets, offsets)
+    for method in METHODS:
+        values = expected[method].to_numpy(dtype=np.float64)
+        order = np.lexsort((-values, source))
+        np.testing.assert_array_equal(index.next_codes[method], target[order])
+        np.testing.assert_array_equal(index.scores[method], values[order].astype(np.float32))
+
+
+def test_recommend_items_reads_the_index(models):
+    _, mc = models
+    sources = np.flatnonzero(np.diff(mc.index.offsets) > 3)[:20]
+    for item_id, length in zip(mc.vocabulary.items.decode(sources), np.diff(mc.index.offsets)[sources]):
+        top = mc.recommend_items(item_id, mc.method, 3)
+        recs = mc.recommend_standard(item_id, N=3)
+        assert top['nextItemId'].tolist() == [item.item_id for item in recs.items]
+        assert (top['itemId'] == item_id).all()
+        # Every transition, the full list of recommend_standard
+        assert len(mc.recommend(item_id)) == len(mc.recommend_standard(item_id).items) == length
+    assert mc.recommend_items("unknown", 'frequencyScore', 3) is None
+
+
+def _transitions(mc, method):
+    # {(itemId, nextItemId): score} of every transition, independent of the code order of the vocabulary
+    sources = np.repeat(np.arange(len(mc.index.offsets) - 1), np.diff(mc.index.offsets))
+    pairs = zip(mc.vocabulary.items.decode(sources).tolist(), mc.vocabulary.items.decode(mc.index.next_codes[method]).tolist())
+    return dict(zip(pairs, mc.index.scores[method].tolist()))
+
+
+def test_partial_fit_matches_a_full_refit(paths):
+    logger = logging.getLogger("tests")
+    files = sorted(os.path.join(paths['sessions'], name) for name in os.listdir(paths['sessions']))
+    assert len(files) > 1
+    full = MC(logger=logger)
+    full.fit(files, nested=True)
+    partial = MC(logger=logger)
+    partial.fit(files[:1], nested=True)
+    partial.partial_fit(files[1:])
+    for method in METHODS:
+        expected, actual = _transitions(full, method), _transitions(partial, method)
+        assert actual.keys() == expected.keys()
+        np.testing.assert_allclose([actual[key] for key in expected], list(expected.values()), rtol=1e-6)
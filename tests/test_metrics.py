@@ -0,0 +1,75 @@
+from collections import Counter
+import numpy as np
+import pytest
+from rec.evaluator.metrics import compute_metrics, gini
+
+
+def _loop_metrics(recs, targets, profiles, popularity, items_count, gini_length):
+    # The per-row loop the evaluator ran before compute_metrics, as the reference for it
+    ctrs, mrrs, item_ids, recommendations, missing = [], [], [], {}, 0
+    for profile, next_item, row in zip(profiles.tolist(), targets.tolist(), recs.tolist()):
+        recommended_items = [item for item in row if item >= 0]
+        if not recommended_items:
+            missing += 1
+            continue
+        ctrs.append(1 if next_item in recommended_items else 0)
+        mrrs.append(1 / (recommended_items.index(next_item) + 1) if next_item in recommended_items else 0)
+        user = recommendations.setdefault(profile, {'actual': [], 'recommended': []})
+        user['actual'].append(next_item)
+        user['recommended'].extend(recommended_items)
+        item_ids.extend(recommended_items)
+    recommended_for_popularity, precisions = [], []
+    for user in recommendations.values():
+        recommended_items = set(user['recommended'])
+        recommended_for_popularity.extend(recommended_items)
+        precisions.append(len(set(user['actual']) & recommended_items) / len(recommended_items))
+    duration, count, session = (scores[recommended_for_popularity] for scores in popularity)
+    duration, count = duration[~np.isnan(duration)], count[~np.isnan(count)]
+    session = session[~np.isnan(session) & (session != 0)]
+    return dict(map=sum(precisions) / len(precisions), accuracy=sum(mrrs) / len(mrrs), avgctr=sum(ctrs) / len(ctrs),
+                avg_popularity_score=duration.mean(), avg_count_popularity_score=count.mean(),
+                avg_session_popularity_score=session.mean(),
+                coverage=len(set(recommended_for_popularity)) / items_count,
+                gini_index=gini(np.array(list(Counter(item_ids).values())), gini_length), missing_recommendations=missing)
+
+
+@pytest.fixture
+def inputs():
+    rng = np.random.default_rng(0)
+    rows, n_items = 500, 40
+    # Distinct items per row, padded with -1 in some rows and missing entirely in others
+    recs = np.argsort(rng.random((rows, n_items)), axis=1)[:, :5].astype(np.int32)
+    recs[rng.random((rows, 5)) < np.linspace(0, 0.5, 5)] = -1
+    recs = -np.sort(-recs, axis=1)
+    recs[rng.random(rows) < 0.05] = -1
+    targets = rng.integers(-1, n_items, rows)
+    profiles = rng.integers(0, 60, rows)
+    popularity = tuple(np.where(rng.random(n_items) < 0.2, np.nan, rng.integers(0, 4, n_items).astype(np.float64))
+                       for _ in range(3))
+    return recs, targets, profiles, popularity
+
+
+def test_compute_metrics_matches_the_row_loop(inputs):
+    recs, targets, profiles, popularity = inputs
+    expected = _loop_metrics(recs, targets, profiles, popularity, 35, 50)
+    actual = compute_metrics(recs, targets, profiles, popularity, items_count=35, gini_length=50)
+    assert actual.keys() == expected.keys()
+    assert expected['missing_recommendations'] > 0 and 0 < expected['avgctr'] < 1
+    for name, value in expected.items():
+        assert actual[name] == pytest.approx(value, rel=1e-12), name
+
+
+def test_weights_count_as_repeated_rows(inputs):
+    recs, targets, profiles, popularity = inputs
+    weights = np.random.default_rng(1).integers(1, 4, len(recs))
+    expected = compute_metrics(*(np.repeat(array, weights, axis=0) for array in (recs, targets, profiles)), popularity,
+                               items_count=35)
+    actual = compute_metrics(recs, targets, profiles, popularity, items_count=35, weights=weights)
+    for name, value in expected.items():
+        assert actual[name] == pytest.approx(value, rel=1e-12), name
+
+
+def test_coverage_without_items_is_zero(inputs):
+    recs, targets, profiles, _ = inputs
+    assert compute_metrics(recs, targets, profiles, items_count=0)['coverage'] == 0
+    assert compute_metrics(recs, targets, profiles)['coverage'] == 0
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import pytest
+from rec.utils.mining import mine_rules
+
+
+def _events(rng, sessions=60, items=30):
+    # Session-ordered events with repeated items, sessions of up to 80 events
+    lengths = rng.integers(1, 80, sessions)
+    profiles = np.repeat(rng.choice(10 * sessions, sessions, replace=False), lengths)
+    items = rng.integers(0, items, lengths.sum()) + 1000
+    return pd.DataFrame({'profileId': profiles, 'itemId': items})
+
+
+@pytest.mark.parametrize("string_sessions", [False, True])
+def test_spilled_rules_match_a_groupby_count(tmp_path, string_sessions):
+    events = _events(np.random.default_rng(0))
+    if string_sessions:
+        events['profileId'] = "profile-" + events['profileId'].astype(str)
+    # Uneven files cut through sessions, so transitions cross both batch and file boundaries
+    cuts = [0, 500, 1337, 1338, len(events)]
+    (tmp_path / "events").mkdir()
+    for i, (start, end) in enumerate(zip(cuts[:-1], cuts[1:])):
+        events.iloc[start:end].to_parquet(tmp_path / "events" / f"part-{i}.parquet", index=False)
+    rules = mine_rules(str(tmp_path / "events"), str(tmp_path / "rules.parquet"), nested=True, memory=4096, batch_size=97,
+                       tmp=str(tmp_path))
+
+    following = events.shift(-1)
+    pairs = (events['profileId'] == following['profileId']) & (events['itemId'] != following['itemId'])
+    expected = pd.DataFrame({'itemId': events['itemId'][pairs], 'nextItemId': following['itemId'][pairs].astype(np.int64)}) \
+        .groupby(['itemId', 'nextItemId']).size().rename('count').reset_index()
+    actual = pd.read_parquet(tmp_path / "rules.parquet")
+    assert rules == len(expected)
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
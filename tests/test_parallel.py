@@ -0,0 +1,35 @@
+import pandas as pd
+from rec.evaluator import parallel
+
+
+def _results(evaluation, experiment_id, workers):
+    evaluation.evaluate_reranker(experiment_id, workers=workers)
+    columns = ['model', 'method', 'w1', 'w2', 'K', 'N']
+    return pd.read_csv(f"{evaluation.out_path}{experiment_id}.csv").sort_values(columns).reset_index(drop=True)
+
+
+def test_parallel_matches_serial_with_index(evaluation):
+    als = evaluation.ALS
+    als.build_index(n_lists=8, nprobe=1)
+    # With one probed list the index returns other lists than exact scoring
+    users = als.user_codes[:100]
+    assert not (als.recommend_batch(users, 5, encoded=True)[0] == als.recommend_batch(users, 5, encoded=True, exact=True)[0]).all()
+    serial = _results(evaluation, "serial", workers=1)
+    parallel = _results(evaluation, "parallel", workers=2)
+    pd.testing.assert_frame_equal(serial, parallel)
+
+
+def test_workers_use_the_evaluation_settings(evaluation, tmp_path):
+    evaluation.single_pass, evaluation.dedup, evaluation.batch_size = False, False, 100
+    parallel._init_worker(str(tmp_path), parallel._share(evaluation, str(tmp_path), blas_threads=1))
+    worker = parallel._worker.pop('evaluation')
+    assert (worker.single_pass, worker.dedup, worker.batch_size) == (False, False, 100)
+    serial = _results(evaluation, "serial", workers=1)
+    parallel_results = _results(evaluation, "parallel", workers=2)
+    pd.testing.assert_frame_equal(serial, parallel_results)
+
+
+def test_parallel_matches_serial_with_variable_order_mc(vomc_evaluation):
+    serial = _results(vomc_evaluation, "serial", workers=1)
+    parallel_results = _results(vomc_evaluation, "parallel", workers=2)
+    pd.testing.assert_frame_equal(serial, parallel_results)
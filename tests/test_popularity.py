@@ -0,0 +1,24 @@
+import numpy as np
+from rec.utils.dataset import read_table
+from rec.utils.popularity import DailyPopularity, POPULARITY_COLUMNS
+
+
+def test_adding_days_one_at_a_time_matches_one_add(paths):
+    data = read_table(paths['viewing'], POPULARITY_COLUMNS, nested=True).to_pandas()
+    day = data['firstStart'].dt.floor('D')
+    full = DailyPopularity()
+    full.add(data)
+    incremental = DailyPopularity()
+    days = sorted(day.unique())
+    # Later days first, then the earlier ones, with windows taken in between
+    for added in days[len(days) // 2:] + days[:len(days) // 2]:
+        incremental.add(data[day == added])
+        incremental.window(7)
+    # Days are appended in place, the arrays are only reallocated when the capacity doubles
+    assert incremental._counts.shape[0] < 2 * len(days)
+    # Items are coded in the order they were first added, compare them by ID
+    order = incremental.vocabulary.items.encode(full.vocabulary.items.decode(np.arange(len(full.vocabulary.items))))
+    np.testing.assert_array_equal(incremental.counts[:, order], full.counts)
+    np.testing.assert_allclose(incremental.durations[:, order], full.durations)
+    for window in (0, 3, 1000):
+        assert incremental.to_dict(window) == full.to_dict(window)
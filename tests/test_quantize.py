@@ -0,0 +1,14 @@
+import numpy as np
+from rec.evaluator.metrics import overlap
+
+
+def test_quantized_top_lists_match_float32(models):
+    als, _ = models
+    exact, exact_scores = als.recommend_batch(als.user_codes, 10, encoded=True, exact=True)
+    for precision, min_overlap, tolerance in (('float16', 0.98, 0.01), ('int8', 0.85, 0.05)):
+        model = type(als).from_arrays(als.to_arrays(), als.vocabulary, logger=als.logger)
+        model.quantize(precision)
+        recs, scores = model.recommend_batch(als.user_codes, 10, encoded=True, exact=True)
+        assert overlap(recs, exact) >= min_overlap
+        # The k-th best score moves by at most the rounding error, relative to the largest score
+        np.testing.assert_allclose(scores, exact_scores, atol=tolerance * np.abs(exact_scores).max())
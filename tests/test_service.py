@@ -0,0 +1,69 @@
+import time
+import asyncio
+import numpy as np
+import pytest
+from rec.serving.service import MicroBatcher, Service
+
+
+class SlowHSEQ:
+    """Stands in for HSEQ, every batch takes delay seconds and the scored users are recorded."""
+    def __init__(self, delay):
+        self.delay = delay
+        self.users = []
+
+    def recommend_batch(self, user_ids, item_ids, N=5, w1=0.5, w2=0.5, K=5):
+        time.sleep(self.delay)
+        self.users += list(user_ids)
+        return np.zeros((len(user_ids), N), dtype=np.int64), np.zeros((len(user_ids), N))
+
+    def item_ids(self, codes):
+        return codes
+
+
+def test_timed_out_request_is_not_scored():
+    async def run():
+        hseq = SlowHSEQ(0.2)
+        batcher = MicroBatcher(hseq, window=0.001)
+        task = asyncio.get_running_loop().create_task(batcher.run())
+        await asyncio.sleep(0)
+        first = asyncio.ensure_future(batcher.recommend("a", "x", budget=5))
+        await asyncio.sleep(0.05)
+        # Queued while the first batch is scored, its budget runs out before the next batch starts
+        with pytest.raises(asyncio.TimeoutError):
+            await batcher.recommend("b", "x", budget=0.05)
+        await first
+        await asyncio.sleep(0.3)
+        task.cancel()
+        return hseq.users
+
+    assert asyncio.run(run()) == ["a"]
+
+
+def test_malformed_requests_get_400():
+    async def request(port, data):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(data)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        return response
+
+    async def run():
+        batcher = MicroBatcher(SlowHSEQ(0), window=0.001)
+        server = await Service(batcher).start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        responses = [await request(port, data) for data in (
+            b"GARBAGE\r\n\r\n",
+            b"POST /recommend HTTP/1.1\r\ncontent-length: many\r\n\r\n",
+            b"GET /health HTTP/1.1\r\nno colon\r\n\r\n",
+            b"GET /recommend?user_id=a&item_id=x HTTP/1.1\r\nConnection: close\r\n\r\n")]
+        # Requests are timed into a fixed-size histogram, not one entry per request
+        buckets = len(batcher.timings.stages["request"].buckets)
+        for _ in range(100):
+            await batcher.recommend("a", "x")
+        server.close()
+        return responses, buckets, len(batcher.timings.stages["request"].buckets)
+
+    responses, before, after = asyncio.run(run())
+    assert [response.split(b"\r\n")[0] for response in responses] == [b"HTTP/1.1 400 Bad Request"] * 3 + [b"HTTP/1.1 200 OK"]
+    assert before == after
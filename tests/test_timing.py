@@ -0,0 +1,31 @@
+import numpy as np
+from rec.utils.timing import Timings, BUCKETS, BUCKETS_PER_DECADE
+
+
+def test_batch_size_of_positional_and_keyword_batches():
+    timings = Timings(enabled=True)
+
+    class Model:
+        @timings.timed("model.recommend_batch", batch=True)
+        def recommend_batch(self, users, N=5):
+            return users[:N]
+
+    model = Model()
+    model.recommend_batch(["a", "b"])
+    model.recommend_batch(users=["a", "b", "c"], N=1)
+    model.recommend_batch(["a"], N=1)
+    stage = timings.summary()["model.recommend_batch"]
+    assert (stage['calls'], stage['items']) == (3, 6)
+
+
+def test_percentiles_from_a_bounded_histogram():
+    timings = Timings(enabled=True)
+    durations = np.random.default_rng(0).lognormal(np.log(0.002), 1, 100000)
+    for seconds in durations:
+        timings.add("stage", seconds)
+    stage = timings.summary()["stage"]
+    assert stage['calls'] == len(durations) and np.isclose(stage['seconds'], durations.sum())
+    # Within half a bucket of the exact percentiles, with memory that does not grow with the calls
+    for q in (50, 95, 99):
+        assert abs(np.log10(stage[f'p{q}_ms'] / 1000 / np.percentile(durations, q))) <= 0.5 / BUCKETS_PER_DECADE + 1e-3
+    assert len(timings.stages["stage"].buckets) == BUCKETS
@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+from rec.models.hseq import HSEQ
+
+
+def test_evaluation_with_variable_order_mc(vomc_evaluation, tmp_path):
+    vomc_evaluation.evaluate_reranker("vomc")
+    results = pd.read_csv(f"{tmp_path}/vomc.csv")
+    assert len(results) == 4 and (results['MAP'] > 0).all()
+
+
+def test_hseq_with_a_cache_takes_session_contexts(vomc_evaluation):
+    als, vomc = vomc_evaluation.ALS, vomc_evaluation.MC
+    users = als.user_codes[:50]
+    contexts = np.random.default_rng(0).integers(0, len(als.vocabulary.items), (50, vomc.max_order))
+    cached = HSEQ(vomc, als, logger=vomc.logger, cache=vomc_evaluation.cache)
+    expected = HSEQ(vomc, als, logger=vomc.logger).recommend_batch(users, contexts, N=3, K=5, encoded=True)
+    for served, exact in zip(cached.recommend_batch(users, contexts, N=3, K=5, encoded=True), expected):
+        np.testing.assert_array_equal(served, exact)
+    # Longer contexts change the lists of some rows
+    assert not np.array_equal(expected[0], HSEQ(vomc, als, logger=vomc.logger).recommend_batch(
+        users, contexts[:, -1], N=3, K=5, encoded=True)[0])